@@ -1,79 +1,417 @@
-from typing import List
+import asyncio
+import logging
+from typing import Awaitable, Dict, List, Optional, Tuple, TypeVar
 import requests.rq as rq
-from models.schemas.schemas import PredictionsResponse, PredictionSchema
-from requests.prediction import PurchasePatternAnalyzer
-from fastapi import APIRouter, Query
+from core import metrics
+from core.cache import ResultCache
+from core.circuit import CircuitOpenError
+from core.config import (
+    PREDICTION_CACHE_ENABLED,
+    PREDICTION_CACHE_MAX_ENTRIES,
+    PREDICTION_CACHE_TTL_SECONDS,
+    PREDICTION_REVALIDATE_RETRY_SECONDS,
+    PREDICTION_STALE_AFTER_SECONDS,
+    PREDICTION_STALE_MAX_AGE_SECONDS,
+    SALES_WATERMARK_MAX_AGE_SECONDS,
+)
+from core.remote_db import REMOTE_ERRORS, PoolTimeout
+from core.serialization import FastJSONResponse
+from models.schemas.schemas import PairPredictionsRequest, PredictionSchema, PredictionsResponse
+from requests import pipeline
+from requests.deltas import delta_feed
+from requests.precompute import prediction_scheduler
+from requests.prediction_index import PredictionIndex
+from fastapi import APIRouter, Header, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
 
-from datetime import datetime
+from datetime import date, datetime
 
 router = APIRouter(prefix="/predictions", tags=["predictions"])
 
+prediction_cache = ResultCache(
+    max_entries=PREDICTION_CACHE_MAX_ENTRIES,
+    ttl_seconds=PREDICTION_CACHE_TTL_SECONDS,
+)
 
-@router.get("/predictions", response_model=PredictionsResponse)
-def get_sales_predictions(
-        min_requirements: int = Query(3, ge=2, le=10, description="Minimum purchase count"),
-        confidence_threshold: float = Query(0.6, ge=0.0, le=1.0, description="Minimum confidence")
-):
-    patterns_data = rq.get_purchase_patterns(min_requirements=min_requirements)
+# One index per min_requirements value, for the client/goods/agent/due lookups
+index_cache = ResultCache(
+    max_entries=PREDICTION_CACHE_MAX_ENTRIES,
+    ttl_seconds=PREDICTION_CACHE_TTL_SECONDS,
+)
+
+# Last good result per request parameters, whatever the data version; see _stale_response
+stale_cache = ResultCache(
+    max_entries=PREDICTION_CACHE_MAX_ENTRIES,
+    ttl_seconds=PREDICTION_STALE_MAX_AGE_SECONDS,
+)
+
+# cache_key -> background task refreshing a result that was served stale
+_revalidations: Dict[tuple, asyncio.Task] = {}
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+T = TypeVar("T")
+
+
+def _filters_applied(min_requirements: int, confidence_threshold: float,
+                     limit: Optional[int], cursor: Optional[str]) -> dict:
+    filters_applied = {
+        "min_requirements": min_requirements,
+        "confidence_threshold": confidence_threshold
+    }
+    if limit is not None:
+        filters_applied["limit"] = limit
+    if cursor is not None:
+        filters_applied["cursor"] = cursor
+    return filters_applied
+
+
+def _json_response(result: PredictionsResponse, response: Optional[Response] = None) -> FastJSONResponse:
+    """
+    Serialize the way FastAPI would for response_model_exclude_none=True, but without
+    validating the model again and under the serialize stage timer.
+    Headers set on `response` are carried over.
+    """
+    with metrics.stage("serialize"):
+        return FastJSONResponse(result, headers=dict(response.headers) if response is not None else None)
+
+
+async def _computed_response(
+        min_requirements: int,
+        confidence_threshold: float,
+        limit: Optional[int],
+        cursor: Optional[str],
+        after: Optional[pipeline.SortKey],
+        watermark: Optional[int],
+) -> PredictionsResponse:
+    """The full /predictions result, stored in the result and stale caches."""
+    cache_key = (min_requirements, confidence_threshold, limit, cursor)
 
-    if not patterns_data["patterns"]:
-        return PredictionsResponse(
-            predictions=[],
+    async def compute() -> PredictionsResponse:
+        next_cursor = None
+
+        if limit is None:
+            predictions = await pipeline.build_predictions_async(min_requirements, confidence_threshold)
+            total = len(predictions)
+        else:
+            predictions, total, next_cursor = await pipeline.build_page_async(
+                min_requirements, confidence_threshold, limit, after
+            )
+
+        result = PredictionsResponse(
+            predictions=predictions,
             generated_at=datetime.now(),
-            total_predictions=0,
-            filters_applied={
-                "min_requirements": min_requirements,
-                "confidence_threshold": confidence_threshold
-            }
+            total_predictions=total,
+            filters_applied=_filters_applied(min_requirements, confidence_threshold, limit, cursor),
+            next_cursor=next_cursor,
         )
 
-    analyzer = PurchasePatternAnalyzer(
-        min_requirements=min_requirements,
-        confidence_threshold=confidence_threshold
-    )
+        if PREDICTION_CACHE_ENABLED:
+            prediction_cache.set(cache_key, result, version=watermark)
+        if PREDICTION_STALE_MAX_AGE_SECONDS > 0:
+            stale_cache.set(cache_key, result)
+        return result
 
-    predictions: List[PredictionSchema] = []
+    # Identical requests arriving while this one is computed wait for it instead of recomputing
+    return await pipeline.flights.do_async(("response", cache_key, watermark), compute)
 
-    for pattern in patterns_data["patterns"]:
-        analysis = analyzer.analyze_client_product_pattern(
-            pattern["dates"],
-            pattern["amounts"]
-        )
 
-        if analysis is None:
-            continue
+async def _within_deadline(awaitable: Awaitable[T], stale: Optional[PredictionsResponse]) -> T:
+    """
+    With a stale result to fall back on, stop waiting after PREDICTION_STALE_AFTER_SECONDS
+    (asyncio.TimeoutError). A computation coalesced in pipeline.flights keeps running and
+    fills the caches when it finishes.
+    """
+    if stale is None:
+        return await awaitable
+    return await asyncio.wait_for(awaitable, PREDICTION_STALE_AFTER_SECONDS)
+
 
-        # Filter by confidence
-        if analysis["confidence_score"] < confidence_threshold:
-            continue
+async def _revalidate(min_requirements: int, confidence_threshold: float, limit: Optional[int],
+                      cursor: Optional[str], after: Optional[pipeline.SortKey]):
+    cache_key = (min_requirements, confidence_threshold, limit, cursor)
+    delay = PREDICTION_REVALIDATE_RETRY_SECONDS
 
-        # Create prediction
+    # Gives up once the stale entry itself expires, nobody is being served from it any more
+    while stale_cache.get(cache_key) is not None:
         try:
-            prediction = PredictionSchema(
-                client_id=pattern["client_id"],
-                client_name=pattern["client_name"],
-                agent_id=pattern["agent_id"],
-                agent_name=pattern["agent_name"],
-                goods_id=pattern["goods_id"],
-                goods_name=pattern["goods_name"],
-                purchase_count=pattern["purchase_count"],
-
-                **analysis
-            )
-            predictions.append(prediction)
+            watermark = None
+            if PREDICTION_CACHE_ENABLED:
+                watermark = await rq.get_sales_watermark_async(max_age=SALES_WATERMARK_MAX_AGE_SECONDS)
+            await _computed_response(min_requirements, confidence_threshold, limit, cursor, after, watermark)
+            logging.info(f"Revalidated stale predictions for {cache_key}")
+            return
+        except CircuitOpenError as e:
+            delay = max(delay, e.retry_after)
         except Exception as e:
-            print(f"Error creating prediction: {e}")
-            continue
+            logging.warning(f"Revalidating predictions for {cache_key} failed: {e!r}")
+
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 10 * PREDICTION_REVALIDATE_RETRY_SECONDS)
+
+
+def _start_revalidation(*args):
+    cache_key = args[:4]
+    if cache_key in _revalidations:
+        return
+
+    task = asyncio.create_task(_revalidate(*args))
+    _revalidations[cache_key] = task
+    task.add_done_callback(lambda _: _revalidations.pop(cache_key, None))
+
+
+def cancel_revalidations():
+    for task in list(_revalidations.values()):
+        task.cancel()
+
+
+def _stale_response(stale: PredictionsResponse, response: Response) -> FastJSONResponse:
+    age = max(0.0, (datetime.now() - stale.generated_at).total_seconds())
+    response.headers["X-Cache"] = "STALE"
+    response.headers["Age"] = str(int(age))
+    response.headers["Warning"] = '110 - "Response is Stale"'
+    metrics.count("stale_responses", 1)
+    return _json_response(stale.model_copy(update={"stale": True, "age_seconds": round(age, 1)}), response)
+
+
+@router.get("/predictions", response_model=PredictionsResponse, response_model_exclude_none=True)
+async def get_sales_predictions(
+        response: Response,
+        min_requirements: int = Query(3, ge=2, le=10, description="Minimum purchase count"),
+        confidence_threshold: float = Query(0.6, ge=0.0, le=1.0, description="Minimum confidence"),
+        limit: Optional[int] = Query(None, ge=1, le=10000, description="Return only the N most overdue (top-K / page size)"),
+        cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
+        response_format: str = Query("json", alias="format", pattern="^(json|ndjson)$",
+                                     description="ndjson streams one prediction per line"),
+        accept: Optional[str] = Header(None),
+        cache_control: Optional[str] = Header(None, description="Send 'no-cache' to skip the result cache"),
+):
+    after = None
+    if cursor is not None:
+        if limit is None:
+            raise HTTPException(status_code=400, detail="cursor requires limit")
+        try:
+            after = pipeline.decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    ndjson = response_format == "ndjson" or (accept and NDJSON_MEDIA_TYPE in accept)
+
+    materialized = prediction_scheduler.get(min_requirements)
+    if materialized is not None:
+        predictions, total, next_cursor = materialized.select(confidence_threshold, limit, after)
+        response.headers["X-Generated-At"] = materialized.generated_at.isoformat()
+
+        if ndjson:
+            return StreamingResponse(
+                pipeline.stream_ndjson(predictions),
+                media_type=NDJSON_MEDIA_TYPE,
+                headers={"X-Generated-At": materialized.generated_at.isoformat()},
+            )
+
+        return _json_response(PredictionsResponse(
+            predictions=predictions,
+            generated_at=materialized.generated_at,
+            total_predictions=total,
+            filters_applied=_filters_applied(min_requirements, confidence_threshold, limit, cursor),
+            next_cursor=next_cursor,
+        ), response)
+
+    if ndjson:
+        return StreamingResponse(
+            pipeline.stream_predictions_ndjson(min_requirements, confidence_threshold, limit, after),
+            media_type=NDJSON_MEDIA_TYPE,
+        )
+
+    use_cache = PREDICTION_CACHE_ENABLED
+    if use_cache and cache_control and "no-cache" in cache_control.lower():
+        prediction_cache.record_bypass()
+        use_cache = False
+
+    cache_key = (min_requirements, confidence_threshold, limit, cursor)
+    watermark = None
+    stale = stale_cache.get(cache_key) if PREDICTION_STALE_MAX_AGE_SECONDS > 0 else None
+
+    try:
+        if PREDICTION_CACHE_ENABLED:
+            # Read before computing, so a sale landing mid-computation invalidates the entry
+            watermark = await _within_deadline(
+                rq.get_sales_watermark_async(max_age=SALES_WATERMARK_MAX_AGE_SECONDS), stale
+            )
+
+        if use_cache:
+            cached = prediction_cache.get(cache_key, version=watermark)
+            if cached is not None:
+                response.headers["X-Cache"] = "HIT"
+                return _json_response(cached, response)
+
+        result = await _within_deadline(
+            _computed_response(min_requirements, confidence_threshold, limit, cursor, after, watermark), stale
+        )
+    except (CircuitOpenError, PoolTimeout, *REMOTE_ERRORS) as e:
+        if stale is None:
+            if isinstance(e, CircuitOpenError):
+                raise
+            raise HTTPException(status_code=503, detail="Database unavailable") from e
+        logging.warning(f"Serving stale predictions for {cache_key}: {e!r}")
+        _start_revalidation(min_requirements, confidence_threshold, limit, cursor, after)
+        return _stale_response(stale, response)
+
+    response.headers["X-Cache"] = "MISS" if use_cache else "BYPASS"
+    return _json_response(result, response)
 
-    # Sort by urgency (days since last requirement, descending)
-    predictions.sort(key=lambda p: p.days_since_last_requirement, reverse=True)
 
-    return PredictionsResponse(
+async def _prediction_index(min_requirements: int) -> Tuple[PredictionIndex, datetime]:
+    materialized = prediction_scheduler.get(min_requirements)
+    if materialized is not None:
+        return await asyncio.to_thread(lambda: materialized.index), materialized.generated_at
+
+    watermark = await rq.get_sales_watermark_async(max_age=SALES_WATERMARK_MAX_AGE_SECONDS)
+    cached = index_cache.get(min_requirements, version=watermark)
+    if cached is not None:
+        return cached
+
+    async def build() -> Tuple[PredictionIndex, datetime]:
+        entry = await pipeline.build_index_async(min_requirements), datetime.now()
+        index_cache.set(min_requirements, entry, version=watermark)
+        return entry
+
+    return await pipeline.flights.do_async(("index", min_requirements, watermark), build)
+
+
+def _lookup_response(predictions: List[PredictionSchema], generated_at: datetime, **filters_applied) -> FastJSONResponse:
+    return _json_response(PredictionsResponse(
         predictions=predictions,
-        generated_at=datetime.now(),
+        generated_at=generated_at,
         total_predictions=len(predictions),
-        filters_applied={
-            "min_requirements": min_requirements,
-            "confidence_threshold": confidence_threshold
-        }
+        filters_applied=filters_applied,
+    ))
+
+
+@router.get("/clients/{client_id}", response_model=PredictionsResponse, response_model_exclude_none=True)
+async def get_client_predictions(
+        client_id: int,
+        min_requirements: int = Query(3, ge=2, le=10, description="Minimum purchase count"),
+        confidence_threshold: float = Query(0.6, ge=0.0, le=1.0, description="Minimum confidence"),
+):
+    index, generated_at = await _prediction_index(min_requirements)
+    return _lookup_response(
+        index.by_client(client_id, confidence_threshold), generated_at,
+        client_id=client_id, min_requirements=min_requirements, confidence_threshold=confidence_threshold,
+    )
+
+
+@router.get("/goods/{goods_id}", response_model=PredictionsResponse, response_model_exclude_none=True)
+async def get_goods_predictions(
+        goods_id: int,
+        min_requirements: int = Query(3, ge=2, le=10, description="Minimum purchase count"),
+        confidence_threshold: float = Query(0.6, ge=0.0, le=1.0, description="Minimum confidence"),
+):
+    index, generated_at = await _prediction_index(min_requirements)
+    return _lookup_response(
+        index.by_goods(goods_id, confidence_threshold), generated_at,
+        goods_id=goods_id, min_requirements=min_requirements, confidence_threshold=confidence_threshold,
+    )
+
+
+@router.get("/agents/{agent_id}", response_model=PredictionsResponse, response_model_exclude_none=True)
+async def get_agent_predictions(
+        agent_id: int,
+        min_requirements: int = Query(3, ge=2, le=10, description="Minimum purchase count"),
+        confidence_threshold: float = Query(0.6, ge=0.0, le=1.0, description="Minimum confidence"),
+):
+    index, generated_at = await _prediction_index(min_requirements)
+    return _lookup_response(
+        index.by_agent(agent_id, confidence_threshold), generated_at,
+        agent_id=agent_id, min_requirements=min_requirements, confidence_threshold=confidence_threshold,
+    )
+
+
+@router.get("/due", response_model=PredictionsResponse, response_model_exclude_none=True)
+async def get_due_predictions(
+        due_from: Optional[date] = Query(None, alias="from", description="Earliest predicted next purchase date"),
+        due_to: Optional[date] = Query(None, alias="to", description="Latest predicted next purchase date"),
+        min_requirements: int = Query(3, ge=2, le=10, description="Minimum purchase count"),
+        confidence_threshold: float = Query(0.6, ge=0.0, le=1.0, description="Minimum confidence"),
+):
+    if due_from is not None and due_to is not None and due_from > due_to:
+        raise HTTPException(status_code=400, detail="'from' must not be after 'to'")
+
+    index, generated_at = await _prediction_index(min_requirements)
+    filters_applied = {"min_requirements": min_requirements, "confidence_threshold": confidence_threshold}
+    if due_from is not None:
+        filters_applied["from"] = due_from
+    if due_to is not None:
+        filters_applied["to"] = due_to
+
+    return _lookup_response(
+        index.due_between(due_from, due_to, confidence_threshold), generated_at, **filters_applied
+    )
+
+
+@router.post("/batch", response_model=PredictionsResponse, response_model_exclude_none=True)
+async def get_pair_predictions(
+        body: PairPredictionsRequest,
+        min_requirements: int = Query(3, ge=2, le=10, description="Minimum purchase count"),
+        confidence_threshold: float = Query(0.6, ge=0.0, le=1.0, description="Minimum confidence"),
+):
+    """
+    Predictions for explicit (client_id, goods_id) pairs. Served from the precomputed
+    set when there is one, otherwise only the sales of these pairs are fetched and analyzed.
+    """
+    pairs = list(dict.fromkeys((pair.client_id, pair.goods_id) for pair in body.pairs))
+
+    materialized = prediction_scheduler.get(min_requirements)
+    if materialized is not None:
+        index = await asyncio.to_thread(lambda: materialized.index)
+        predictions = [p for pair in pairs for p in index.by_pair(*pair, confidence_threshold)]
+        predictions.sort(key=lambda p: p.days_since_last_requirement, reverse=True)
+        generated_at = materialized.generated_at
+    else:
+        predictions = await pipeline.build_pair_predictions_async(pairs, min_requirements, confidence_threshold)
+        generated_at = datetime.now()
+
+    return _lookup_response(
+        predictions, generated_at,
+        pairs=len(pairs), min_requirements=min_requirements, confidence_threshold=confidence_threshold,
     )
+
+
+@router.get("/stream", response_class=StreamingResponse)
+async def stream_prediction_deltas(
+        min_requirements: int = Query(3, ge=2, le=10, description="Minimum purchase count"),
+        confidence_threshold: float = Query(0.6, ge=0.0, le=1.0, description="Minimum confidence"),
+):
+    """
+    Server-Sent Events of changes to the actionable prediction set: `due` (entered the
+    window), `fulfilled` (closed by a new sale) and `dropped` (expired), each carrying
+    the prediction as data. A `reset` event followed by every current prediction as
+    `due` comes first, and again whenever the client falls too far behind. All
+    subscribers share one computation per interval.
+    """
+    return StreamingResponse(
+        delta_feed(min_requirements).stream(confidence_threshold),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/cache")
+def get_cache_stats():
+    return prediction_cache.stats()
+
+
+@router.get("/precompute")
+def get_precompute_status():
+    return prediction_scheduler.stats()
+
+
+@router.post("/precompute")
+async def trigger_precompute(
+        wait: bool = Query(False, description="Wait for the refresh to finish"),
+):
+    if wait:
+        return await prediction_scheduler.refresh()
+
+    prediction_scheduler.trigger()
+    return {"triggered": True, **prediction_scheduler.stats()}
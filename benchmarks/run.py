@@ -0,0 +1,235 @@
+"""
+Offline micro-benchmarks of the prediction path on synthetic data.
+
+    python -m benchmarks.run --rows 1000000 --repeat 3
+    python -m benchmarks.run --rows 1000000 --compare benchmarks/results/<commit>.json
+
+Each stage is timed separately and the report is written as JSON
+(benchmarks/results/<commit>.json by default) so runs can be diffed between commits.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from benchmarks.synthetic import generate_history, generate_names
+from core import serialization
+from models.schemas.schemas import PredictionsResponse
+from requests import pipeline
+from requests.patterns import PatternGroups
+from requests.prediction import PurchasePatternAnalyzer
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True, cwd=os.path.dirname(__file__),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _time_stage(fn: Callable[[], Any], repeat: int, items: int) -> Dict[str, Any]:
+    timings: List[float] = []
+    result = None
+
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+
+    median = statistics.median(timings)
+    return {
+        "items": items,
+        "min_s": round(min(timings), 6),
+        "median_s": round(median, 6),
+        "mean_s": round(statistics.fmean(timings), 6),
+        "items_per_s": round(items / median, 1) if median else None,
+        "_result": result,
+    }
+
+
+def run(rows: int, seed: int, repeat: int, min_requirements: int, confidence_threshold: float) -> Dict[str, Any]:
+    started = time.perf_counter()
+    history = generate_history(rows, seed=seed)
+    names = generate_names(history)
+    generate_s = time.perf_counter() - started
+
+    analyzer = PurchasePatternAnalyzer(min_requirements=min_requirements, confidence_threshold=confidence_threshold)
+    stages: Dict[str, Dict[str, Any]] = {}
+
+    def group():
+        groups = PatternGroups()
+        groups.add_rows(history)
+        return groups.to_result(min_requirements)["patterns"].with_names(names)
+
+    stages["group_patterns"] = _time_stage(group, repeat, len(history))
+    patterns = stages["group_patterns"]["_result"]
+
+    def analyze_scalar():
+        return [
+            (patterns.info(i), analyzer.analyze_client_product_pattern(p.dates, p.amounts.tolist()))
+            for i, p in enumerate(patterns)
+        ]
+
+    stages["analyze_scalar"] = _time_stage(analyze_scalar, repeat, len(patterns))
+    analyzed = stages["analyze_scalar"]["_result"]
+
+    def analyze_vectorized():
+        return analyzer.analyze_many(*patterns.pack())
+
+    stages["analyze_vectorized"] = _time_stage(analyze_vectorized, repeat, len(patterns))
+
+    def pattern_stats():
+        return analyzer.pattern_stats(*patterns.pack())
+
+    stages["pattern_stats"] = _time_stage(pattern_stats, repeat, len(patterns))
+    stats = stages["pattern_stats"]["_result"]
+
+    def select_cached():
+        # What a request with new thresholds costs once the statistics table is cached
+        return [(patterns.info(i), analysis) for i, analysis in stats.actionable(min_requirements)]
+
+    stages["select_cached"] = _time_stage(select_cached, repeat, len(patterns))
+
+    candidates = list(pipeline.iter_candidates(analyzed, confidence_threshold))
+
+    def build_schemas():
+        return [p for p in (pipeline.make_prediction(*item) for item in candidates) if p is not None]
+
+    stages["build_schemas"] = _time_stage(build_schemas, repeat, len(candidates))
+    predictions = stages["build_schemas"]["_result"]
+
+    response = PredictionsResponse(
+        predictions=predictions,
+        generated_at=datetime.now(),
+        total_predictions=len(predictions),
+        filters_applied={"min_requirements": min_requirements, "confidence_threshold": confidence_threshold},
+    )
+
+    def serialize_response():
+        return serialization.dumps(response)
+
+    def serialize_response_stdlib():
+        # Reference: dump in json mode, then json.dumps
+        content = response.model_dump(mode="json", by_alias=True, exclude_none=True)
+        return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode()
+
+    def serialize_response_validated():
+        # Reference: what FastAPI does with a response_model, validate the dumped response again, then as above
+        validated = PredictionsResponse.model_validate(response.model_dump(by_alias=True))
+        content = validated.model_dump(mode="json", by_alias=True, exclude_none=True)
+        return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode()
+
+    for name, fn in (("serialize_response", serialize_response),
+                     ("serialize_response_stdlib", serialize_response_stdlib),
+                     ("serialize_response_validated", serialize_response_validated)):
+        stages[name] = _time_stage(fn, repeat, len(predictions))
+        stages[name]["bytes"] = len(stages[name]["_result"])
+    serialized_identical = all(
+        stages[name]["_result"] == stages["serialize_response"]["_result"]
+        for name in ("serialize_response_stdlib", "serialize_response_validated")
+    )
+
+    # Schemas are built the same way on both paths; the fast path only skips the second validation and json.dumps
+    build_s = stages["build_schemas"]["median_s"]
+    response_speedup = (
+        (build_s + stages["serialize_response_validated"]["median_s"])
+        / (build_s + stages["serialize_response"]["median_s"])
+    )
+
+    for stage in stages.values():
+        del stage["_result"]
+
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "created_at": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "rows": len(history),
+            "patterns": len(patterns),
+            "predictions": len(predictions),
+            "seed": seed,
+            "repeat": repeat,
+            "min_requirements": min_requirements,
+            "confidence_threshold": confidence_threshold,
+            "generate_s": round(generate_s, 3),
+            "serialized_identical": serialized_identical,
+            "response_speedup": round(response_speedup, 2),
+        },
+        "stages": stages,
+    }
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any]) -> Dict[str, float]:
+    """median_s ratio (current / baseline) per stage present in both reports."""
+    ratios = {}
+    for name, stage in report["stages"].items():
+        before = baseline.get("stages", {}).get(name)
+        if before and before["median_s"]:
+            ratios[name] = round(stage["median_s"] / before["median_s"], 3)
+    return ratios
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200_000, help="Synthetic sales rows to generate")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per stage (median is reported)")
+    parser.add_argument("--min-requirements", type=int, default=3)
+    parser.add_argument("--confidence-threshold", type=float, default=0.6)
+    parser.add_argument("--output", help="Report path (default: benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", help="Baseline report to compare against")
+    parser.add_argument("--max-ratio", type=float, default=None,
+                        help="Exit with status 1 if any stage is slower than baseline by more than this ratio")
+    args = parser.parse_args(argv)
+
+    report = run(args.rows, args.seed, args.repeat, args.min_requirements, args.confidence_threshold)
+
+    exit_code = 0
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        report["baseline"] = {"path": args.compare, "commit": baseline.get("meta", {}).get("commit")}
+        report["ratios"] = compare(report, baseline)
+        if args.max_ratio is not None and any(r > args.max_ratio for r in report["ratios"].values()):
+            exit_code = 1
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{report['meta']['commit'] or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    meta = report["meta"]
+    print(f"{meta['rows']} rows, {meta['patterns']} patterns, {meta['predictions']} predictions "
+          f"(generated in {meta['generate_s']}s)")
+    if not meta["serialized_identical"]:
+        print("  WARNING: fast and stdlib serialization differ")
+    for name, stage in report["stages"].items():
+        ratio = report.get("ratios", {}).get(name)
+        print(f"  {name:<30} {stage['median_s'] * 1000:>10.1f} ms  {stage['items_per_s']:>14,.0f} items/s"
+              + (f"  x{ratio}" if ratio is not None else ""))
+    print(f"  build + serialize vs response_model + json.dumps: x{meta['response_speedup']} faster")
+    print(f"Report written to {output}")
+
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+import random
+from datetime import date, timedelta
+from typing import Any, Dict, Iterator, List, Optional
+
+# Same cadence model as populate_db.generate_mock_data: every client reorders a fixed
+# basket every 7/14/21/30 days with +-3 days of jitter over the past 12 months.
+ORDER_FREQUENCIES = [7, 14, 21, 30]
+BASE_AMOUNTS = [10, 20, 50, 100, 200, 500, 1000]
+
+
+def generate_sales_rows(
+        rows: int,
+        seed: int = 42,
+        goods: int = 500,
+        agents: int = 150,
+        today: Optional[date] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Yield about `rows` fact rows shaped like PURCHASE_FACT_QUERY results.
+    Clients are generated until the row target is reached, so the output is
+    identical for the same (rows, seed, goods, agents, today).
+    """
+    rnd = random.Random(seed)
+    today = today or date.today()
+    start_date = today - timedelta(days=365)
+
+    goods_ids = list(range(1, goods + 1))
+    base_amounts = {goods_id: rnd.choice(BASE_AMOUNTS) for goods_id in goods_ids}
+
+    produced = 0
+    sales_id = 0
+    client_id = 0
+
+    while produced < rows:
+        client_id += 1
+
+        # Each client orders 3-8 different products regularly
+        client_products = rnd.sample(goods_ids, rnd.randint(3, 8))
+        num_requirements = rnd.randint(8, 20)
+        order_frequency = rnd.choice(ORDER_FREQUENCIES)
+
+        for req_num in range(num_requirements):
+            days_offset = min(req_num * order_frequency + rnd.randint(-3, 3), 365)
+            created_date = start_date + timedelta(days=days_offset)
+            agent_id = rnd.randint(1, agents)
+            sales_id += 1
+
+            num_items = rnd.randint(2, 6)
+            for goods_id in rnd.sample(client_products, min(num_items, len(client_products))):
+                yield {
+                    "sales_id": sales_id,
+                    "client_id": client_id,
+                    "created_date": created_date,
+                    "agent_id": agent_id,
+                    "goods_id": goods_id,
+                    "amount": round(base_amounts[goods_id] * rnd.uniform(0.8, 1.2), 2),
+                }
+                produced += 1
+
+
+def generate_history(rows: int, seed: int = 42, **kwargs) -> List[Dict[str, Any]]:
+    """Rows in PURCHASE_FACT_QUERY order (created_date DESC)."""
+    history = list(generate_sales_rows(rows, seed=seed, **kwargs))
+    history.sort(key=lambda row: row["created_date"], reverse=True)
+    return history
+
+
+def generate_names(history: List[Dict[str, Any]]) -> Dict[str, Dict[int, str]]:
+    """Dimension names for every id in `history`, as rq.resolve_names returns them."""
+    names: Dict[str, Dict[int, str]] = {"client": {}, "agent": {}, "goods": {}}
+    for row in history:
+        names["client"][row["client_id"]] = f"Client {row['client_id']}"
+        names["agent"][row["agent_id"]] = f"Agent {row['agent_id']}"
+        names["goods"][row["goods_id"]] = f"Goods {row['goods_id']}"
+    return names
+
@@ -0,0 +1,160 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+
+
+class ResultCache:
+    """
+    Bounded LRU cache with a TTL. Each entry remembers the data version it was computed
+    for; a lookup with a different version treats the entry as stale.
+    """
+
+    def __init__(self, max_entries: int = 64, ttl_seconds: float = 30.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.invalidated = 0
+        self.bypassed = 0
+
+    def get(self, key: Hashable, version: Any = None) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, stored_at, stored_version = entry
+
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+
+            if stored_version != version:
+                del self._entries[key]
+                self.invalidated += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, version: Any = None):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic(), version)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def record_bypass(self):
+        with self._lock:
+            self.bypassed += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "invalidated": self.invalidated,
+                "bypassed": self.bypassed,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+class LookupCache:
+    """
+    Bounded LRU of key -> value with a per-entry TTL, read and filled in batches.
+    Meant for id -> name style lookups where the caller loads the misses itself.
+    """
+
+    def __init__(self, max_entries: int = 100_000, ttl_seconds: float = 3600.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def get_many(self, keys: Iterable[Hashable]) -> Tuple[Dict[Hashable, Any], List[Hashable]]:
+        """(cached values by key, keys that are missing or expired)."""
+        found: Dict[Hashable, Any] = {}
+        missing: List[Hashable] = []
+        now = time.monotonic()
+
+        with self._lock:
+            entries = self._entries
+            for key in keys:
+                entry = entries.get(key)
+                if entry is None:
+                    missing.append(key)
+                    continue
+
+                value, stored_at = entry
+                if now - stored_at > self.ttl_seconds:
+                    del entries[key]
+                    self.expired += 1
+                    missing.append(key)
+                    continue
+
+                entries.move_to_end(key)
+                found[key] = value
+
+            self.hits += len(found)
+            self.misses += len(missing)
+
+        return found, missing
+
+    def set_many(self, items: Dict[Hashable, Any]):
+        now = time.monotonic()
+
+        with self._lock:
+            entries = self._entries
+            for key, value in items.items():
+                entries[key] = (value, now)
+                entries.move_to_end(key)
+
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+                self.evicted += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "evicted": self.evicted,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
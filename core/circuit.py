@@ -0,0 +1,115 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Tuple, Type
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a remote that has been failing; retry_after is in seconds."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} circuit is open, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Stops calling a remote after failure_threshold consecutive failures. While open,
+    calls fail at once with CircuitOpenError; after reset_seconds one trial call is let
+    through (half-open) and its outcome closes or reopens the circuit.
+
+    Only exceptions of the `failures` types count against the remote; any other
+    outcome (a SQL error, an abandoned stream) leaves the failure count alone.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_seconds: float = 30.0,
+                 failures: Tuple[Type[BaseException], ...] = (Exception,)):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = failures
+
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+        self.opened = 0
+        self.rejected = 0
+        self.failed = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at < self.reset_seconds:
+            return "open"
+        return "half_open"
+
+    def before_call(self) -> bool:
+        """Raises CircuitOpenError if the call must not go out; True for the half-open trial."""
+        with self._lock:
+            state = self._state()
+            if state == "closed":
+                return False
+            if state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+
+            self.rejected += 1
+            retry_after = max(0.0, self.reset_seconds - (time.monotonic() - self._opened_at))
+        raise CircuitOpenError(self.name, retry_after)
+
+    def record_success(self):
+        with self._lock:
+            self._consecutive_failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self, trial: bool = False):
+        with self._lock:
+            self.failed += 1
+            self._consecutive_failures += 1
+            if trial:
+                self._trial_in_flight = False
+            if trial or (self._opened_at is None and self._consecutive_failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                self.opened += 1
+
+    def _end_trial(self, trial: bool):
+        if trial:
+            with self._lock:
+                self._trial_in_flight = False
+
+    @contextmanager
+    def guard(self):
+        """Run the block as one call to the remote."""
+        trial = self.before_call()
+        try:
+            yield
+        except self.failures:
+            self.record_failure(trial)
+            raise
+        except BaseException:
+            # Not the remote's fault (or not known to be): no verdict either way
+            self._end_trial(trial)
+            raise
+        self.record_success()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            state = self._state()
+            return {
+                "state": state,
+                "open": state != "closed",
+                "consecutive_failures": self._consecutive_failures,
+                "failure_threshold": self.failure_threshold,
+                "reset_seconds": self.reset_seconds,
+                "opened": self.opened,
+                "rejected": self.rejected,
+                "failed": self.failed,
+            }
@@ -0,0 +1,97 @@
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def env_bool(name: str, default: bool = False) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+# Group and filter (client, goods) pairs in MySQL instead of in Python. Predictions and agents
+# match the default path; purchase_count then only counts purchases inside the window
+PATTERNS_AGGREGATE_IN_DB = env_bool("PATTERNS_AGGREGATE_IN_DB", False)
+
+# Analysis window used by PurchasePatternAnalyzer
+PATTERN_WINDOW_DAYS = 365
+
+# Keep (client, goods) statistics in memory and only fetch sales past the last seen sales_id
+PATTERN_STORE_ENABLED = env_bool("PATTERN_STORE_ENABLED", False)
+# Full reload interval; catches late-committed or edited rows the sales_id watermark misses
+PATTERN_STORE_FULL_RELOAD_SECONDS = env_int("PATTERN_STORE_FULL_RELOAD_SECONDS", 6 * 60 * 60)
+
+# Result cache for /predictions/predictions, invalidated when MAX(sales_id) moves
+PREDICTION_CACHE_ENABLED = env_bool("PREDICTION_CACHE_ENABLED", True)
+PREDICTION_CACHE_TTL_SECONDS = env_float("PREDICTION_CACHE_TTL_SECONDS", 30.0)
+PREDICTION_CACHE_MAX_ENTRIES = env_int("PREDICTION_CACHE_MAX_ENTRIES", 64)
+# How long a MAX(sales_id) result is reused before asking MySQL again
+SALES_WATERMARK_MAX_AGE_SECONDS = env_float("SALES_WATERMARK_MAX_AGE_SECONDS", 1.0)
+
+# Last good /predictions result per parameters, served marked stale when the database fails
+# (or is slower than PREDICTION_STALE_AFTER_SECONDS) while a background refresh retries; 0 disables
+PREDICTION_STALE_MAX_AGE_SECONDS = env_float("PREDICTION_STALE_MAX_AGE_SECONDS", 24 * 60 * 60.0)
+PREDICTION_STALE_AFTER_SECONDS = env_float("PREDICTION_STALE_AFTER_SECONDS", 10.0)
+PREDICTION_REVALIDATE_RETRY_SECONDS = env_float("PREDICTION_REVALIDATE_RETRY_SECONDS", 15.0)
+
+# Threshold-independent pattern statistics, kept per MAX(sales_id) and reused for every
+# min_requirements / confidence_threshold; the TTL bounds staleness from edited rows
+ANALYSIS_CACHE_ENABLED = env_bool("ANALYSIS_CACHE_ENABLED", True)
+ANALYSIS_CACHE_TTL_SECONDS = env_float("ANALYSIS_CACHE_TTL_SECONDS", 600.0)
+
+# Process pool for pattern analysis (0 keeps everything in the request thread)
+ANALYSIS_WORKERS = env_int("ANALYSIS_WORKERS", 0)
+# Below this many patterns the pickling overhead outweighs the gain, stay serial
+ANALYSIS_PARALLEL_MIN_PATTERNS = env_int("ANALYSIS_PARALLEL_MIN_PATTERNS", 20000)
+
+# Local memory-mapped copy of the sales facts; predictions are served from it when enabled
+SNAPSHOT_ENABLED = env_bool("SNAPSHOT_ENABLED", False)
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshot")
+SNAPSHOT_REFRESH_SECONDS = env_int("SNAPSHOT_REFRESH_SECONDS", 300)
+# Full rebuild interval; catches backdated or edited rows the sales_id watermark misses
+SNAPSHOT_FULL_REBUILD_SECONDS = env_int("SNAPSHOT_FULL_REBUILD_SECONDS", 6 * 60 * 60)
+
+# Background precomputation of the full prediction set for a grid of min_requirements values
+PRECOMPUTE_ENABLED = env_bool("PRECOMPUTE_ENABLED", False)
+PRECOMPUTE_INTERVAL_SECONDS = env_int("PRECOMPUTE_INTERVAL_SECONDS", 300)
+PRECOMPUTE_MIN_REQUIREMENTS = [
+    int(v) for v in os.getenv("PRECOMPUTE_MIN_REQUIREMENTS", "2,3,4,5").split(",") if v.strip()
+]
+
+# Name caches for the dimension tables; the pattern fact query only carries ids
+CLIENT_CACHE_TTL_SECONDS = env_float("CLIENT_CACHE_TTL_SECONDS", 15 * 60.0)
+CLIENT_CACHE_MAX_ENTRIES = env_int("CLIENT_CACHE_MAX_ENTRIES", 200_000)
+AGENT_CACHE_TTL_SECONDS = env_float("AGENT_CACHE_TTL_SECONDS", 60 * 60.0)
+AGENT_CACHE_MAX_ENTRIES = env_int("AGENT_CACHE_MAX_ENTRIES", 10_000)
+GOODS_CACHE_TTL_SECONDS = env_float("GOODS_CACHE_TTL_SECONDS", 60 * 60.0)
+GOODS_CACHE_MAX_ENTRIES = env_int("GOODS_CACHE_MAX_ENTRIES", 50_000)
+
+# EXPLAIN the service queries in the background at startup and log plan regressions / missing indexes
+QUERY_PLAN_CHECK_ON_STARTUP = env_bool("QUERY_PLAN_CHECK_ON_STARTUP", True)
+# Last seen plan per query; a plan that differs from it on the next check is logged as changed
+QUERY_PLAN_HISTORY_FILE = os.getenv("QUERY_PLAN_HISTORY_FILE", "query_plans.json")
+
+# Server-Sent Events of prediction deltas (GET /predictions/stream): recompute interval while
+# anyone is subscribed, keep-alive comment interval, and how far a subscriber may fall behind
+# before it is resent the whole set
+DELTA_INTERVAL_SECONDS = env_float("DELTA_INTERVAL_SECONDS", 60.0)
+DELTA_HEARTBEAT_SECONDS = env_float("DELTA_HEARTBEAT_SECONDS", 15.0)
+DELTA_MAX_PENDING_BATCHES = env_int("DELTA_MAX_PENDING_BATCHES", 100)
+
+# Startup warm-up before /ready reports ready: open the tunnel and pool connections, load the
+# dimension names and run one prediction pass. Without it everything connects on first use
+WARMUP_ENABLED = env_bool("WARMUP_ENABLED", True)
+WARMUP_CONNECTIONS = env_int("WARMUP_CONNECTIONS", 2)
+WARMUP_TIMEOUT_SECONDS = env_float("WARMUP_TIMEOUT_SECONDS", 300.0)
@@ -1,15 +1,147 @@
 import os
+import time
+import socket
+import asyncio
+import logging
+import threading
 from dotenv import load_dotenv
+import sshtunnel
 from sshtunnel import SSHTunnelForwarder
 import pymysql
-from typing import List, Dict, Any, Optional
-from contextlib import contextmanager
+import aiomysql
+from typing import List, Dict, Any, AsyncIterator, Iterator, Optional, Sequence
+from contextlib import asynccontextmanager, contextmanager
+
+from core import metrics
+from core.circuit import CircuitBreaker
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# Errors that mean the tunnel or MySQL is unreachable or too slow; they trip the circuit breaker.
+# PoolTimeout is not one of them: an exhausted pool is local load, not a sign the remote is down.
+REMOTE_ERRORS = (
+    pymysql.err.OperationalError,
+    pymysql.err.InterfaceError,
+    sshtunnel.BaseSSHTunnelForwarderError,
+    socket.timeout,
+    asyncio.TimeoutError,
+)
+
+
+class _CountingConnection(pymysql.connections.Connection):
+    """pymysql connection that counts the bytes it reads from the server."""
+
+    bytes_received = 0
+
+    def _read_bytes(self, num_bytes):
+        data = super()._read_bytes(num_bytes)
+        self.bytes_received += len(data)
+        return data
+
+
+def _count_received_bytes(conn):
+    """Same counter for an aiomysql connection (its pool has no hook for a Connection subclass)."""
+    if hasattr(conn, "bytes_received"):
+        return
+
+    conn.bytes_received = 0
+    read_bytes = conn._read_bytes
+
+    async def _read_bytes(num_bytes):
+        data = await read_bytes(num_bytes)
+        conn.bytes_received += len(data)
+        return data
+
+    conn._read_bytes = _read_bytes
+
+
+@contextmanager
+def _tracked_query(conn):
+    """Time a statement as the db_query stage and report the bytes it read."""
+    bytes_before = conn.bytes_received
+    try:
+        with metrics.stage("db_query"):
+            yield
+    finally:
+        metrics.count("db_bytes", conn.bytes_received - bytes_before)
+
+
+class SSHTunnel:
+    """
+    One long-lived SSH tunnel to the MySQL host, restarted on demand when it drops.
+    generation changes on every restart so pools can drop connections to the old port.
+    """
+
+    def __init__(self, ssh_host, ssh_port, ssh_user, ssh_password, remote_host, remote_port,
+                 timeout: Optional[float] = None):
+        self.ssh_host = ssh_host
+        self.ssh_port = ssh_port
+        self.ssh_user = ssh_user
+        self.ssh_password = ssh_password
+        self.remote_host = remote_host
+        self.remote_port = remote_port
+        self.timeout = timeout
+
+        self._forwarder: Optional[SSHTunnelForwarder] = None
+        self._lock = threading.Lock()
+        self.generation = 0
+
+    @property
+    def is_active(self) -> bool:
+        return self._forwarder is not None and self._forwarder.is_active
+
+    def ensure(self) -> int:
+        """Start the tunnel if needed and return its local port."""
+        forwarder = self._forwarder
+        if forwarder is not None and forwarder.is_active:
+            return forwarder.local_bind_port
+
+        with self._lock:
+            if self.is_active:
+                return self._forwarder.local_bind_port
+
+            if self._forwarder is not None:
+                logger.warning("SSH tunnel is down, reconnecting")
+                self._stop()
+
+            # sshtunnel only takes its connect / channel timeouts from module globals
+            sshtunnel.SSH_TIMEOUT = self.timeout
+            sshtunnel.TUNNEL_TIMEOUT = self.timeout
+            forwarder = SSHTunnelForwarder(
+                (self.ssh_host, self.ssh_port),
+                ssh_username=self.ssh_user,
+                ssh_password=self.ssh_password,
+                remote_bind_address=(self.remote_host, self.remote_port),
+                set_keepalive=30.0,
+            )
+            forwarder.start()
+
+            self._forwarder = forwarder
+            self.generation += 1
+            return forwarder.local_bind_port
+
+    def _stop(self):
+        if self._forwarder:
+            try:
+                self._forwarder.stop()
+            except Exception:
+                pass
+        self._forwarder = None
 
-class RemoteMySQL:
-    def __init__(self):
+    def stop(self):
+        with self._lock:
+            self._stop()
+
+
+class _RemoteMySQLSettings:
+    def __init__(self, tunnel: Optional[SSHTunnel] = None, breaker: Optional[CircuitBreaker] = None):
         self.ssh_host = os.getenv("SSH_HOST")
         self.ssh_port = int(os.getenv("SSH_PORT"))
         self.ssh_user = os.getenv("SSH_USER")
@@ -21,60 +153,464 @@ class RemoteMySQL:
         self.sql_password = os.getenv("SQL_PASSWORD")
         self.sql_db = os.getenv("SQL_DB")
 
+        self.pool_size = int(os.getenv("SQL_POOL_SIZE", "5"))
+        self.pool_recycle = int(os.getenv("SQL_POOL_RECYCLE", "300"))  # max idle seconds
+        self.pool_timeout = float(os.getenv("SQL_POOL_TIMEOUT", "30"))
+
+        # Seconds; a slow or dead remote fails the call instead of hanging it
+        self.connect_timeout = float(os.getenv("SQL_CONNECT_TIMEOUT", "10"))
+        self.read_timeout = float(os.getenv("SQL_READ_TIMEOUT", "120"))
+        self.write_timeout = float(os.getenv("SQL_WRITE_TIMEOUT", "60"))
+
+        self.tunnel = tunnel or SSHTunnel(
+            self.ssh_host, self.ssh_port, self.ssh_user, self.ssh_password,
+            self.sql_host, self.sql_port, timeout=self.connect_timeout,
+        )
+        # Share it together with the tunnel: both clients fail the same way
+        self.breaker = breaker or CircuitBreaker(
+            "mysql",
+            failure_threshold=int(os.getenv("SQL_CIRCUIT_FAILURES", "5")),
+            reset_seconds=float(os.getenv("SQL_CIRCUIT_RESET_SECONDS", "30")),
+            failures=REMOTE_ERRORS,
+        )
+
+
+class RemoteMySQL(_RemoteMySQLSettings):
+    """
+    MySQL behind an SSH tunnel.
+    The tunnel is started once and kept alive; connections are pooled on top of it.
+    """
+
+    def __init__(self, tunnel: Optional[SSHTunnel] = None, breaker: Optional[CircuitBreaker] = None):
+        super().__init__(tunnel, breaker)
+
+        self._pool_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.pool_size)
+        self._idle: List[tuple] = []  # (conn, returned_at), most recent last
+        self._in_use = 0
+
+        self._stats = {
+            "checkouts": 0,
+            "connections_created": 0,
+            "connections_recycled": 0,
+            "connections_discarded": 0,
+            "pool_waits": 0,
+        }
+
+    # ---------- pool ----------
+
+    def _count(self, name: str):
+        # Checkouts run on many threads at once; += on a dict entry is not atomic
+        with self._pool_lock:
+            self._stats[name] += 1
+
+    def _connect(self):
+        port = self.tunnel.ensure()
+
+        conn = _CountingConnection(
+            host="127.0.0.1",
+            port=port,
+            user=self.sql_user,
+            password=self.sql_password,
+            database=self.sql_db,
+            cursorclass=pymysql.cursors.DictCursor,
+            charset="utf8mb4",
+            connect_timeout=self.connect_timeout,
+            read_timeout=self.read_timeout,
+            write_timeout=self.write_timeout,
+            # Pooled connections must not keep an old REPEATABLE READ snapshot around
+            autocommit=True,
+            # Server-side aggregation packs whole purchase histories into GROUP_CONCAT
+            init_command="SET SESSION group_concat_max_len = 16777216",
+        )
+        conn.tunnel_generation = self.tunnel.generation
+        self._count("connections_created")
+        return conn
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _close_idle(self):
+        with self._pool_lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    def _checkout(self):
+        if not self._slots.acquire(blocking=False):
+            self._count("pool_waits")
+            if not self._slots.acquire(timeout=self.pool_timeout):
+                raise PoolTimeout(f"No free MySQL connection after {self.pool_timeout}s")
+
+        try:
+            self.tunnel.ensure()
+
+            conn = None
+            while conn is None:
+                with self._pool_lock:
+                    conn, returned_at = self._idle.pop() if self._idle else (None, None)
+
+                if conn is None:
+                    conn = self._connect()
+                    break
+
+                if conn.tunnel_generation != self.tunnel.generation:
+                    # Bound to the local port of a tunnel that has since been restarted
+                    self._count("connections_discarded")
+                    self._close_quietly(conn)
+                    conn = None
+                    continue
+
+                if time.monotonic() - returned_at > self.pool_recycle:
+                    self._count("connections_recycled")
+                    self._close_quietly(conn)
+                    conn = None
+                    continue
+
+                try:
+                    conn.ping(reconnect=False)
+                except Exception:
+                    self._count("connections_discarded")
+                    self._close_quietly(conn)
+                    conn = None
+
+            with self._pool_lock:
+                self._in_use += 1
+                self._stats["checkouts"] += 1
+            return conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _release(self, conn, broken: bool = False):
+        with self._pool_lock:
+            self._in_use -= 1
+            if broken:
+                self._stats["connections_discarded"] += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+
+        if broken:
+            self._close_quietly(conn)
+
+        self._slots.release()
+
     @contextmanager
     def _get_connection(self):
-        tunnel = None
-        conn = None
+        with self.breaker.guard():
+            with metrics.stage("db_connect"):
+                conn = self._checkout()
+            broken = False
 
-        try:
-            tunnel = SSHTunnelForwarder(
-                (self.ssh_host, self.ssh_port),
-                ssh_username=self.ssh_user,
-                ssh_password=self.ssh_password,
-                remote_bind_address=(self.sql_host, self.sql_port),
-            )
-            tunnel.start()
+            try:
+                yield conn
+            except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+                broken = True
+                raise
+            finally:
+                self._release(conn, broken=broken)
 
-            conn = pymysql.connect(
-                host="127.0.0.1",
-                port=tunnel.local_bind_port,
-                user=self.sql_user,
-                password=self.sql_password,
-                database=self.sql_db,
-                cursorclass=pymysql.cursors.DictCursor,
-                charset="utf8mb4",
-            )
+    # ---------- lifecycle ----------
 
-            yield conn
+    def start(self, warm_connections: int = 1):
+        """Open the tunnel and pre-open a few pooled connections."""
+        self.tunnel.ensure()
 
+        conns = []
+        try:
+            for _ in range(min(warm_connections, self.pool_size)):
+                conns.append(self._checkout())
         finally:
-            if conn:
-                try:
-                    conn.close()
-                except:
-                    pass
+            for conn in conns:
+                self._release(conn)
 
-            if tunnel:
-                try:
-                    tunnel.stop()
-                except:
-                    pass
+    def close(self, stop_tunnel: bool = True):
+        self._close_idle()
+        if stop_tunnel:
+            self.tunnel.stop()
+
+    def is_healthy(self) -> bool:
+        try:
+            self.query_one("SELECT 1 AS ok")
+            return True
+        except Exception:
+            return False
+
+    def pool_stats(self) -> Dict[str, Any]:
+        with self._pool_lock:
+            idle = len(self._idle)
+            in_use = self._in_use
+
+        return {
+            "max_size": self.pool_size,
+            "idle": idle,
+            "in_use": in_use,
+            "tunnel_active": self.tunnel.is_active,
+            "tunnel_starts": self.tunnel.generation,
+            **self._stats,
+        }
+
+    # ---------- queries ----------
 
     def query(self, sql: str, params: Optional[tuple] = None) -> List[Dict[str, Any]]:
         with self._get_connection() as conn:
-            with conn.cursor() as cursor:
+            with conn.cursor() as cursor, _tracked_query(conn):
                 cursor.execute(sql, params or ())
-                return cursor.fetchall()
+                rows = cursor.fetchall()
+            metrics.count("db_rows", len(rows))
+            return rows
 
     def query_one(self, sql: str, params: Optional[tuple] = None) -> Optional[Dict[str, Any]]:
         with self._get_connection() as conn:
-            with conn.cursor() as cursor:
+            with conn.cursor() as cursor, _tracked_query(conn):
                 cursor.execute(sql, params or ())
                 return cursor.fetchone()
 
     def execute(self, sql: str, params: Optional[tuple] = None) -> int:
         with self._get_connection() as conn:
-            with conn.cursor() as cursor:
+            with conn.cursor() as cursor, _tracked_query(conn):
                 result = cursor.execute(sql, params or ())
                 conn.commit()
                 return result
+
+    def executemany(self, sql: str, rows: Sequence[tuple]) -> int:
+        """
+        Run sql once per row. For "INSERT ... VALUES (...)" pymysql sends the rows
+        as multi-row INSERT statements (up to ~1 MB each) instead of one per row.
+        """
+        with self._get_connection() as conn:
+            with conn.cursor() as cursor, _tracked_query(conn):
+                result = cursor.executemany(sql, rows)
+                conn.commit()
+                return result
+
+    def stream_batches(
+            self,
+            sql: str,
+            params: Optional[tuple] = None,
+            batch_size: int = 5000,
+    ) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Run sql on an unbuffered server-side cursor and yield rows in lists of
+        at most batch_size, so the full result set is never held in memory.
+        The pooled connection stays checked out until the generator finishes.
+        """
+        with self.breaker.guard():
+            with metrics.stage("db_connect"):
+                conn = self._checkout()
+            cursor = None
+            exhausted = False
+
+            # Only time spent waiting on the server counts, not the consumer between batches
+            query_seconds = 0.0
+            rows_fetched = 0
+            bytes_before = conn.bytes_received
+
+            try:
+                started = time.perf_counter()
+                cursor = conn.cursor(pymysql.cursors.SSDictCursor)
+                cursor.execute(sql, params or ())
+                query_seconds += time.perf_counter() - started
+
+                while True:
+                    started = time.perf_counter()
+                    rows = cursor.fetchmany(batch_size)
+                    query_seconds += time.perf_counter() - started
+                    if not rows:
+                        break
+                    rows_fetched += len(rows)
+                    yield rows
+
+                cursor.close()
+                exhausted = True
+            finally:
+                metrics.record_stage("db_query", query_seconds)
+                metrics.count("db_rows", rows_fetched)
+                metrics.count("db_bytes", conn.bytes_received - bytes_before)
+                # Closing an abandoned SSCursor would read the rest of the result off the wire,
+                # so drop the connection instead of returning it half-read
+                self._release(conn, broken=not exhausted)
+
+    def stream(
+            self,
+            sql: str,
+            params: Optional[tuple] = None,
+            batch_size: int = 5000,
+    ) -> Iterator[Dict[str, Any]]:
+        for rows in self.stream_batches(sql, params, batch_size):
+            yield from rows
+
+
+class AsyncRemoteMySQL(_RemoteMySQLSettings):
+    """
+    asyncio counterpart of RemoteMySQL: an aiomysql pool over the same kind of SSH tunnel.
+    Pass the tunnel of a RemoteMySQL to share one SSH connection between both.
+    """
+
+    def __init__(self, tunnel: Optional[SSHTunnel] = None, breaker: Optional[CircuitBreaker] = None):
+        super().__init__(tunnel, breaker)
+
+        self._pool: Optional[aiomysql.Pool] = None
+        self._pool_generation = None
+        self._pool_lock = asyncio.Lock()
+        self._pool_starts = 0
+
+    async def _get_pool(self) -> aiomysql.Pool:
+        if self._pool is not None and self.tunnel.is_active \
+                and self._pool_generation == self.tunnel.generation:
+            return self._pool
+
+        async with self._pool_lock:
+            # Starting the tunnel is blocking (paramiko), keep it off the event loop
+            port = await asyncio.to_thread(self.tunnel.ensure)
+
+            if self._pool is not None and self._pool_generation == self.tunnel.generation:
+                return self._pool
+
+            if self._pool is not None:
+                await self._close_pool()
+
+            self._pool = await aiomysql.create_pool(
+                host="127.0.0.1",
+                port=port,
+                user=self.sql_user,
+                password=self.sql_password,
+                db=self.sql_db,
+                minsize=1,
+                maxsize=self.pool_size,
+                pool_recycle=self.pool_recycle,
+                cursorclass=aiomysql.DictCursor,
+                charset="utf8mb4",
+                autocommit=True,
+                init_command="SET SESSION group_concat_max_len = 16777216",
+                connect_timeout=self.connect_timeout,
+            )
+            self._pool_generation = self.tunnel.generation
+            self._pool_starts += 1
+            return self._pool
+
+    async def _close_pool(self):
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            await pool.wait_closed()
+
+    async def _acquire(self):
+        with metrics.stage("db_connect"):
+            pool = await self._get_pool()
+            try:
+                conn = await asyncio.wait_for(pool.acquire(), self.pool_timeout)
+            except asyncio.TimeoutError:
+                raise PoolTimeout(f"No free MySQL connection after {self.pool_timeout}s")
+        _count_received_bytes(conn)
+        return pool, conn
+
+    async def _timed(self, awaitable):
+        """aiomysql has no read timeout, so every round trip is bounded here."""
+        return await asyncio.wait_for(awaitable, self.read_timeout)
+
+    @asynccontextmanager
+    async def _get_connection(self):
+        with self.breaker.guard():
+            pool, conn = await self._acquire()
+            try:
+                yield conn
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                # Interrupted mid round trip, the connection's protocol state is unknown
+                conn.close()
+                raise
+            finally:
+                pool.release(conn)
+
+    # ---------- lifecycle ----------
+
+    async def start(self):
+        await self._get_pool()
+
+    async def close(self, stop_tunnel: bool = True):
+        async with self._pool_lock:
+            await self._close_pool()
+        if stop_tunnel:
+            await asyncio.to_thread(self.tunnel.stop)
+
+    def pool_stats(self) -> Dict[str, Any]:
+        pool = self._pool
+        return {
+            "max_size": self.pool_size,
+            "size": pool.size if pool else 0,
+            "idle": pool.freesize if pool else 0,
+            "in_use": (pool.size - pool.freesize) if pool else 0,
+            "tunnel_active": self.tunnel.is_active,
+            "pool_starts": self._pool_starts,
+        }
+
+    # ---------- queries ----------
+
+    async def query(self, sql: str, params: Optional[tuple] = None) -> List[Dict[str, Any]]:
+        async with self._get_connection() as conn:
+            async with conn.cursor() as cursor:
+                with _tracked_query(conn):
+                    await self._timed(cursor.execute(sql, params or ()))
+                    rows = await self._timed(cursor.fetchall())
+            metrics.count("db_rows", len(rows))
+            return rows
+
+    async def query_one(self, sql: str, params: Optional[tuple] = None) -> Optional[Dict[str, Any]]:
+        async with self._get_connection() as conn:
+            async with conn.cursor() as cursor:
+                with _tracked_query(conn):
+                    await self._timed(cursor.execute(sql, params or ()))
+                    return await self._timed(cursor.fetchone())
+
+    async def execute(self, sql: str, params: Optional[tuple] = None) -> int:
+        async with self._get_connection() as conn:
+            async with conn.cursor() as cursor:
+                with _tracked_query(conn):
+                    result = await self._timed(cursor.execute(sql, params or ()))
+                    await self._timed(conn.commit())
+                    return result
+
+    async def stream_batches(
+            self,
+            sql: str,
+            params: Optional[tuple] = None,
+            batch_size: int = 5000,
+    ) -> AsyncIterator[List[Dict[str, Any]]]:
+        """Async version of RemoteMySQL.stream_batches (unbuffered SSDictCursor)."""
+        with self.breaker.guard():
+            pool, conn = await self._acquire()
+            exhausted = False
+
+            query_seconds = 0.0
+            rows_fetched = 0
+            bytes_before = conn.bytes_received
+
+            try:
+                started = time.perf_counter()
+                cursor = await conn.cursor(aiomysql.SSDictCursor)
+                await self._timed(cursor.execute(sql, params or ()))
+                query_seconds += time.perf_counter() - started
+
+                while True:
+                    started = time.perf_counter()
+                    rows = await self._timed(cursor.fetchmany(batch_size))
+                    query_seconds += time.perf_counter() - started
+                    if not rows:
+                        break
+                    rows_fetched += len(rows)
+                    yield rows
+
+                await cursor.close()
+                exhausted = True
+            finally:
+                metrics.record_stage("db_query", query_seconds)
+                metrics.count("db_rows", rows_fetched)
+                metrics.count("db_bytes", conn.bytes_received - bytes_before)
+                if not exhausted:
+                    # Don't hand a half-read (or timed out) unbuffered result back to the pool
+                    conn.close()
+                pool.release(conn)
@@ -0,0 +1,26 @@
+from typing import Any
+
+import orjson
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+
+def dumps(content: Any) -> bytes:
+    """
+    JSON bytes for a response body. A model is dumped the way FastAPI does for
+    response_model_exclude_none=True (aliases, None fields dropped), but without
+    validating it again and encoded with orjson instead of json.dumps. The bytes are
+    the same as Starlette's JSONResponse produces (compact separators, UTF-8 kept
+    as is) for the values predictions hold; orjson only differs in exponent notation
+    (1e16 vs 1e+16) and writes NaN as null instead of raising.
+    """
+    if isinstance(content, BaseModel):
+        content = content.model_dump(by_alias=True, exclude_none=True)
+    return orjson.dumps(content)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse that takes a model as content and renders it with dumps."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,98 @@
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, TypeVar
+
+from core import metrics
+
+T = TypeVar("T")
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller runs the
+    computation, callers arriving while it is in flight wait for it and get the
+    same result (or exception). Nothing is kept once it finishes, so this only
+    dedupes work that overlaps in time; ResultCache is what reuses finished results.
+
+    do() is for threads, do_async() for coroutines on one event loop; the two keep
+    separate in-flight tables. Shared results must be treated as read-only.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+        self._tasks: Dict[Hashable, asyncio.Future] = {}
+        self._lock = threading.Lock()
+
+        self.executed = 0
+        self.coalesced = 0
+
+    def _record(self, coalesced: bool):
+        with self._lock:
+            if coalesced:
+                self.coalesced += 1
+            else:
+                self.executed += 1
+        if coalesced:
+            metrics.count("coalesced", 1)
+
+    def do(self, key: Hashable, fn: Callable[[], T]) -> T:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        self._record(coalesced=not leader)
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def do_async(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        task = self._tasks.get(key)
+        leader = task is None
+        if leader:
+            task = self._tasks[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda t: self._finished(key, t))
+        self._record(coalesced=not leader)
+
+        # A caller going away (client disconnect) must not cancel the others' computation
+        return await asyncio.shield(task)
+
+    def _finished(self, key: Hashable, task: asyncio.Future):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            # Retrieved here so a failure nobody awaits anymore is not logged as unhandled
+            task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            calls = self.executed + self.coalesced
+            return {
+                "in_flight": len(self._calls) + len(self._tasks),
+                "executed": self.executed,
+                "coalesced": self.coalesced,
+                "coalesced_ratio": round(self.coalesced / calls, 3) if calls else 0.0,
+            }
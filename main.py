@@ -1,18 +1,88 @@
+import asyncio
+import math
+import time
 import uvicorn
 from contextlib import asynccontextmanager
 import logging
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 # from core.base import init_db
 from api import  predict
+import requests.rq as rq
+from core import metrics
+from core.circuit import CircuitOpenError
+from core.remote_db import REMOTE_ERRORS, PoolTimeout
+from requests import deltas, pipeline, query_plans
+from requests.parallel import analysis_pool
+from requests.snapshot import sales_snapshot
+from requests.precompute import prediction_scheduler
+from requests.warmup import warmup
+from core.config import (
+    PRECOMPUTE_ENABLED, QUERY_PLAN_CHECK_ON_STARTUP, SNAPSHOT_ENABLED, SNAPSHOT_REFRESH_SECONDS, WARMUP_ENABLED,
+)
+
+
+async def refresh_snapshot_forever():
+    while True:
+        try:
+            stats = await asyncio.to_thread(sales_snapshot.refresh)
+            logging.info(f"Sales snapshot refreshed: {stats}")
+        except Exception as e:
+            logging.error(f"Sales snapshot refresh failed: {e}")
+        await asyncio.sleep(SNAPSHOT_REFRESH_SECONDS)
+
+
+async def check_query_plans():
+    try:
+        report = await asyncio.to_thread(query_plans.check, rq.get_db())
+        query_plans.log_report(report)
+    except Exception as e:
+        logging.error(f"Query plan check failed: {e}")
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logging.info("Starting app...")
     # await init_db()
 
+    # Reads the database settings; nothing connects until the warm-up or the first request
+    rq.init_clients()
+    analysis_pool.start()
+
+    plan_check_task = None
+    if QUERY_PLAN_CHECK_ON_STARTUP:
+        # Only logs; startup does not wait for it
+        plan_check_task = asyncio.create_task(check_query_plans())
+
+    snapshot_task = None
+    if SNAPSHOT_ENABLED:
+        # Serve from what is already on disk right away; the loop catches up in the background
+        await asyncio.to_thread(sales_snapshot.load)
+        snapshot_task = asyncio.create_task(refresh_snapshot_forever())
+
+    if PRECOMPUTE_ENABLED:
+        prediction_scheduler.start()
+
+    # Startup does not wait for it; GET /ready does
+    if WARMUP_ENABLED:
+        warmup.start()
+    else:
+        warmup.skip()
+
     yield
 
     logging.info("Shutting down...")
+    await warmup.stop()
+    await prediction_scheduler.stop()
+    predict.cancel_revalidations()
+    await deltas.stop_delta_feeds()
+    if snapshot_task:
+        snapshot_task.cancel()
+    if plan_check_task:
+        plan_check_task.cancel()
+    analysis_pool.shutdown()
+    await rq.get_async_db().close(stop_tunnel=False)
+    await asyncio.to_thread(rq.get_db().close)
 
 app = FastAPI(
     title="Predict Future Clients",
@@ -24,5 +94,86 @@ app = FastAPI(
 
 app.include_router(predict.router)
 
+metrics.registry.register_collector("db_pool", lambda: rq.get_db().pool_stats())
+metrics.registry.register_collector("async_db_pool", lambda: rq.get_async_db().pool_stats())
+metrics.registry.register_collector("db_circuit", lambda: rq.get_db().breaker.stats())
+metrics.registry.register_collector("warmup", warmup.stats)
+metrics.registry.register_collector("prediction_cache", predict.prediction_cache.stats)
+metrics.registry.register_collector("stale_cache", predict.stale_cache.stats)
+metrics.registry.register_collector("analysis_pool", analysis_pool.stats)
+metrics.registry.register_collector("analysis_cache", pipeline.analysis_cache.stats)
+metrics.registry.register_collector("singleflight", pipeline.flights.stats)
+metrics.registry.register_collector("sales_snapshot", sales_snapshot.stats)
+metrics.registry.register_collector("precompute", prediction_scheduler.stats)
+for _kind, _cache in rq.dimension_caches.items():
+    metrics.registry.register_collector(f"{_kind}_names", _cache.stats)
+
+
+@app.exception_handler(CircuitOpenError)
+async def database_unavailable(request: Request, exc: CircuitOpenError):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(math.ceil(exc.retry_after))},
+    )
+
+
+async def database_error(request: Request, exc: Exception):
+    # Same answer /predictions gives when it has no stale result to fall back on
+    logging.warning(f"{request.method} {request.url.path} failed, database unavailable: {exc!r}")
+    return JSONResponse(status_code=503, content={"detail": "Database unavailable"})
+
+
+for _error in (PoolTimeout, *REMOTE_ERRORS):
+    app.add_exception_handler(_error, database_error)
+
+
+@app.middleware("http")
+async def server_timing(request: Request, call_next):
+    timings = metrics.begin_request()
+    started = time.perf_counter()
+
+    response = await call_next(request)
+
+    # Time to response headers; a streamed body keeps running after this
+    elapsed = time.perf_counter() - started
+    route = request.scope.get("route")
+    metrics.request_seconds.observe(
+        elapsed, request.method, route.path if route else "unmatched", str(response.status_code)
+    )
+    response.headers["Server-Timing"] = timings.server_timing(elapsed)
+    return response
+
+
+@app.get("/health", tags=["health"])
+def health():
+    return {
+        "db_pool": rq.get_db().pool_stats(),
+        "async_db_pool": rq.get_async_db().pool_stats(),
+        "db_circuit": rq.get_db().breaker.stats(),
+        "prediction_cache": predict.prediction_cache.stats(),
+        "stale_cache": predict.stale_cache.stats(),
+        "analysis_pool": analysis_pool.stats(),
+        "analysis_cache": pipeline.analysis_cache.stats(),
+        "singleflight": pipeline.flights.stats(),
+        "sales_snapshot": sales_snapshot.stats(),
+        "precompute": prediction_scheduler.stats(),
+        "delta_feeds": deltas.stats(),
+        "dimension_caches": {kind: cache.stats() for kind, cache in rq.dimension_caches.items()},
+        "warmup": warmup.stats(),
+    }
+
+
+@app.get("/ready", tags=["health"])
+def ready():
+    # 503 until the warm-up has finished; a failed step still ends it, reported as warm: false
+    return JSONResponse(warmup.stats(), status_code=200 if warmup.ready else 503)
+
+
+@app.get("/metrics", tags=["health"], response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
     uvicorn.run("backend.main:app", host="0.0.0.0", port=8000, reload=True)
@@ -93,4 +93,17 @@ class PredictionsResponse(BaseModel):
     predictions: List[PredictionSchema]
     generated_at: datetime
     total_predictions: int
-    filters_applied: dict = Field(default_factory=dict)
\ No newline at end of file
+    filters_applied: dict = Field(default_factory=dict)
+    next_cursor: Optional[str] = Field(None, description="Pass as cursor to get the next page")
+    stale: Optional[bool] = Field(None, description="Last good result, served while the database is unavailable")
+    age_seconds: Optional[float] = Field(None, description="Age of a stale result")
+
+
+class ClientGoodsPair(BaseModel):
+    client_id: int
+    goods_id: int
+
+
+class PairPredictionsRequest(BaseModel):
+    pairs: List[ClientGoodsPair] = Field(..., min_length=1, max_length=1000,
+                                         description="(client_id, goods_id) pairs to predict")
@@ -0,0 +1,238 @@
+"""
+Bulk mock data for load testing, written straight into the tables the service
+reads (client, agent, goods, sales, sales_goods) with multi-row INSERTs.
+
+    python populate_bulk.py --clients 200000 --goods 5000 --agents 500 --years 2 --workers 8
+    python populate_bulk.py --clients 200000 --dry-run    # generate only, to measure rows/sec
+
+Clients are split into shards of --shard-clients; every shard is generated and
+inserted by a worker process on its own connection. The ordering model is the
+one populate_db.generate_mock_data uses (a fixed basket per client reordered
+every 7/14/21/30 days with +-3 days of jitter), scaled up. New ids continue after
+the current MAX(id) of each table, so existing data is left alone.
+"""
+import argparse
+import functools
+import multiprocessing
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from benchmarks.synthetic import BASE_AMOUNTS, ORDER_FREQUENCIES
+
+SALES_INSERT = "INSERT INTO sales (sales_id, sales_number, client_id, agent_id, created_date) VALUES (%s, %s, %s, %s, %s)"
+SALES_GOODS_INSERT = "INSERT INTO sales_goods (sales_id, goods_id, amount, cost_sell) VALUES (%s, %s, %s, %s)"
+
+DIMENSIONS = (
+    # (table, id column, name column, name prefix, plan key)
+    ("client", "client_id", "client_name", "Mock Client", "clients"),
+    ("agent", "agent_id", "agent_name", "Mock Agent", "agents"),
+    ("goods", "goods_id", "goods_name", "Mock Goods", "goods"),
+)
+
+# Per worker process: its own connection (None for --dry-run)
+_db = None
+
+
+def _init_worker(dry_run: bool):
+    global _db
+    if not dry_run:
+        from core.remote_db import RemoteMySQL
+
+        _db = RemoteMySQL()
+
+
+@functools.lru_cache(maxsize=4)
+def _goods_profile(seed: int, first_goods_id: int, goods: int) -> Dict[int, Tuple[float, float]]:
+    """goods_id -> (base amount, base price); the same in every worker for a seed."""
+    rnd = random.Random(seed)
+    return {
+        goods_id: (rnd.choice(BASE_AMOUNTS), rnd.uniform(10, 200))
+        for goods_id in range(first_goods_id, first_goods_id + goods)
+    }
+
+
+def _insert(sales: List[tuple], items: List[tuple]):
+    if _db is not None:
+        _db.executemany(SALES_INSERT, sales)
+        _db.executemany(SALES_GOODS_INSERT, items)
+
+
+def generate_shard(shard: int, first_client_id: int, clients: int, plan: Dict[str, Any]) -> Tuple[int, int, int]:
+    """
+    Generate (and unless dry-run, insert) the orders of clients
+    first_client_id .. first_client_id + clients - 1.
+    Returns (shard, sales rows, sales_goods rows).
+    """
+    rnd = random.Random(f"{plan['seed']}:{shard}")
+    profile = _goods_profile(plan["seed"], plan["first_goods_id"], plan["goods"])
+    goods_ids = range(plan["first_goods_id"], plan["first_goods_id"] + plan["goods"])
+    first_agent_id = plan["first_agent_id"]
+    last_agent_id = first_agent_id + plan["agents"] - 1
+
+    years = plan["years"]
+    span_days = 365 * years
+    start = plan["end"] - timedelta(days=span_days)
+    min_orders, max_orders = plan["orders_per_client"]
+
+    # Each shard owns a fixed sales_id range, so workers never coordinate
+    sales_id = plan["first_sales_id"] + shard * plan["shard_clients"] * max_orders * years - 1
+
+    sales: List[tuple] = []
+    items: List[tuple] = []
+    sales_total = items_total = 0
+
+    for client_id in range(first_client_id, first_client_id + clients):
+        # Each client orders 3-8 different products regularly
+        client_products = rnd.sample(goods_ids, min(rnd.randint(3, 8), len(goods_ids)))
+        num_orders = rnd.randint(min_orders, max_orders) * years
+        order_frequency = rnd.choice(ORDER_FREQUENCIES)
+
+        for order in range(num_orders):
+            days_offset = min(order * order_frequency + rnd.randint(-3, 3), span_days)
+            sales_id += 1
+            sales.append((sales_id, f"MOCK-{sales_id}", client_id,
+                          rnd.randint(first_agent_id, last_agent_id), start + timedelta(days=days_offset)))
+
+            # 10% price inflation per year
+            inflation = 1 + days_offset / 365.0 * 0.1
+            for goods_id in rnd.sample(client_products, min(rnd.randint(2, 6), len(client_products))):
+                base_amount, base_price = profile[goods_id]
+                items.append((
+                    sales_id,
+                    goods_id,
+                    round(base_amount * rnd.uniform(0.8, 1.2), 2),
+                    round(base_price * inflation * rnd.uniform(0.95, 1.05), 2),
+                ))
+
+        if len(items) >= plan["batch_size"]:
+            _insert(sales, items)
+            sales_total += len(sales)
+            items_total += len(items)
+            sales, items = [], []
+
+    if sales:
+        _insert(sales, items)
+        sales_total += len(sales)
+        items_total += len(items)
+
+    return shard, sales_total, items_total
+
+
+def _next_id(db, table: str, id_column: str) -> int:
+    row = db.query_one(f"SELECT COALESCE(MAX({id_column}), 0) AS max_id FROM {table}")
+    return int(row["max_id"]) + 1
+
+
+def _insert_dimensions(db, plan: Dict[str, Any]):
+    for table, id_column, name_column, prefix, key in DIMENSIONS:
+        first_id = plan[f"first_{table}_id"]
+        sql = f"INSERT INTO {table} ({id_column}, {name_column}) VALUES (%s, %s)"
+        ids = range(first_id, first_id + plan[key])
+        for start in range(0, len(ids), plan["batch_size"]):
+            db.executemany(sql, [(i, f"{prefix} {i}") for i in ids[start:start + plan["batch_size"]]])
+        print(f"Inserted {plan[key]:,} rows into {table}")
+
+
+def _parse_range(value: str) -> Tuple[int, int]:
+    low, _, high = value.partition("-")
+    low, high = int(low), int(high or low)
+    if not 0 < low <= high:
+        raise argparse.ArgumentTypeError(f"expected N or MIN-MAX with 0 < MIN <= MAX, got {value!r}")
+    return low, high
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=10_000)
+    parser.add_argument("--goods", type=int, default=1_000)
+    parser.add_argument("--agents", type=int, default=200)
+    parser.add_argument("--years", type=int, default=1, help="History length, ending today")
+    parser.add_argument("--orders-per-client", type=_parse_range, default=(8, 20),
+                        help="Orders per client per year, N or MIN-MAX")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Worker processes (0 generates in this process)")
+    parser.add_argument("--shard-clients", type=int, default=1_000, help="Clients per shard")
+    parser.add_argument("--batch-size", type=int, default=20_000, help="sales_goods rows per INSERT batch")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--dry-run", action="store_true", help="Generate rows without connecting to the database")
+    args = parser.parse_args(argv)
+
+    plan: Dict[str, Any] = {
+        "clients": args.clients,
+        "goods": args.goods,
+        "agents": args.agents,
+        "years": args.years,
+        "orders_per_client": args.orders_per_client,
+        "shard_clients": args.shard_clients,
+        "batch_size": args.batch_size,
+        "seed": args.seed,
+        "end": datetime.now().replace(microsecond=0),
+    }
+
+    db = None
+    if args.dry_run:
+        plan.update(first_client_id=1, first_agent_id=1, first_goods_id=1, first_sales_id=1)
+    else:
+        from core.remote_db import RemoteMySQL
+
+        db = RemoteMySQL()
+        for table, id_column, *_ in DIMENSIONS:
+            plan[f"first_{table}_id"] = _next_id(db, table, id_column)
+        plan["first_sales_id"] = _next_id(db, "sales", "sales_id")
+        _insert_dimensions(db, plan)
+
+    shards = [
+        (shard, plan["first_client_id"] + start, min(args.shard_clients, args.clients - start))
+        for shard, start in enumerate(range(0, args.clients, args.shard_clients))
+    ]
+
+    started = time.perf_counter()
+    sales_total = items_total = done = 0
+    last_report = 0.0
+
+    def report(final: bool = False):
+        elapsed = time.perf_counter() - started
+        rate = items_total / elapsed if elapsed else 0.0
+        print(f"{'Done' if final else 'Progress'}: {done}/{len(shards)} shards, {sales_total:,} sales, "
+              f"{items_total:,} sales_goods rows in {elapsed:.1f}s ({rate:,.0f} rows/s)", flush=True)
+
+    def collect(result: Tuple[int, int, int]):
+        nonlocal sales_total, items_total, done, last_report
+        _, sales, items = result
+        sales_total += sales
+        items_total += items
+        done += 1
+        if time.perf_counter() - last_report >= 1.0:
+            last_report = time.perf_counter()
+            report()
+
+    if args.workers <= 0:
+        _init_worker(args.dry_run)
+        for shard in shards:
+            collect(generate_shard(*shard, plan))
+    else:
+        # spawn: each worker opens its own SSH tunnel and connection, nothing is inherited
+        with ProcessPoolExecutor(
+                max_workers=args.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(args.dry_run,),
+        ) as executor:
+            futures = [executor.submit(generate_shard, *shard, plan) for shard in shards]
+            for future in as_completed(futures):
+                collect(future.result())
+
+    report(final=True)
+
+    if db is not None:
+        db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
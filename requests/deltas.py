@@ -0,0 +1,295 @@
+import asyncio
+import logging
+from collections import deque
+from datetime import date, datetime
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Set, Tuple, Union
+
+from core import metrics, serialization
+from core.config import DELTA_HEARTBEAT_SECONDS, DELTA_INTERVAL_SECONDS, DELTA_MAX_PENDING_BATCHES
+from models.schemas.schemas import PredictionSchema
+from requests import pipeline
+from requests.precompute import prediction_scheduler
+from requests.prediction import ACTIONABLE_WINDOW_DAYS
+
+logger = logging.getLogger(__name__)
+
+PairKey = Tuple[int, int]
+# (event name, pair key, prediction the event is about)
+Delta = Tuple[str, PairKey, PredictionSchema]
+# (event name, confidence_score, JSON data), filtered per subscriber by confidence
+Event = Tuple[str, float, bytes]
+# (generation, events); generation is the SSE id
+Batch = Tuple[int, List[Event]]
+
+DUE = "due"
+FULFILLED = "fulfilled"
+DROPPED = "dropped"
+RESET = "reset"
+
+
+def diff_predictions(previous: Dict[PairKey, PredictionSchema], current: Dict[PairKey, PredictionSchema],
+                     today: date) -> List[Delta]:
+    """
+    Deltas between two keyed prediction sets (client_id, goods_id) -> prediction:
+
+    * due: the pair entered the actionable window
+    * fulfilled: a new sale closed the cycle. Either the pair is still due with a later
+      last_requirement_date (fulfilled for the old prediction, then due for the new one),
+      or it left the set while its old prediction was still inside the window, which only
+      a change in its history does, normally a new sale moving the next date out
+    * dropped: the pair left the set because its expected date is now more than
+      ACTIONABLE_WINDOW_DAYS overdue
+
+    Pairs present in both with the same last_requirement_date produce nothing; only
+    days_since_last_requirement moves for them day to day.
+    """
+    deltas: List[Delta] = []
+
+    for key, before in previous.items():
+        after = current.get(key)
+        if after is None:
+            overdue = (today - before.predicted_next_purchase_date).days
+            deltas.append((DROPPED if overdue > ACTIONABLE_WINDOW_DAYS else FULFILLED, key, before))
+        elif after.last_requirement_date > before.last_requirement_date:
+            deltas.append((FULFILLED, key, before))
+            deltas.append((DUE, key, after))
+
+    for key, after in current.items():
+        if key not in previous:
+            deltas.append((DUE, key, after))
+
+    return deltas
+
+
+def _sse(generation: int, name: str, data: bytes) -> bytes:
+    return f"id: {generation}\nevent: {name}\ndata: ".encode() + data + b"\n\n"
+
+
+class _Subscriber:
+    __slots__ = ("confidence_threshold", "pending", "ready", "needs_reset")
+
+    def __init__(self, confidence_threshold: float):
+        self.confidence_threshold = confidence_threshold
+        # Batches, or an already rendered reset + snapshot
+        self.pending: Deque[Union[Batch, bytes]] = deque()
+        self.ready = asyncio.Event()
+        # Subscribed before the feed had any state: its first message is the first snapshot
+        self.needs_reset = True
+
+
+class DeltaFeed:
+    """
+    Prediction deltas for one min_requirements value, pushed to any number of SSE
+    subscribers. One background loop recomputes the set (or picks up the precomputed
+    one) every interval_seconds while anyone is subscribed, diffs it against the
+    previous one and serializes each event once; subscribers only filter by confidence.
+
+    A new subscriber, or one that fell more than max_pending batches behind, first
+    gets a reset event followed by the whole current set as due events; one that
+    subscribed before the first computation gets it once that computation is done.
+    """
+
+    def __init__(self, min_requirements: int, interval_seconds: float = DELTA_INTERVAL_SECONDS,
+                 max_pending: int = DELTA_MAX_PENDING_BATCHES):
+        self.min_requirements = min_requirements
+        self.interval_seconds = interval_seconds
+        self.max_pending = max_pending
+
+        self._current: Dict[PairKey, PredictionSchema] = {}
+        self._encoded: Dict[PairKey, bytes] = {}
+        self._subscribers: Set[_Subscriber] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._source_generated_at: Optional[datetime] = None
+        self._has_state = False
+
+        self.generation = 0
+        self.computations = 0
+        self.resyncs = 0
+        self.events = {DUE: 0, FULFILLED: 0, DROPPED: 0}
+        self.last_computed_at: Optional[datetime] = None
+        self.last_error: Optional[str] = None
+
+    # ---------- computation ----------
+
+    async def _predictions(self) -> Optional[List[PredictionSchema]]:
+        """The current set, or None when the precomputed one has not changed since last time."""
+        materialized = prediction_scheduler.get(self.min_requirements)
+        if materialized is not None:
+            if materialized.generated_at == self._source_generated_at:
+                return None
+            self._source_generated_at = materialized.generated_at
+            return list(materialized.predictions)
+
+        # Coalesced with identical requests and served from the statistics cache when it is on
+        return await pipeline.build_predictions_async(self.min_requirements, 0.0)
+
+    def _diff(self, predictions: List[PredictionSchema], today: date):
+        current = {(p.client_id, p.goods_id): p for p in predictions}
+        deltas = diff_predictions(self._current, current, today)
+
+        # Each prediction is serialized once per computation, whatever the number of subscribers
+        with metrics.stage("serialize"):
+            encoded = {key: serialization.dumps(prediction) for key, prediction in current.items()}
+
+        events = [
+            (name, prediction.confidence_score, encoded[key] if name == DUE else self._encoded[key])
+            for name, key, prediction in deltas
+        ]
+        return current, encoded, events
+
+    async def refresh(self):
+        predictions = await self._predictions()
+        self.computations += 1
+        self.last_computed_at = datetime.now()
+        if predictions is None:
+            return
+
+        current, encoded, events = await asyncio.to_thread(self._diff, predictions, date.today())
+        # No await from here on: subscribers see the new state and its deltas together
+        self._current, self._encoded = current, encoded
+        self._has_state = True
+
+        if events:
+            self.generation += 1
+            for name, _, _ in events:
+                self.events[name] += 1
+            metrics.count("delta_events", len(events))
+
+        batch = (self.generation, events)
+        for subscriber in self._subscribers:
+            if subscriber.needs_reset:
+                # Joined before the first state: the whole set, not a diff against nothing
+                self._reset(subscriber)
+            elif events:
+                self._push(subscriber, batch)
+
+    async def _run(self):
+        try:
+            while self._subscribers:
+                try:
+                    await self.refresh()
+                    self.last_error = None
+                except Exception as e:
+                    self.last_error = str(e)
+                    logger.error(f"Prediction delta refresh failed: {e}")
+                await asyncio.sleep(self.interval_seconds)
+        finally:
+            self._task = None
+
+    # ---------- subscribers ----------
+
+    def _reset(self, subscriber: _Subscriber):
+        subscriber.pending.clear()
+        subscriber.pending.append(self._snapshot(subscriber.confidence_threshold))
+        subscriber.needs_reset = False
+        subscriber.ready.set()
+
+    def _push(self, subscriber: _Subscriber, batch: Batch):
+        if len(subscriber.pending) >= self.max_pending:
+            # Too slow to keep up: drop what it has not read and resend the whole set instead
+            self._reset(subscriber)
+            self.resyncs += 1
+        else:
+            subscriber.pending.append(batch)
+            subscriber.ready.set()
+
+    def _snapshot(self, confidence_threshold: float) -> bytes:
+        parts = [_sse(self.generation, RESET, serialization.dumps({
+            "generation": self.generation,
+            "min_requirements": self.min_requirements,
+            "predictions": len(self._current),
+        }))]
+        parts += [
+            _sse(self.generation, DUE, self._encoded[key])
+            for key, prediction in self._current.items()
+            if prediction.confidence_score >= confidence_threshold
+        ]
+        return b"".join(parts)
+
+    def subscribe(self, confidence_threshold: float = 0.0) -> _Subscriber:
+        subscriber = _Subscriber(confidence_threshold)
+        self._subscribers.add(subscriber)
+        if self._has_state:
+            # Rendered now, so the batches that follow apply on top of exactly this state
+            self._reset(subscriber)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return subscriber
+
+    def unsubscribe(self, subscriber: _Subscriber):
+        self._subscribers.discard(subscriber)
+
+    async def stream(self, confidence_threshold: float = 0.0,
+                     heartbeat_seconds: float = DELTA_HEARTBEAT_SECONDS) -> AsyncIterator[bytes]:
+        """text/event-stream body for one subscriber."""
+        subscriber = self.subscribe(confidence_threshold)
+        try:
+            yield f"retry: {int(self.interval_seconds * 1000)}\n\n".encode()
+            while True:
+                try:
+                    await asyncio.wait_for(subscriber.ready.wait(), heartbeat_seconds)
+                except asyncio.TimeoutError:
+                    # Keeps proxies from closing an idle connection
+                    yield b": keep-alive\n\n"
+                    continue
+
+                subscriber.ready.clear()
+                while subscriber.pending:
+                    batch = subscriber.pending.popleft()
+                    if isinstance(batch, bytes):
+                        yield batch
+                        continue
+
+                    generation, events = batch
+                    chunk = b"".join(
+                        _sse(generation, name, data)
+                        for name, confidence, data in events
+                        if confidence >= confidence_threshold
+                    )
+                    if chunk:
+                        yield chunk
+        finally:
+            self.unsubscribe(subscriber)
+
+    async def stop(self):
+        task = self._task
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "subscribers": len(self._subscribers),
+            "running": self._task is not None,
+            "interval_seconds": self.interval_seconds,
+            "generation": self.generation,
+            "predictions": len(self._current),
+            "computations": self.computations,
+            "resyncs": self.resyncs,
+            "events": dict(self.events),
+            "last_computed_at": self.last_computed_at.isoformat() if self.last_computed_at else None,
+            "last_error": self.last_error,
+        }
+
+
+# min_requirements -> feed, created on first subscription
+delta_feeds: Dict[int, DeltaFeed] = {}
+
+
+def delta_feed(min_requirements: int) -> DeltaFeed:
+    feed = delta_feeds.get(min_requirements)
+    if feed is None:
+        feed = delta_feeds[min_requirements] = DeltaFeed(min_requirements)
+    return feed
+
+
+async def stop_delta_feeds():
+    for feed in list(delta_feeds.values()):
+        await feed.stop()
+
+
+def stats() -> Dict[str, Any]:
+    return {m: feed.stats() for m, feed in delta_feeds.items()}
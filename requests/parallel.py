@@ -0,0 +1,118 @@
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from core.config import ANALYSIS_PARALLEL_MIN_PATTERNS, ANALYSIS_WORKERS
+from requests.patterns import PatternSet
+from requests.prediction import PatternStats, PurchasePatternAnalyzer
+
+logger = logging.getLogger(__name__)
+
+
+def _worker_ready():
+    """Runs in a worker process; unpickling it there imports this module, NumPy and the analyzer."""
+
+
+def _stats_shard(
+        offsets: np.ndarray,
+        days: np.ndarray,
+        amounts: np.ndarray,
+        now: datetime,
+) -> PatternStats:
+    """Runs in a worker process."""
+    return PurchasePatternAnalyzer().pattern_stats(offsets, days, amounts, now=now)
+
+
+class AnalysisPool:
+    """
+    Persistent process pool for PurchasePatternAnalyzer.pattern_stats (and so analyze_many).
+    Patterns are sharded by client_id and each shard travels as three NumPy arrays.
+    """
+
+    def __init__(self, workers: int = ANALYSIS_WORKERS, min_patterns: int = ANALYSIS_PARALLEL_MIN_PATTERNS):
+        self.workers = workers
+        self.min_patterns = min_patterns
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+        self.parallel_runs = 0
+        self.serial_runs = 0
+
+    @property
+    def running(self) -> bool:
+        return self._executor is not None
+
+    def start(self):
+        if self.workers <= 0 or self._executor is not None:
+            return
+
+        started = time.perf_counter()
+        # spawn: the parent runs SSH tunnel threads, which fork doesn't copy safely
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        # Workers are spawned lazily, one per task submitted while none is idle; start them all
+        # here so the first large request doesn't pay for interpreter start-up and imports
+        for future in [self._executor.submit(_worker_ready) for _ in range(self.workers)]:
+            future.result()
+        logger.info(f"Analysis pool started with {self.workers} workers in {time.perf_counter() - started:.1f}s")
+
+    def shutdown(self):
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def pattern_stats(
+            self,
+            patterns: PatternSet,
+            now: Optional[datetime] = None,
+    ) -> PatternStats:
+        """Same table as PurchasePatternAnalyzer.pattern_stats over all patterns, in the same order."""
+        now = now or datetime.now()
+
+        if self._executor is None or len(patterns) < self.min_patterns:
+            self.serial_runs += 1
+            return PurchasePatternAnalyzer().pattern_stats(*patterns.pack(), now=now)
+
+        shard_of = patterns.client_id % self.workers
+
+        futures = []
+        for shard in range(self.workers):
+            indices = np.flatnonzero(shard_of == shard)
+            if not len(indices):
+                continue
+            futures.append((indices, self._executor.submit(
+                _stats_shard, *patterns.take(indices).pack(), now
+            )))
+
+        # Every shard is placed by its original indices, so the merge doesn't depend on completion order
+        stats = PatternStats.merge(len(patterns), [(indices, future.result()) for indices, future in futures])
+
+        self.parallel_runs += 1
+        return stats
+
+    def analyze(
+            self,
+            analyzer: PurchasePatternAnalyzer,
+            patterns: PatternSet,
+            now: Optional[datetime] = None,
+    ) -> List[Optional[dict]]:
+        """Same result as analyzer.analyze_many over all patterns, in the same order."""
+        now = now or datetime.now()
+        return self.pattern_stats(patterns, now).analyses(analyzer.min_requirements, now)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers if self.running else 0,
+            "min_patterns": self.min_patterns,
+            "parallel_runs": self.parallel_runs,
+            "serial_runs": self.serial_runs,
+        }
+
+
+analysis_pool = AnalysisPool()
@@ -0,0 +1,260 @@
+import time
+import logging
+import threading
+from collections import deque
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import requests.rq as rq
+from core.config import PATTERN_WINDOW_DAYS, PATTERN_STORE_FULL_RELOAD_SECONDS
+from requests.prediction import PurchasePatternAnalyzer
+
+logger = logging.getLogger(__name__)
+
+
+class PairStats:
+    """
+    Running statistics of one (client, goods) pair inside the analysis window.
+    Intervals are the positive gaps between consecutive purchase days. They are whole
+    days, so integer running sums give an exact mean/variance that does not drift
+    as intervals are added and aged out.
+
+    Like the request path, purchase_count and the agent describe the whole history:
+    every purchase ever counted, and the agent of the oldest one. The pair's ids are
+    the store's key and are not repeated here.
+    """
+
+    __slots__ = ("agent_id", "purchase_count", "first_purchase", "days", "recent", "cycle_count", "cycle_sum",
+                 "cycle_sumsq")
+
+    def __init__(self):
+        self.agent_id = None
+
+        self.purchase_count = 0
+        self.first_purchase = None  # (created_date, sales_id) of the oldest purchase
+
+        self.days = deque()  # purchase day ordinals, ascending
+        self.recent: List[Tuple[int, float]] = []  # last 3 (day, amount) in sorted order
+        self.cycle_count = 0
+        self.cycle_sum = 0
+        self.cycle_sumsq = 0
+
+    def _add_cycle(self, x: int):
+        self.cycle_count += 1
+        self.cycle_sum += x
+        self.cycle_sumsq += x * x
+
+    def _remove_cycle(self, x: int):
+        self.cycle_count -= 1
+        self.cycle_sum -= x
+        self.cycle_sumsq -= x * x
+
+    def add(self, day: int, amount: float) -> bool:
+        """Append a purchase. Returns False if it is older than the last one (pair needs a reload)."""
+        if self.days:
+            last = self.days[-1]
+            if day < last:
+                return False
+            if day > last:
+                self._add_cycle(day - last)
+
+        self.days.append(day)
+
+        self.recent.append((day, amount))
+        self.recent.sort()
+        del self.recent[:-3]
+        return True
+
+    def count(self, row: Dict[str, Any]):
+        """Count a purchase of the whole history; the oldest one sets the agent."""
+        self.purchase_count += 1
+
+        first = (row["created_date"], row["sales_id"])
+        if self.first_purchase is None or first < self.first_purchase:
+            self.first_purchase = first
+            self.agent_id = row["agent_id"]
+
+    def expire(self, cutoff_day: int):
+        """Drop purchases before cutoff_day together with the interval that follows each."""
+        days = self.days
+        while days and days[0] < cutoff_day:
+            dropped = days.popleft()
+            if days and days[0] > dropped:
+                self._remove_cycle(days[0] - dropped)
+
+        # The trailing amounts are the newest days, so whatever is left of them is still the last <= 3
+        if self.recent and self.recent[0][0] < cutoff_day:
+            self.recent = [(day, amount) for day, amount in self.recent if day >= cutoff_day]
+
+    @property
+    def window_count(self) -> int:
+        return len(self.days)
+
+    @property
+    def cycle_mean(self) -> float:
+        return self.cycle_sum / self.cycle_count if self.cycle_count else 0.0
+
+    @property
+    def variance(self) -> float:
+        # Population variance, computed exactly in integers before the single division
+        n = self.cycle_count
+        return (n * self.cycle_sumsq - self.cycle_sum ** 2) / (n * n) if n else 0.0
+
+    def info(self, key: Tuple[int, int]) -> Dict[str, Any]:
+        """Ids only; names are attached by rq.with_names."""
+        return {
+            "client_id": key[0],
+            "agent_id": self.agent_id,
+            "goods_id": key[1],
+            "purchase_count": self.purchase_count,
+        }
+
+
+class IncrementalPatternStore:
+    """
+    In-process replacement for re-reading the whole sales history on every request.
+    Remembers the highest sales_id seen and applies only newer rows on refresh().
+    Rows older than the window only count towards purchase_count and the agent, and
+    a pair is dropped once none of its purchases is left inside the window.
+
+    Rows arriving out of date order, and rows of a pair the store does not hold
+    (new, or dropped earlier with history that still counts), reload their pair
+    from the database. Rows the watermark cannot see (late commits, edits of old
+    sales) are picked up by the periodic full reload.
+    """
+
+    def __init__(self, window_days: int = PATTERN_WINDOW_DAYS,
+                 full_reload_seconds: int = PATTERN_STORE_FULL_RELOAD_SECONDS):
+        self.window_days = window_days
+        self.full_reload_seconds = full_reload_seconds
+
+        self._pairs: Dict[Tuple[int, int], PairStats] = {}
+        self._lock = threading.Lock()
+
+        self.last_sales_id = 0
+        self.last_created_date: Optional[date] = None
+        self._loaded_at: Optional[float] = None
+
+    def _cutoff_day(self, now: datetime) -> int:
+        cutoff = now - timedelta(days=self.window_days)
+        # First whole day that is not older than the cutoff
+        return cutoff.toordinal() + (cutoff.time() != datetime.min.time())
+
+    def _apply(self, rows: Iterator[Dict[str, Any]], cutoff_day: int,
+               full: bool) -> Tuple[int, List[Tuple[int, int]]]:
+        """Apply rows in (created_date, sales_id) order; returns the pairs to reload."""
+        applied = 0
+        reload = set()
+
+        for row in rows:
+            key = (row["client_id"], row["goods_id"])
+            pair = self._pairs.get(key)
+            if pair is None and full:
+                pair = self._pairs[key] = PairStats()
+
+            if pair is None or key in reload:
+                # Reloaded whole below, this row included
+                reload.add(key)
+            else:
+                pair.count(row)
+                day = row["created_date"].toordinal()
+                if day >= cutoff_day and not pair.add(day, float(row["amount"])):
+                    reload.add(key)
+
+            applied += 1
+
+            if row["sales_id"] > self.last_sales_id:
+                self.last_sales_id = row["sales_id"]
+            created = row["created_date"]
+            if self.last_created_date is None or created > self.last_created_date:
+                self.last_created_date = created
+
+        return applied, sorted(reload)
+
+    def _reload_pairs(self, keys: List[Tuple[int, int]], cutoff_day: int):
+        for start in range(0, len(keys), rq.PAIR_LOOKUP_CHUNK):
+            chunk = keys[start:start + rq.PAIR_LOOKUP_CHUNK]
+            for key in chunk:
+                self._pairs[key] = PairStats()
+
+            for row in rq.get_pairs_history(chunk):
+                pair = self._pairs[(row["client_id"], row["goods_id"])]
+                pair.count(row)
+                day = row["created_date"].toordinal()
+                if day >= cutoff_day:
+                    pair.add(day, float(row["amount"]))
+
+    def refresh(self, now: Optional[datetime] = None, full: bool = False) -> Dict[str, Any]:
+        now = now or datetime.now()
+        cutoff_day = self._cutoff_day(now)
+
+        with self._lock:
+            started = time.perf_counter()
+
+            reload_due = (
+                self._loaded_at is None
+                or time.monotonic() - self._loaded_at > self.full_reload_seconds
+            )
+            full = bool(full or reload_due)
+            if full:
+                logger.info("Pattern store: full reload")
+                self._pairs = {}
+                self.last_sales_id = 0
+                self.last_created_date = None
+                self._loaded_at = time.monotonic()
+
+            applied, reload = self._apply(rq.get_sales_since(self.last_sales_id), cutoff_day, full)
+            if reload:
+                self._reload_pairs(reload, cutoff_day)
+
+            expired = []
+            for key, pair in self._pairs.items():
+                if pair.days and pair.days[0] < cutoff_day:
+                    pair.expire(cutoff_day)
+                if not pair.days:
+                    expired.append(key)
+            # Nothing left in the window: a later purchase reloads the pair's history
+            for key in expired:
+                del self._pairs[key]
+
+            return {
+                "full_reload": full,
+                "rows_applied": applied,
+                "pairs_reloaded": len(reload),
+                "pairs_expired": len(expired),
+                "pairs": len(self._pairs),
+                "last_sales_id": self.last_sales_id,
+                "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+            }
+
+    def analyze(
+            self,
+            analyzer: PurchasePatternAnalyzer,
+            now: Optional[datetime] = None,
+    ) -> List[Tuple[Dict[str, Any], Optional[dict]]]:
+        """
+        (pattern info, analysis) for every pair with enough purchases, like the request path.
+        Names come from rq.dimension_caches, outside the store lock.
+        """
+        now = now or datetime.now()
+        results = []
+
+        with self._lock:
+            for key, pair in self._pairs.items():
+                if pair.window_count < analyzer.min_requirements or not pair.cycle_count:
+                    continue
+
+                analysis = analyzer.analyze_summary(
+                    requirement_count=pair.window_count,
+                    last_date=date.fromordinal(pair.days[-1]),
+                    avg_cycle=pair.cycle_mean,
+                    variance=pair.variance,
+                    recent_amounts=[amount for _, amount in pair.recent],
+                    now=now,
+                )
+                results.append((pair.info(key), analysis))
+
+        return rq.with_names(results)
+
+
+pattern_store = IncrementalPatternStore()
@@ -0,0 +1,303 @@
+from array import array
+from datetime import date
+from typing import Any, Dict, Iterable, Iterator, List, Sequence, Tuple, Union
+
+import numpy as np
+
+from core import metrics
+
+Names = Dict[str, Dict[int, str]]
+
+# (client_id, goods_id) packed as client_id << 32 | goods_id; ids are non-negative and goods_id < 2**32
+PAIR_KEY_SHIFT = 32
+PAIR_KEY_MASK = (1 << PAIR_KEY_SHIFT) - 1
+
+
+def _empty_names() -> Names:
+    return {"client": {}, "agent": {}, "goods": {}}
+
+
+class PurchasePattern:
+    """One pair of a PatternSet; days and amounts are views into the set's arrays."""
+
+    __slots__ = ("client_id", "goods_id", "agent_id", "client_name", "agent_name", "goods_name", "days", "amounts")
+
+    def __init__(self, client_id: int, goods_id: int, agent_id: int,
+                 client_name: str, agent_name: str, goods_name: str,
+                 days: np.ndarray, amounts: np.ndarray):
+        self.client_id = client_id
+        self.goods_id = goods_id
+        self.agent_id = agent_id
+        self.client_name = client_name
+        self.agent_name = agent_name
+        self.goods_name = goods_name
+        self.days = days
+        self.amounts = amounts
+
+    def __repr__(self) -> str:
+        return f"PurchasePattern(client_id={self.client_id}, goods_id={self.goods_id}, purchases={len(self.days)})"
+
+    @property
+    def purchase_count(self) -> int:
+        return len(self.days)
+
+    @property
+    def dates(self) -> List[date]:
+        return [date.fromordinal(day) for day in self.days.tolist()]
+
+
+class PatternSet:
+    """
+    Purchase patterns as struct-of-arrays. Pattern i owns days[offsets[i]:offsets[i + 1]]
+    (int32 day ordinals) and the same slice of amounts; its ids are client_id[i],
+    goods_id[i] and agent_id[i], and names are looked up once per id in `names`.
+
+    Indexing returns a PurchasePattern, slicing and take() return a smaller PatternSet,
+    pack() hands the arrays to PurchasePatternAnalyzer.analyze_many as they are.
+    """
+
+    def __init__(self, offsets: np.ndarray, days: np.ndarray, amounts: np.ndarray,
+                 client_id: np.ndarray, goods_id: np.ndarray, agent_id: np.ndarray, names: Names):
+        self.offsets = offsets
+        self.days = days
+        self.amounts = amounts
+        self.client_id = client_id
+        self.goods_id = goods_id
+        self.agent_id = agent_id
+        self.names = names
+
+    @classmethod
+    def empty(cls, names: Names = None) -> "PatternSet":
+        ids = np.empty(0, np.int64)
+        return cls(np.zeros(1, np.int64), np.empty(0, np.int32), np.empty(0, np.float64),
+                   ids, ids, ids, names or _empty_names())
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def purchase_counts(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in (self.offsets, self.days, self.amounts,
+                                      self.client_id, self.goods_id, self.agent_id))
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[PurchasePattern, "PatternSet"]:
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return self.take(np.arange(start, stop, step))
+            stop = max(start, stop)
+            # Contiguous pairs: views, nothing is copied
+            first, last = self.offsets[start], self.offsets[stop]
+            return PatternSet(
+                self.offsets[start:stop + 1] - first, self.days[first:last], self.amounts[first:last],
+                self.client_id[start:stop], self.goods_id[start:stop], self.agent_id[start:stop], self.names,
+            )
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+
+        info = self.info(index)
+        first, last = self.offsets[index], self.offsets[index + 1]
+        return PurchasePattern(
+            info["client_id"], info["goods_id"], info["agent_id"],
+            info["client_name"], info["agent_name"], info["goods_name"],
+            self.days[first:last], self.amounts[first:last],
+        )
+
+    def __iter__(self) -> Iterator[PurchasePattern]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def take(self, indices: Sequence[int]) -> "PatternSet":
+        indices = np.asarray(indices, dtype=np.int64)
+        counts = self.purchase_counts[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        rows = np.repeat(self.offsets[indices] - offsets[:-1], counts) + np.arange(offsets[-1])
+        return PatternSet(
+            offsets, self.days[rows], self.amounts[rows],
+            self.client_id[indices], self.goods_id[indices], self.agent_id[indices], self.names,
+        )
+
+    def with_min_purchases(self, min_requirements: int) -> "PatternSet":
+        return self.take(np.flatnonzero(self.purchase_counts >= min_requirements))
+
+    def distinct_ids(self) -> Dict[str, np.ndarray]:
+        """Sorted unique ids per dimension, the keys `names` has to cover."""
+        return {
+            "client": np.unique(self.client_id),
+            "agent": np.unique(self.agent_id),
+            "goods": np.unique(self.goods_id),
+        }
+
+    def with_names(self, names: Names) -> "PatternSet":
+        """
+        This set with `names` attached. Pairs whose client, agent or goods has no
+        name are dropped, as the INNER JOINs on the dimension tables used to do.
+        """
+        known = np.ones(len(self), dtype=bool)
+        for kind, ids in (("client", self.client_id), ("agent", self.agent_id), ("goods", self.goods_id)):
+            mapping = names[kind]
+            if ids.size:
+                known &= np.fromiter((i in mapping for i in ids.tolist()), dtype=bool, count=ids.size)
+
+        patterns = self[:] if known.all() else self.take(np.flatnonzero(known))
+        patterns.names = names
+        return patterns
+
+    def pack(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(offsets, day ordinals, amounts) in the layout analyze_many takes."""
+        return self.offsets, self.days, self.amounts
+
+    def info(self, index: int) -> Dict[str, Any]:
+        """Pattern info in the shape pipeline.make_prediction reads."""
+        client_id = int(self.client_id[index])
+        goods_id = int(self.goods_id[index])
+        agent_id = int(self.agent_id[index])
+        return {
+            "client_id": client_id,
+            "client_name": self.names["client"].get(client_id),
+            "agent_id": agent_id,
+            "agent_name": self.names["agent"].get(agent_id),
+            "goods_id": goods_id,
+            "goods_name": self.names["goods"].get(goods_id),
+            "purchase_count": int(self.offsets[index + 1] - self.offsets[index]),
+        }
+
+
+def _as_array(buffer: array, dtype) -> np.ndarray:
+    return np.frombuffer(buffer, dtype=dtype) if len(buffer) else np.empty(0, dtype)
+
+
+class PatternGroups:
+    """
+    Groups fact rows (PURCHASE_FACT_QUERY shape: ids, date, amount) into a PatternSet.
+    add_rows only appends to flat typed arrays, with (client_id, goods_id) packed into
+    one int64 key per row; pairs are formed once, in to_result, by a stable sort on
+    that key. Names are not read from the rows; attach them with PatternSet.with_names.
+    """
+
+    def __init__(self):
+        self._keys = array("q")
+        self._agent_id = array("q")
+        self._days = array("i")
+        self._amounts = array("d")
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    @metrics.stage("group")
+    def add_rows(self, rows: Iterable[Dict[str, Any]]):
+        keys, agent_ids = self._keys.append, self._agent_id.append
+        days, amounts = self._days.append, self._amounts.append
+
+        for row in rows:
+            keys(row["client_id"] << PAIR_KEY_SHIFT | row["goods_id"])
+            agent_ids(row["agent_id"])
+            days(row["created_date"].toordinal())
+            amounts(float(row["amount"]))
+
+    @metrics.stage("group")
+    def to_result(self, min_requirements: int) -> Dict[str, Any]:
+        """
+        Pairs with at least min_requirements purchases. Same content and order as the
+        dict-of-dicts grouping this replaced: rows of a pair in arrival order, agent of
+        the last row seen, most purchases first and ties in first-seen order
+        (client first, then goods within the client).
+        """
+        keys = _as_array(self._keys, np.int64)
+        n = len(keys)
+
+        if n == 0:
+            patterns = PatternSet.empty()
+        else:
+            # Stable, so rows of a pair stay in arrival order
+            order = np.argsort(keys, kind="stable")
+            sorted_keys = keys[order]
+            del keys
+
+            sorted_client = sorted_keys >> PAIR_KEY_SHIFT
+            new_client = np.concatenate(([True], sorted_client[1:] != sorted_client[:-1]))
+            starts = np.flatnonzero(np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1])))
+            counts = np.diff(np.append(starts, n))
+            pair_keys = sorted_keys[starts]
+            del sorted_keys
+
+            client_starts = np.flatnonzero(new_client)
+            client_first_seen = np.minimum.reduceat(order, client_starts)
+            pair_client = np.searchsorted(client_starts, starts, side="right") - 1
+            del sorted_client, new_client
+
+            pairs = np.flatnonzero(counts >= min_requirements)
+            pairs = pairs[np.lexsort((
+                order[starts[pairs]],  # pair first seen
+                client_first_seen[pair_client[pairs]],
+                -counts[pairs],
+            ))]
+
+            pair_counts = counts[pairs]
+            offsets = np.zeros(len(pairs) + 1, dtype=np.int64)
+            np.cumsum(pair_counts, out=offsets[1:])
+            rows = order[np.repeat(starts[pairs] - offsets[:-1], pair_counts) + np.arange(offsets[-1])]
+            last_rows = order[starts[pairs] + pair_counts - 1]
+            del order
+
+            pair_keys = pair_keys[pairs]
+            patterns = PatternSet(
+                offsets,
+                _as_array(self._days, np.int32)[rows],
+                _as_array(self._amounts, np.float64)[rows],
+                pair_keys >> PAIR_KEY_SHIFT,
+                pair_keys & PAIR_KEY_MASK,
+                _as_array(self._agent_id, np.int64)[last_rows],
+                _empty_names(),
+            )
+
+        metrics.count("patterns", len(patterns))
+        return {
+            "patterns": patterns,
+            "total_patterns": len(patterns),
+            "min_requirements_used": min_requirements
+        }
+
+
+class PatternSetBuilder:
+    """Builds a PatternSet from histories that arrive already grouped, one pair at a time, in order."""
+
+    def __init__(self):
+        self._offsets = array("q", [0])
+        self._days = array("i")
+        self._amounts = array("d")
+        self._client_id = array("q")
+        self._goods_id = array("q")
+        self._agent_id = array("q")
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def append(self, client_id: int, goods_id: int, agent_id: int,
+               days: Iterable[int], amounts: Iterable[float]):
+        self._client_id.append(client_id)
+        self._goods_id.append(goods_id)
+        self._agent_id.append(agent_id)
+        self._days.extend(days)
+        self._amounts.extend(amounts)
+        self._offsets.append(len(self._days))
+
+    def build(self) -> PatternSet:
+        return PatternSet(
+            _as_array(self._offsets, np.int64),
+            _as_array(self._days, np.int32),
+            _as_array(self._amounts, np.float64),
+            _as_array(self._client_id, np.int64),
+            _as_array(self._goods_id, np.int64),
+            _as_array(self._agent_id, np.int64),
+            _empty_names(),
+        )
@@ -0,0 +1,349 @@
+import asyncio
+import heapq
+import logging
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import requests.rq as rq
+from core import metrics
+from core.cache import ResultCache
+from core.singleflight import SingleFlight
+from core.config import (
+    ANALYSIS_CACHE_ENABLED,
+    ANALYSIS_CACHE_TTL_SECONDS,
+    PATTERN_STORE_ENABLED,
+    SALES_WATERMARK_MAX_AGE_SECONDS,
+    SNAPSHOT_ENABLED,
+)
+from models.schemas.schemas import PredictionSchema
+from requests.parallel import analysis_pool
+from requests.pattern_store import pattern_store
+from requests.patterns import PatternSet
+from requests.prediction import PatternStats, PurchasePatternAnalyzer
+from requests.prediction_index import PredictionIndex
+from requests.snapshot import sales_snapshot
+
+logger = logging.getLogger(__name__)
+
+# (pattern info, analysis or None)
+Analyzed = Tuple[Dict[str, Any], Optional[dict]]
+SortKey = Tuple[int, int, int]
+
+# Patterns analyzed per step when streaming
+STREAM_CHUNK_SIZE = 2000
+
+# Smallest min_requirements the API accepts; statistics fetched at it serve every higher value
+STATS_MIN_REQUIREMENTS = 2
+
+# (PatternSet, PatternStats) of the latest data version, shared by all thresholds
+analysis_cache = ResultCache(max_entries=1, ttl_seconds=ANALYSIS_CACHE_TTL_SECONDS)
+
+StatsEntry = Tuple[PatternSet, PatternStats]
+
+# Identical fetch / analysis work that overlaps in time runs once; see SingleFlight
+flights = SingleFlight()
+
+
+def analyze_fetched(patterns: PatternSet, analyzer: PurchasePatternAnalyzer) -> List[Analyzed]:
+    """Only actionable pairs are returned, so pattern info is built for those alone."""
+    if not len(patterns):
+        return []
+
+    # Serial unless the process pool is running and there are enough patterns
+    with metrics.stage("analyze"):
+        analyses = analysis_pool.analyze(analyzer, patterns)
+        return [(patterns.info(i), analysis) for i, analysis in enumerate(analyses) if analysis is not None]
+
+
+def _cached_stats(watermark: Optional[int], now: datetime) -> Optional[StatsEntry]:
+    entry = analysis_cache.get("stats", version=watermark)
+    # The table also depends on the day, through the window cutoff
+    if entry is not None and entry[1].valid_for(now):
+        return entry
+    return None
+
+
+def _compute_stats(patterns: PatternSet, watermark: Optional[int], now: datetime) -> StatsEntry:
+    with metrics.stage("analyze"):
+        entry = patterns, analysis_pool.pattern_stats(patterns, now)
+    analysis_cache.set("stats", entry, version=watermark)
+    return entry
+
+
+def _load_stats(watermark: Optional[int], now: datetime) -> StatsEntry:
+    # A flight that finished just before this one started may have stored it already
+    entry = _cached_stats(watermark, now)
+    if entry is None:
+        patterns = rq.get_purchase_patterns(min_requirements=STATS_MIN_REQUIREMENTS)["patterns"]
+        entry = _compute_stats(patterns, watermark, now)
+    return entry
+
+
+async def _load_stats_async(watermark: Optional[int], now: datetime) -> StatsEntry:
+    entry = _cached_stats(watermark, now)
+    if entry is None:
+        patterns = (await rq.get_purchase_patterns_async(min_requirements=STATS_MIN_REQUIREMENTS))["patterns"]
+        entry = await asyncio.to_thread(_compute_stats, patterns, watermark, now)
+    return entry
+
+
+def _flight_key(analyzer: PurchasePatternAnalyzer) -> tuple:
+    return "analyze", analyzer.min_requirements, analyzer.confidence_threshold
+
+
+def _select(entry: StatsEntry, analyzer: PurchasePatternAnalyzer, now: datetime) -> List[Analyzed]:
+    """The thresholds applied to a cached table; only the patterns that pass are touched."""
+    patterns, stats = entry
+    with metrics.stage("select"):
+        return [(patterns.info(i), analysis) for i, analysis in stats.actionable(analyzer.min_requirements, now)]
+
+
+def analyze_patterns(analyzer: PurchasePatternAnalyzer) -> List[Analyzed]:
+    """(pattern info, analysis or None) for every (client, goods) pair with enough purchases."""
+    if SNAPSHOT_ENABLED and sales_snapshot.loaded:
+        with metrics.stage("analyze"):
+            return sales_snapshot.analyze(analyzer)
+
+    if PATTERN_STORE_ENABLED:
+        with metrics.stage("store_refresh"):
+            pattern_store.refresh()
+        with metrics.stage("analyze"):
+            return pattern_store.analyze(analyzer)
+
+    if ANALYSIS_CACHE_ENABLED:
+        now = datetime.now()
+        watermark = rq.get_sales_watermark(max_age=SALES_WATERMARK_MAX_AGE_SECONDS)
+        entry = _cached_stats(watermark, now)
+        if entry is None:
+            # Concurrent misses for the same data version share one fetch and one analysis
+            entry = flights.do(("stats", watermark), lambda: _load_stats(watermark, now))
+        return _select(entry, analyzer, now)
+
+    def fetch_and_analyze() -> List[Analyzed]:
+        patterns = rq.get_purchase_patterns(min_requirements=analyzer.min_requirements)["patterns"]
+        return analyze_fetched(patterns, analyzer)
+
+    return flights.do(_flight_key(analyzer), fetch_and_analyze)
+
+
+async def analyze_patterns_async(analyzer: PurchasePatternAnalyzer) -> List[Analyzed]:
+    """analyze_patterns with async I/O; the analysis itself runs in a worker thread."""
+    if (SNAPSHOT_ENABLED and sales_snapshot.loaded) or PATTERN_STORE_ENABLED:
+        # Local snapshot, or the store's delta queries through the blocking pool
+        return await flights.do_async(_flight_key(analyzer), lambda: asyncio.to_thread(analyze_patterns, analyzer))
+
+    if ANALYSIS_CACHE_ENABLED:
+        now = datetime.now()
+        watermark = await rq.get_sales_watermark_async(max_age=SALES_WATERMARK_MAX_AGE_SECONDS)
+        entry = _cached_stats(watermark, now)
+        if entry is None:
+            entry = await flights.do_async(("stats", watermark), lambda: _load_stats_async(watermark, now))
+        return await asyncio.to_thread(_select, entry, analyzer, now)
+
+    async def fetch_and_analyze() -> List[Analyzed]:
+        patterns = (await rq.get_purchase_patterns_async(min_requirements=analyzer.min_requirements))["patterns"]
+        return await asyncio.to_thread(analyze_fetched, patterns, analyzer)
+
+    return await flights.do_async(_flight_key(analyzer), fetch_and_analyze)
+
+
+def iter_candidates(analyzed: Iterable[Analyzed], confidence_threshold: float) -> Iterator[Analyzed]:
+    for pattern, analysis in analyzed:
+        if analysis is None:
+            continue
+
+        # Filter by confidence
+        if analysis["confidence_score"] < confidence_threshold:
+            continue
+
+        yield pattern, analysis
+
+
+def make_prediction(pattern: Dict[str, Any], analysis: dict) -> Optional[PredictionSchema]:
+    """
+    PredictionSchema from a pattern and its analysis, validated here once; the
+    responses are serialized from it without a second response_model validation.
+    A pattern without a name or with an out-of-range confidence is skipped.
+    """
+    try:
+        # Validation is also the fastest supported constructor: model_construct takes longer per model
+        return PredictionSchema(**pattern, **analysis)
+    except Exception as e:
+        logger.error(f"Error creating prediction: {e}")
+        return None
+
+
+@metrics.stage("build")
+def to_predictions(analyzed: Iterable[Analyzed], confidence_threshold: float) -> List[PredictionSchema]:
+    predictions: List[PredictionSchema] = []
+
+    for pattern, analysis in iter_candidates(analyzed, confidence_threshold):
+        prediction = make_prediction(pattern, analysis)
+        if prediction is not None:
+            predictions.append(prediction)
+
+    # Sort by urgency (days since last requirement, descending)
+    predictions.sort(key=lambda p: p.days_since_last_requirement, reverse=True)
+    metrics.count("predictions", len(predictions))
+
+    return predictions
+
+
+def sort_key(item: Analyzed) -> SortKey:
+    """Most overdue first; client/goods ids make the order total so cursors are stable."""
+    pattern, analysis = item
+    return -analysis["days_since_last_requirement"], pattern["client_id"], pattern["goods_id"]
+
+
+def encode_cursor(key: SortKey) -> str:
+    return f"{-key[0]}:{key[1]}:{key[2]}"
+
+
+def decode_cursor(cursor: str) -> SortKey:
+    """Raises ValueError for a malformed cursor."""
+    days_since, client_id, goods_id = (int(part) for part in cursor.split(":"))
+    return -days_since, client_id, goods_id
+
+
+@metrics.stage("build")
+def page_predictions(
+        analyzed: Iterable[Analyzed],
+        confidence_threshold: float,
+        limit: int,
+        after: Optional[SortKey] = None,
+) -> Tuple[List[PredictionSchema], int, Optional[str]]:
+    """
+    The next `limit` predictions after the cursor key, chosen with a bounded heap
+    instead of sorting everything. Only the returned page is turned into schemas.
+    Returns (page, total matching predictions, next cursor or None).
+    """
+    total = 0
+
+    def remaining():
+        nonlocal total
+        for item in iter_candidates(analyzed, confidence_threshold):
+            total += 1
+            if after is None or sort_key(item) > after:
+                yield item
+
+    page = heapq.nsmallest(limit + 1, remaining(), key=sort_key)
+
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = encode_cursor(sort_key(page[-1]))
+
+    predictions = [p for p in (make_prediction(*item) for item in page) if p is not None]
+    metrics.count("predictions", len(predictions))
+    return predictions, total, next_cursor
+
+
+def build_predictions(min_requirements: int, confidence_threshold: float) -> List[PredictionSchema]:
+    analyzer = PurchasePatternAnalyzer(
+        min_requirements=min_requirements,
+        confidence_threshold=confidence_threshold
+    )
+    return to_predictions(analyze_patterns(analyzer), confidence_threshold)
+
+
+async def build_predictions_async(min_requirements: int, confidence_threshold: float) -> List[PredictionSchema]:
+    analyzer = PurchasePatternAnalyzer(
+        min_requirements=min_requirements,
+        confidence_threshold=confidence_threshold
+    )
+    analyzed = await analyze_patterns_async(analyzer)
+    return await asyncio.to_thread(to_predictions, analyzed, confidence_threshold)
+
+
+async def build_page_async(
+        min_requirements: int,
+        confidence_threshold: float,
+        limit: int,
+        after: Optional[SortKey] = None,
+) -> Tuple[List[PredictionSchema], int, Optional[str]]:
+    analyzer = PurchasePatternAnalyzer(
+        min_requirements=min_requirements,
+        confidence_threshold=confidence_threshold
+    )
+    analyzed = await analyze_patterns_async(analyzer)
+    return await asyncio.to_thread(page_predictions, analyzed, confidence_threshold, limit, after)
+
+
+async def build_pair_predictions_async(
+        pairs: List[Tuple[int, int]],
+        min_requirements: int,
+        confidence_threshold: float,
+) -> List[PredictionSchema]:
+    """Predictions for the given (client_id, goods_id) pairs only, most overdue first."""
+    analyzer = PurchasePatternAnalyzer(
+        min_requirements=min_requirements,
+        confidence_threshold=confidence_threshold
+    )
+    patterns = (await rq.get_pair_patterns_async(pairs, min_requirements=min_requirements))["patterns"]
+    analyzed = await asyncio.to_thread(analyze_fetched, patterns, analyzer)
+    return await asyncio.to_thread(to_predictions, analyzed, confidence_threshold)
+
+
+async def build_index_async(min_requirements: int) -> PredictionIndex:
+    """Index over every actionable prediction; lookups apply their own confidence filter."""
+    predictions = await build_predictions_async(min_requirements, 0.0)
+    return await asyncio.to_thread(PredictionIndex, predictions)
+
+
+@metrics.stage("serialize")
+def _ndjson(predictions: Iterable[PredictionSchema]) -> bytes:
+    return b"".join(p.model_dump_json(by_alias=True).encode() + b"\n" for p in predictions)
+
+
+def _ndjson_chunk(analyzed: Iterable[Analyzed], confidence_threshold: float) -> bytes:
+    predictions = (make_prediction(*item) for item in iter_candidates(analyzed, confidence_threshold))
+    return _ndjson(p for p in predictions if p is not None)
+
+
+async def stream_ndjson(predictions: List[PredictionSchema]) -> AsyncIterator[bytes]:
+    """NDJSON for an already computed list, serialized in chunks off the event loop."""
+    for start in range(0, len(predictions), STREAM_CHUNK_SIZE):
+        yield await asyncio.to_thread(_ndjson, predictions[start:start + STREAM_CHUNK_SIZE])
+
+
+async def stream_predictions_ndjson(
+        min_requirements: int,
+        confidence_threshold: float,
+        limit: Optional[int] = None,
+        after: Optional[SortKey] = None,
+) -> AsyncIterator[bytes]:
+    """
+    Predictions as NDJSON, one object per line. Without a limit they are emitted
+    chunk by chunk (unsorted): straight from the cached statistics when the analysis
+    cache is on, otherwise as each chunk of fetched patterns is analyzed, so nothing
+    accumulates. With a limit the page is selected first and emitted most overdue first.
+    """
+    if limit is not None:
+        page, _, _ = await build_page_async(min_requirements, confidence_threshold, limit, after)
+        yield await asyncio.to_thread(_ndjson, page)
+        return
+
+    analyzer = PurchasePatternAnalyzer(
+        min_requirements=min_requirements,
+        confidence_threshold=confidence_threshold
+    )
+
+    if (SNAPSHOT_ENABLED and sales_snapshot.loaded) or PATTERN_STORE_ENABLED or ANALYSIS_CACHE_ENABLED:
+        # Local sources, or the cached statistics table: only actionable pairs come back, stream their lines
+        analyzed = await analyze_patterns_async(analyzer)
+        for start in range(0, len(analyzed), STREAM_CHUNK_SIZE):
+            chunk = analyzed[start:start + STREAM_CHUNK_SIZE]
+            yield await asyncio.to_thread(_ndjson_chunk, chunk, confidence_threshold)
+        return
+
+    result = await flights.do_async(
+        ("patterns", min_requirements), lambda: rq.get_purchase_patterns_async(min_requirements=min_requirements)
+    )
+    patterns = result["patterns"]
+
+    for start in range(0, len(patterns), STREAM_CHUNK_SIZE):
+        chunk = patterns[start:start + STREAM_CHUNK_SIZE]
+        analyzed = await asyncio.to_thread(analyze_fetched, chunk, analyzer)
+        lines = await asyncio.to_thread(_ndjson_chunk, analyzed, confidence_threshold)
+        if lines:
+            yield lines
@@ -0,0 +1,190 @@
+import asyncio
+import bisect
+import logging
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests.rq as rq
+from core import metrics
+from core.config import (
+    ANALYSIS_CACHE_ENABLED,
+    PATTERN_STORE_ENABLED,
+    PRECOMPUTE_INTERVAL_SECONDS,
+    PRECOMPUTE_MIN_REQUIREMENTS,
+    SNAPSHOT_ENABLED,
+)
+from models.schemas.schemas import PredictionSchema
+from requests import pipeline
+from requests.parallel import analysis_pool
+from requests.prediction import PurchasePatternAnalyzer
+from requests.prediction_index import PredictionIndex
+from requests.snapshot import sales_snapshot
+
+logger = logging.getLogger(__name__)
+
+
+class MaterializedPredictions:
+    """
+    Every actionable prediction for one min_requirements value (no confidence filter),
+    in pipeline.sort_key order, so requests only filter and slice.
+    """
+
+    def __init__(self, min_requirements: int, items: List[pipeline.Analyzed], generated_at: datetime):
+        self.min_requirements = min_requirements
+        self.generated_at = generated_at
+
+        items = sorted(items, key=pipeline.sort_key)
+        # Items make_prediction rejects are never served, so they are not counted either
+        built = [(pipeline.sort_key(item), pipeline.make_prediction(*item)) for item in items]
+        built = [(key, prediction) for key, prediction in built if prediction is not None]
+        self.keys = [key for key, _ in built]
+        self.predictions: List[PredictionSchema] = [prediction for _, prediction in built]
+        self._confidences = sorted(prediction.confidence_score for prediction in self.predictions)
+        self._index: Optional[PredictionIndex] = None
+
+    @property
+    def index(self) -> PredictionIndex:
+        # Built on first lookup, once per generation
+        if self._index is None:
+            self._index = PredictionIndex(self.predictions)
+        return self._index
+
+    def count(self, confidence_threshold: float) -> int:
+        return len(self._confidences) - bisect.bisect_left(self._confidences, confidence_threshold)
+
+    def select(
+            self,
+            confidence_threshold: float,
+            limit: Optional[int] = None,
+            after: Optional[pipeline.SortKey] = None,
+    ) -> Tuple[List[PredictionSchema], int, Optional[str]]:
+        """Same contract as pipeline.page_predictions; without a limit returns every match."""
+        start = bisect.bisect_right(self.keys, after) if after is not None else 0
+
+        page = []
+        last_index = None
+        next_cursor = None
+        for i in range(start, len(self.predictions)):
+            prediction = self.predictions[i]
+            if prediction.confidence_score < confidence_threshold:
+                continue
+            if limit is not None and len(page) == limit:
+                next_cursor = pipeline.encode_cursor(self.keys[last_index])
+                break
+            page.append(prediction)
+            last_index = i
+
+        return page, self.count(confidence_threshold), next_cursor
+
+
+class PredictionScheduler:
+    """
+    Recomputes the prediction set for every min_requirements value in the grid on a
+    fixed interval (or on demand) and keeps the results in memory.
+    """
+
+    def __init__(self, grid: List[int] = PRECOMPUTE_MIN_REQUIREMENTS,
+                 interval_seconds: int = PRECOMPUTE_INTERVAL_SECONDS):
+        self.grid = sorted(set(grid))
+        self.interval_seconds = interval_seconds
+
+        self._sets: Dict[int, MaterializedPredictions] = {}
+        self._lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+        # Set once the first refresh has finished, successful or not
+        self.refreshed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+        self.generation = 0
+        self.last_refresh_at: Optional[datetime] = None
+        self.last_refresh_ms: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    def get(self, min_requirements: int) -> Optional[MaterializedPredictions]:
+        return self._sets.get(min_requirements)
+
+    def compute(self) -> Dict[int, MaterializedPredictions]:
+        generated_at = datetime.now()
+        analyzed_by_min: Dict[int, List[pipeline.Analyzed]] = {}
+
+        if (SNAPSHOT_ENABLED and sales_snapshot.loaded) or PATTERN_STORE_ENABLED or ANALYSIS_CACHE_ENABLED:
+            # Local sources, or the shared statistics table: each pass after the first is cheap
+            for min_requirements in self.grid:
+                analyzed_by_min[min_requirements] = pipeline.analyze_patterns(
+                    PurchasePatternAnalyzer(min_requirements=min_requirements)
+                )
+        else:
+            # One remote fetch and one statistics table at the smallest threshold serve the whole grid
+            patterns = rq.get_purchase_patterns(min_requirements=self.grid[0])["patterns"]
+            with metrics.stage("analyze"):
+                stats = analysis_pool.pattern_stats(patterns, generated_at)
+            for min_requirements in self.grid:
+                analyzed_by_min[min_requirements] = [
+                    (patterns.info(i), analysis) for i, analysis in stats.actionable(min_requirements, generated_at)
+                ]
+
+        return {
+            min_requirements: MaterializedPredictions(
+                min_requirements, list(pipeline.iter_candidates(analyzed, 0.0)), generated_at
+            )
+            for min_requirements, analyzed in analyzed_by_min.items()
+        }
+
+    async def refresh(self) -> Dict[str, Any]:
+        async with self._lock:
+            started = time.perf_counter()
+            try:
+                self._sets = await asyncio.to_thread(self.compute)
+                self.generation += 1
+                self.last_refresh_at = datetime.now()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+                logger.error(f"Prediction precompute failed: {e}")
+            finally:
+                self.last_refresh_ms = round((time.perf_counter() - started) * 1000, 1)
+                self.refreshed.set()
+
+        return self.stats()
+
+    def trigger(self):
+        """Wake the background loop for an immediate refresh."""
+        self._wake.set()
+
+    async def _run(self):
+        while True:
+            await self.refresh()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self._task is not None,
+            "grid": self.grid,
+            "interval_seconds": self.interval_seconds,
+            "generation": self.generation,
+            "last_refresh_at": self.last_refresh_at.isoformat() if self.last_refresh_at else None,
+            "last_refresh_ms": self.last_refresh_ms,
+            "last_error": self.last_error,
+            "sets": {m: len(s.predictions) for m, s in self._sets.items()},
+        }
+
+
+prediction_scheduler = PredictionScheduler()
@@ -1,5 +1,12 @@
-from datetime import datetime, timedelta, date
-from typing import List, Optional, Union
+from datetime import datetime, timedelta, date, time
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+from core.config import PATTERN_WINDOW_DAYS
+
+# A prediction is actionable while the expected next purchase is at most this many days away or overdue
+ACTIONABLE_WINDOW_DAYS = 30
 
 
 class PurchasePatternAnalyzer:
@@ -8,6 +15,17 @@ class PurchasePatternAnalyzer:
         self.min_requirements = min_requirements
         self.confidence_threshold = confidence_threshold
 
+    @staticmethod
+    def _pattern_consistency(cv: float) -> str:
+        if cv < 0.2:
+            return "highly_regular"
+        elif cv < 0.4:
+            return "regular"
+        elif cv < 0.6:
+            return "somewhat_regular"
+        else:
+            return "irregular"
+
     def analyze_client_product_pattern(
             self,
             order_dates: List[Union[datetime, date]],
@@ -20,7 +38,7 @@ class PurchasePatternAnalyzer:
             for d in order_dates
         ]
 
-        cutoff = datetime.now() - timedelta(days=365)  # 12 months
+        cutoff = datetime.now() - timedelta(days=PATTERN_WINDOW_DAYS)  # 12 months
 
         filtered_dates = []
         filtered_amounts = []
@@ -56,36 +74,55 @@ class PurchasePatternAnalyzer:
 
         avg_cycle = sum(cycles) / len(cycles)
         variance = sum((c - avg_cycle) ** 2 for c in cycles) / len(cycles)
+
+        return self.analyze_summary(
+            requirement_count=len(dates),
+            last_date=dates[-1],
+            avg_cycle=avg_cycle,
+            variance=variance,
+            recent_amounts=qtys[-3:],
+        )
+
+    def analyze_summary(
+            self,
+            requirement_count: int,
+            last_date: Union[datetime, date],
+            avg_cycle: float,
+            variance: float,
+            recent_amounts: List[float],
+            now: Optional[datetime] = None,
+    ) -> Optional[dict]:
+        """
+        Finish the analysis from already aggregated interval statistics
+        (count, last date, mean/variance of positive intervals, last <= 3 amounts).
+        """
+        if requirement_count < self.min_requirements or not recent_amounts:
+            return None
+
+        now = now or datetime.now()
+
         std_dev = variance ** 0.5
 
         # Coefficient of variation (lower = more consistent)
         cv = std_dev / avg_cycle if avg_cycle > 0 else 1
         confidence = max(0, min(1, 1 - cv))
 
-        last_order_date = dates[-1]
-        days_since = (datetime.now() - last_order_date).days
+        last_order_date = datetime.combine(last_date, time.min)
+        days_since = (now - last_order_date).days
 
         # Predict next purchase date
         expected_next_order_date = last_order_date + timedelta(days=int(avg_cycle))
-        days_until_expected = (expected_next_order_date - datetime.now()).days
+        days_until_expected = (expected_next_order_date - now).days
 
         # Only return predictions that are actionable (within next 30 days or overdue)
-        if days_until_expected < -30 or days_until_expected > 30:
+        if days_until_expected < -ACTIONABLE_WINDOW_DAYS or days_until_expected > ACTIONABLE_WINDOW_DAYS:
             return None
 
         # Predict quantity
-        recent_qtys = qtys[-3:]
-        predicted_qty = sum(recent_qtys) / len(recent_qtys)
+        predicted_qty = sum(recent_amounts) / len(recent_amounts)
 
         # Determine pattern consistency
-        if cv < 0.2:
-            pattern_consistency = "highly_regular"
-        elif cv < 0.4:
-            pattern_consistency = "regular"
-        elif cv < 0.6:
-            pattern_consistency = "somewhat_regular"
-        else:
-            pattern_consistency = "irregular"
+        pattern_consistency = self._pattern_consistency(cv)
 
         return {
             "last_requirement_date": last_order_date.date(),
@@ -96,6 +133,186 @@ class PurchasePatternAnalyzer:
             "cycle_variance": round(variance, 1),
             "confidence_score": round(confidence, 2),
             "predicted_amount": round(predicted_qty, 2),
-            "requirement_count": len(dates),
+            "requirement_count": requirement_count,
             "pattern_consistency": pattern_consistency,
         }
+
+    def pattern_stats(
+            self,
+            offsets: np.ndarray,
+            days: np.ndarray,
+            amounts: np.ndarray,
+            now: Optional[datetime] = None,
+    ) -> "PatternStats":
+        """
+        Per-pattern interval statistics in the layout analyze_many takes. Nothing here
+        depends on min_requirements, confidence_threshold or the actionability window,
+        so one table serves every threshold for as long as the data and the day stay the same.
+        """
+        now = now or datetime.now()
+        n = max(len(offsets) - 1, 0)
+        cutoff_day, _ = _day_bounds(now)
+
+        group = np.repeat(np.arange(n), np.diff(offsets))
+        days = np.asarray(days, dtype=np.int64)
+        amounts = np.asarray(amounts, dtype=np.float64)
+
+        keep = days >= cutoff_day
+        group, days, amounts = group[keep], days[keep], amounts[keep]
+
+        # Same order as sorted(zip(dates, amounts)) within each pattern
+        order = np.lexsort((amounts, days, group))
+        group, days, amounts = group[order], days[order], amounts[order]
+
+        kept = np.bincount(group, minlength=n)
+        ends = np.cumsum(kept) - 1
+
+        diffs = np.diff(days)
+        is_cycle = (group[1:] == group[:-1]) & (diffs > 0)
+        cycle_group = group[1:][is_cycle]
+        cycles = diffs[is_cycle].astype(np.float64)
+
+        cycle_count = np.bincount(cycle_group, minlength=n)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            avg_cycle = np.bincount(cycle_group, weights=cycles, minlength=n) / cycle_count
+            variance = np.bincount(
+                cycle_group, weights=(cycles - avg_cycle[cycle_group]) ** 2, minlength=n
+            ) / cycle_count
+
+        has_rows = np.flatnonzero(kept > 0)
+        last_day = np.zeros(n, dtype=np.int64)
+        predicted_qty = np.full(n, np.nan)
+
+        end = ends[has_rows]
+        count = kept[has_rows]
+        last_day[has_rows] = days[end]
+        # Trailing-3 mean, summed in the same order as sum(qtys[-3:])
+        third = np.where(count >= 3, amounts[np.maximum(end - 2, 0)], 0.0)
+        second = np.where(count >= 2, amounts[np.maximum(end - 1, 0)], 0.0)
+        predicted_qty[has_rows] = (third + second + amounts[end]) / np.minimum(count, 3)
+
+        return PatternStats(kept, cycle_count, last_day, avg_cycle, variance, predicted_qty, cutoff_day)
+
+    def analyze_many(
+            self,
+            offsets: np.ndarray,
+            days: np.ndarray,
+            amounts: np.ndarray,
+            now: Optional[datetime] = None,
+    ) -> List[Optional[dict]]:
+        """
+        Vectorized analyze_client_product_pattern over many patterns at once.
+        Pattern i owns days[offsets[i]:offsets[i + 1]] (date ordinals) and the same slice of amounts.
+        Returns one result (or None) per pattern, using a single "now" for the whole batch.
+        """
+        now = now or datetime.now()
+        return self.pattern_stats(offsets, days, amounts, now).analyses(self.min_requirements, now)
+
+
+def _day_bounds(now: datetime) -> Tuple[int, int]:
+    """(first day ordinal inside the window, 1 once now is past midnight)."""
+    # A midnight date passes "d >= now - 365 days" only from this ordinal on
+    cutoff = now - timedelta(days=PATTERN_WINDOW_DAYS)
+    cutoff_day = cutoff.toordinal() + (cutoff.time() != time.min)
+    # (midnight - now).days floors, so it is one less once now is past midnight
+    return cutoff_day, int(now.time() != time.min)
+
+
+class PatternStats:
+    """
+    Threshold-independent statistics of a PatternSet, one entry per pattern:
+    purchases inside the window, positive intervals, last purchase day,
+    interval mean / variance and the trailing-3 mean amount.
+
+    actionable() turns them into analyses for a min_requirements and a "now";
+    that only touches the patterns that pass, so sweeping thresholds is cheap.
+    The table is valid while now falls on a day with the same window cutoff.
+    """
+
+    def __init__(self, kept: np.ndarray, cycle_count: np.ndarray, last_day: np.ndarray,
+                 avg_cycle: np.ndarray, variance: np.ndarray, predicted_qty: np.ndarray, cutoff_day: int):
+        self.kept = kept
+        self.cycle_count = cycle_count
+        self.last_day = last_day
+        self.avg_cycle = avg_cycle
+        self.variance = variance
+        self.predicted_qty = predicted_qty
+        self.cutoff_day = cutoff_day
+
+    def __len__(self) -> int:
+        return len(self.kept)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in (self.kept, self.cycle_count, self.last_day,
+                                      self.avg_cycle, self.variance, self.predicted_qty))
+
+    def valid_for(self, now: datetime) -> bool:
+        return _day_bounds(now)[0] == self.cutoff_day
+
+    @classmethod
+    def merge(cls, n: int, parts: List[Tuple[np.ndarray, "PatternStats"]]) -> "PatternStats":
+        """One table of n patterns from (original indices, stats) shards."""
+        kept = np.zeros(n, dtype=np.int64)
+        cycle_count = np.zeros(n, dtype=np.int64)
+        last_day = np.zeros(n, dtype=np.int64)
+        avg_cycle = np.full(n, np.nan)
+        variance = np.full(n, np.nan)
+        predicted_qty = np.full(n, np.nan)
+        cutoff_day = None
+
+        for indices, part in parts:
+            kept[indices] = part.kept
+            cycle_count[indices] = part.cycle_count
+            last_day[indices] = part.last_day
+            avg_cycle[indices] = part.avg_cycle
+            variance[indices] = part.variance
+            predicted_qty[indices] = part.predicted_qty
+            cutoff_day = part.cutoff_day
+
+        return cls(kept, cycle_count, last_day, avg_cycle, variance, predicted_qty, cutoff_day)
+
+    def actionable(self, min_requirements: int, now: Optional[datetime] = None) -> List[Tuple[int, dict]]:
+        """(pattern index, analysis) for patterns with an analysis, in pattern order."""
+        now = now or datetime.now()
+        today = now.toordinal()
+        _, past_midnight = _day_bounds(now)
+
+        idx = np.flatnonzero((self.kept >= min_requirements) & (self.cycle_count > 0))
+        last_day = self.last_day[idx]
+        next_day = last_day + np.floor(self.avg_cycle[idx]).astype(np.int64)
+        days_until = next_day - today - past_midnight
+
+        actionable = (days_until >= -ACTIONABLE_WINDOW_DAYS) & (days_until <= ACTIONABLE_WINDOW_DAYS)
+        idx, last_day, next_day = idx[actionable], last_day[actionable], next_day[actionable]
+
+        results = []
+        for i, last, nxt, k, qty, avg, var in zip(
+                idx.tolist(), last_day.tolist(), next_day.tolist(), self.kept[idx].tolist(),
+                self.predicted_qty[idx].tolist(), self.avg_cycle[idx].tolist(), self.variance[idx].tolist()
+        ):
+            std_dev = var ** 0.5
+            cv = std_dev / avg if avg > 0 else 1
+            confidence = max(0, min(1, 1 - cv))
+
+            results.append((i, {
+                "last_requirement_date": date.fromordinal(last),
+                "days_since_last_requirement": today - last,
+                "predicted_next_purchase_date": date.fromordinal(nxt),
+                "average_cycle_days": round(avg, 1),
+                "avg_interval_days": round(avg, 1),
+                "cycle_variance": round(var, 1),
+                "confidence_score": round(confidence, 2),
+                "predicted_amount": round(qty, 2),
+                "requirement_count": k,
+                "pattern_consistency": PurchasePatternAnalyzer._pattern_consistency(cv),
+            }))
+
+        return results
+
+    def analyses(self, min_requirements: int, now: Optional[datetime] = None) -> List[Optional[dict]]:
+        """One result (or None) per pattern, as analyze_many returns them."""
+        results: List[Optional[dict]] = [None] * len(self)
+        for i, analysis in self.actionable(min_requirements, now):
+            results[i] = analysis
+        return results
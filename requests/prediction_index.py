@@ -0,0 +1,74 @@
+import bisect
+from collections import defaultdict
+from datetime import date
+from typing import Dict, Iterable, List, Optional
+
+from models.schemas.schemas import PredictionSchema
+
+
+class PredictionIndex:
+    """
+    Lookup structures over one prediction set (no confidence filter applied):
+    hash indexes by client, goods and agent, plus the set ordered by
+    predicted_next_purchase_date for due-date range queries.
+    Every lookup touches only the predictions it returns.
+    """
+
+    def __init__(self, predictions: Iterable[PredictionSchema]):
+        # Most overdue first, same order as the main endpoint
+        self.predictions: List[PredictionSchema] = sorted(
+            predictions, key=lambda p: (-p.days_since_last_requirement, p.client_id, p.goods_id)
+        )
+
+        self._by_client: Dict[int, List[int]] = defaultdict(list)
+        self._by_goods: Dict[int, List[int]] = defaultdict(list)
+        self._by_agent: Dict[int, List[int]] = defaultdict(list)
+        for i, prediction in enumerate(self.predictions):
+            self._by_client[prediction.client_id].append(i)
+            self._by_goods[prediction.goods_id].append(i)
+            self._by_agent[prediction.agent_id].append(i)
+
+        by_due = sorted(range(len(self.predictions)),
+                        key=lambda i: (self.predictions[i].predicted_next_purchase_date, i))
+        self._due_positions = by_due
+        self._due_dates = [self.predictions[i].predicted_next_purchase_date for i in by_due]
+
+    def __len__(self) -> int:
+        return len(self.predictions)
+
+    def _select(self, positions: Iterable[int], confidence_threshold: float) -> List[PredictionSchema]:
+        predictions = self.predictions
+        return [predictions[i] for i in positions if predictions[i].confidence_score >= confidence_threshold]
+
+    def by_client(self, client_id: int, confidence_threshold: float = 0.0) -> List[PredictionSchema]:
+        return self._select(self._by_client.get(client_id, ()), confidence_threshold)
+
+    def by_pair(self, client_id: int, goods_id: int, confidence_threshold: float = 0.0) -> List[PredictionSchema]:
+        predictions = self.predictions
+        positions = (i for i in self._by_client.get(client_id, ()) if predictions[i].goods_id == goods_id)
+        return self._select(positions, confidence_threshold)
+
+    def by_goods(self, goods_id: int, confidence_threshold: float = 0.0) -> List[PredictionSchema]:
+        return self._select(self._by_goods.get(goods_id, ()), confidence_threshold)
+
+    def by_agent(self, agent_id: int, confidence_threshold: float = 0.0) -> List[PredictionSchema]:
+        return self._select(self._by_agent.get(agent_id, ()), confidence_threshold)
+
+    def due_between(
+            self,
+            start: Optional[date] = None,
+            end: Optional[date] = None,
+            confidence_threshold: float = 0.0,
+    ) -> List[PredictionSchema]:
+        """Predictions with start <= predicted_next_purchase_date <= end, earliest first."""
+        lo = bisect.bisect_left(self._due_dates, start) if start is not None else 0
+        hi = bisect.bisect_right(self._due_dates, end) if end is not None else len(self._due_dates)
+        return self._select(self._due_positions[lo:hi], confidence_threshold)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "predictions": len(self.predictions),
+            "clients": len(self._by_client),
+            "goods": len(self._by_goods),
+            "agents": len(self._by_agent),
+        }
@@ -0,0 +1,346 @@
+"""
+EXPLAIN FORMAT=JSON for every query the service issues, and the indexes they rely on.
+
+    python -m requests.query_plans           # plans, issues, missing indexes and their DDL
+    python -m requests.query_plans --json    # the same report as JSON
+    python -m requests.query_plans --ddl     # only the migration DDL
+
+Full table scans, full index scans, filesorts and temporary tables are flagged per
+query. Some of them are inherent to a query (grouping every pair needs a temporary
+table, a full reload reads every sales row) and listed in ServiceQuery.accepted;
+anything else is a plan regression and makes the command exit with status 1.
+
+The plan of every query is kept in QUERY_PLAN_HISTORY_FILE; when the next check
+gets a different plan for the same SQL (another index, a range scan turning into
+a full scan, a new filesort) the change is logged and reported under "plan_changes".
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+from datetime import datetime, timedelta
+from typing import Any, Dict, FrozenSet, Iterator, List, Optional, Tuple
+
+from core.config import PATTERN_WINDOW_DAYS, QUERY_PLAN_HISTORY_FILE
+
+logger = logging.getLogger(__name__)
+
+FULL_SCAN = "full_scan"
+FULL_INDEX_SCAN = "full_index_scan"
+FILESORT = "filesort"
+TEMPORARY = "temporary"
+
+# Aliases used in the service queries -> table
+TABLE_ALIASES = {"s": "sales", "sg": "sales_goods"}
+
+# (table, index name, columns, why)
+RECOMMENDED_INDEXES = (
+    ("sales_goods", "idx_sales_goods_sales_goods_amount", ("sales_id", "goods_id", "amount"),
+     "joins from sales and filters amount > 0 from the index alone, without reading sales_goods rows"),
+    ("sales", "idx_sales_created_client_agent", ("created_date", "client_id", "agent_id"),
+     "the pattern window and ORDER BY created_date, covering every sales column the fact queries read"),
+    ("sales", "idx_sales_client_created_agent", ("client_id", "created_date", "agent_id"),
+     "pair lookups (POST /predictions/batch, the pattern store) by client_id"),
+)
+
+INDEX_COLUMNS_QUERY = """
+    SELECT INDEX_NAME AS index_name, COLUMN_NAME AS column_name
+    FROM information_schema.STATISTICS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+    ORDER BY INDEX_NAME, SEQ_IN_INDEX
+    """
+
+# Sample pairs for the IN (...) queries, so the optimizer sees a realistic list length
+_SAMPLE_PAIRS = [(i, i) for i in range(1, 101)]
+
+
+class ServiceQuery:
+    """One query of requests.rq with representative parameters and the plan issues it is allowed."""
+
+    __slots__ = ("name", "sql", "params", "accepted")
+
+    def __init__(self, name: str, sql: str, params: tuple = (), accepted: FrozenSet[str] = frozenset()):
+        self.name = name
+        self.sql = sql
+        self.params = params
+        self.accepted = accepted
+
+
+def service_queries() -> List[ServiceQuery]:
+    from requests import rq
+
+    cutoff = datetime.now() - timedelta(days=PATTERN_WINDOW_DAYS)
+    pair_query, pair_params = next(rq.pair_fact_queries(_SAMPLE_PAIRS))
+
+    dimension_queries = []
+    for kind in rq.DIMENSION_TABLES:
+        # Warm-up reads the first max_entries rows in any order
+        dimension_queries.append(ServiceQuery(f"{kind}_names_warmup", rq.dimension_scan_query(kind),
+                                              (rq.dimension_caches[kind].max_entries,),
+                                              frozenset({FULL_SCAN, FULL_INDEX_SCAN})))
+        names_query, names_params = next(rq.dimension_lookups(kind, list(range(1, 101))))
+        dimension_queries.append(ServiceQuery(f"{kind}_names", names_query, names_params))
+
+    return [
+        # Reads every sale; walking a covering index in created_date order is the best it gets
+        ServiceQuery("purchase_facts", rq.PURCHASE_FACT_QUERY, (), frozenset({FULL_INDEX_SCAN})),
+        # Reads every sale (the agent is the oldest sale's); GROUP BY pair and ORDER BY
+        # purchase_count cannot come from an index
+        ServiceQuery("aggregated_patterns", rq.AGGREGATED_PATTERNS_QUERY, (cutoff, cutoff, 2),
+                     frozenset({FULL_INDEX_SCAN, TEMPORARY, FILESORT})),
+        # A few hundred rows per chunk of pairs, sorting them is cheap
+        ServiceQuery("pair_facts", pair_query, pair_params, frozenset({FILESORT})),
+        ServiceQuery("pairs_history", rq.pairs_history_query(len(_SAMPLE_PAIRS)),
+                     tuple(v for pair in _SAMPLE_PAIRS for v in pair), frozenset({FILESORT})),
+        # Only the sales above the watermark, sorted after the range read
+        ServiceQuery("sales_since", rq.SALES_SINCE_QUERY, (0,), frozenset({FILESORT})),
+        # Snapshot full load reads the whole table by primary key
+        ServiceQuery("sales_facts", rq.SALES_FACTS_QUERY, (0,), frozenset({FULL_INDEX_SCAN})),
+        ServiceQuery("sales_watermark", rq.SALES_WATERMARK_QUERY),
+        *dimension_queries,
+    ]
+
+
+def explain(db, sql: str, params: tuple = ()) -> Dict[str, Any]:
+    """Parsed EXPLAIN FORMAT=JSON of sql run through a RemoteMySQL."""
+    row = db.query_one("EXPLAIN FORMAT=JSON " + sql, params or None)
+    return json.loads(next(iter(row.values())))
+
+
+def _walk(node: Any) -> Iterator[Dict[str, Any]]:
+    if isinstance(node, dict):
+        yield node
+        for value in node.values():
+            yield from _walk(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from _walk(value)
+
+
+def plan_tables(plan: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Per table access of a plan: alias, access type, chosen key, rows examined per scan."""
+    return [
+        {
+            "table": node["table_name"],
+            "access_type": node.get("access_type"),
+            "key": node.get("key"),
+            "rows": node.get("rows_examined_per_scan"),
+            "using_index": bool(node.get("using_index")),
+        }
+        for node in _walk(plan)
+        if "table_name" in node
+    ]
+
+
+def plan_issues(plan: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Full scans, full index scans, filesorts and temporary tables anywhere in a plan."""
+    issues = []
+    for node in _walk(plan):
+        if "table_name" in node:
+            access_type = node.get("access_type")
+            if access_type == "ALL":
+                issues.append({"kind": FULL_SCAN, "table": node["table_name"],
+                               "rows": node.get("rows_examined_per_scan")})
+            elif access_type == "index":
+                issues.append({"kind": FULL_INDEX_SCAN, "table": node["table_name"],
+                               "key": node.get("key"), "rows": node.get("rows_examined_per_scan")})
+        if node.get("using_filesort"):
+            issues.append({"kind": FILESORT})
+        if node.get("using_temporary_table"):
+            issues.append({"kind": TEMPORARY})
+    return issues
+
+
+def plan_signature(plan: Dict[str, Any]) -> Dict[str, Any]:
+    """The parts of a plan that make it a different plan; row estimates change with the data and are left out."""
+    return {
+        "tables": [
+            {key: table[key] for key in ("table", "access_type", "key", "using_index")}
+            for table in plan_tables(plan)
+        ],
+        "operations": sorted({issue["kind"] for issue in plan_issues(plan) if issue["kind"] in (FILESORT, TEMPORARY)}),
+    }
+
+
+def _describe(signature: Dict[str, Any]) -> str:
+    tables = ", ".join(
+        f"{t['table']} {t['access_type'] or '-'}"
+        + (f" {t['key']}" if t["key"] else "")
+        + (" covering" if t["using_index"] else "")
+        for t in signature["tables"]
+    )
+    return tables + "".join(f" +{operation}" for operation in signature["operations"])
+
+
+def load_history(path: Optional[str]) -> Dict[str, Any]:
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring query plan history {path}: {e}")
+        return {}
+
+
+def save_history(path: Optional[str], history: Dict[str, Any]):
+    if not path:
+        return
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(history, f, indent=2)
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.warning(f"Could not save query plan history {path}: {e}")
+
+
+def existing_indexes(db, table: str) -> Dict[str, Tuple[str, ...]]:
+    indexes: Dict[str, List[str]] = {}
+    for row in db.query(INDEX_COLUMNS_QUERY, (table,)):
+        indexes.setdefault(row["index_name"], []).append(row["column_name"].lower())
+    return {name: tuple(columns) for name, columns in indexes.items()}
+
+
+def missing_indexes(db) -> List[Dict[str, Any]]:
+    """Recommended indexes not covered by an existing index with the same leading columns."""
+    missing = []
+    tables: Dict[str, Dict[str, Tuple[str, ...]]] = {}
+
+    for table, name, columns, reason in RECOMMENDED_INDEXES:
+        if table not in tables:
+            tables[table] = existing_indexes(db, table)
+        if not any(existing[:len(columns)] == columns for existing in tables[table].values()):
+            missing.append({"table": table, "index": name, "columns": list(columns), "reason": reason})
+    return missing
+
+
+def migration_ddl(missing: List[Dict[str, Any]]) -> List[str]:
+    """One online ALTER TABLE per table adding its missing indexes."""
+    per_table: Dict[str, List[str]] = {}
+    for index in missing:
+        per_table.setdefault(index["table"], []).append(
+            f"ADD INDEX {index['index']} ({', '.join(index['columns'])})"
+        )
+    return [
+        f"ALTER TABLE {table} {', '.join(clauses)}, ALGORITHM=INPLACE, LOCK=NONE;"
+        for table, clauses in per_table.items()
+    ]
+
+
+def check(db=None, history_file: Optional[str] = QUERY_PLAN_HISTORY_FILE) -> Dict[str, Any]:
+    """
+    EXPLAIN every service query and look up the recommended indexes. Issues a
+    query is not allowed are reported under "regressions", plans that differ from
+    the last one stored in history_file for the same SQL under "plan_changes".
+    """
+    if db is None:
+        from requests import rq
+
+        db = rq.get_db()
+
+    checked_at = datetime.now().isoformat()
+    history = load_history(history_file)
+    queries = []
+    regressions = []
+    changes = []
+    for query in service_queries():
+        plan = explain(db, query.sql, query.params)
+        issues = plan_issues(plan)
+        for issue in issues:
+            issue["accepted"] = issue["kind"] in query.accepted
+            if not issue["accepted"]:
+                regressions.append({"query": query.name, **issue})
+        queries.append({"name": query.name, "tables": plan_tables(plan), "issues": issues})
+
+        signature = plan_signature(plan)
+        sql_hash = hashlib.sha1(query.sql.encode()).hexdigest()
+        previous = history.get(query.name)
+        # A changed query text is expected to change its plan
+        if previous and previous["sql_hash"] == sql_hash and previous["plan"] != signature:
+            changes.append({"query": query.name, "before": previous["plan"], "after": signature,
+                            "since": previous["seen_at"]})
+        if not previous or previous["sql_hash"] != sql_hash or previous["plan"] != signature:
+            history[query.name] = {"sql_hash": sql_hash, "plan": signature, "seen_at": checked_at}
+
+    save_history(history_file, history)
+    missing = missing_indexes(db)
+    return {
+        "checked_at": checked_at,
+        "queries": queries,
+        "regressions": regressions,
+        "plan_changes": changes,
+        "missing_indexes": missing,
+        "ddl": migration_ddl(missing),
+    }
+
+
+def log_report(report: Dict[str, Any]):
+    """Warnings for plan regressions, plan changes and missing indexes; one info line when there are none."""
+    for issue in report["regressions"]:
+        table = issue.get("table")
+        table = f" on {table} ({TABLE_ALIASES.get(table, table)}, ~{issue.get('rows')} rows)" if table else ""
+        logger.warning(f"Query plan regression: {issue['query']} uses a {issue['kind'].replace('_', ' ')}{table}")
+    for change in report["plan_changes"]:
+        logger.warning(f"Query plan changed: {change['query']}: {_describe(change['before'])} "
+                       f"-> {_describe(change['after'])} (previous plan seen at {change['since']})")
+    for ddl in report["ddl"]:
+        logger.warning(f"Missing recommended index, run: {ddl}")
+    if not report["regressions"] and not report["plan_changes"] and not report["ddl"]:
+        logger.info(f"Query plans OK ({len(report['queries'])} queries checked)")
+
+
+def _print_report(report: Dict[str, Any]):
+    for query in report["queries"]:
+        print(query["name"])
+        for t in query["tables"]:
+            print(f"  {t['table']:<4} {t['access_type'] or '-':<8} key={t['key'] or '-':<36} rows~{t['rows']}"
+                  + ("  covering" if t["using_index"] else ""))
+        for issue in query["issues"]:
+            where = f" on {issue['table']}" if issue.get("table") else ""
+            print(f"  {'accepted' if issue['accepted'] else 'REGRESSION'}: {issue['kind']}{where}")
+
+    if report["plan_changes"]:
+        print("\nPlan changes:")
+        for change in report["plan_changes"]:
+            print(f"  {change['query']}: {_describe(change['before'])} -> {_describe(change['after'])}")
+
+    if report["missing_indexes"]:
+        print("\nMissing indexes:")
+        for index in report["missing_indexes"]:
+            print(f"  {index['table']}({', '.join(index['columns'])}): {index['reason']}")
+        print("\nMigration:")
+        for ddl in report["ddl"]:
+            print(f"  {ddl}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    parser.add_argument("--ddl", action="store_true", help="Only print the DDL for missing indexes")
+    parser.add_argument("--history", default=QUERY_PLAN_HISTORY_FILE,
+                        help="Plan history file to compare with and update (empty to skip)")
+    args = parser.parse_args(argv)
+
+    from requests import rq
+
+    db = rq.get_db()
+    try:
+        report = check(db, args.history)
+    finally:
+        db.close()
+
+    if args.ddl:
+        print("\n".join(report["ddl"]))
+    elif args.json:
+        print(json.dumps(report, indent=2, default=str))
+    else:
+        _print_report(report)
+
+    return 1 if report["regressions"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
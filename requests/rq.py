@@ -1,102 +1,460 @@
-from typing import Dict, Any, List
-from collections import defaultdict
+from typing import Dict, Any, Iterable, Iterator, List, Optional, Tuple
+import time
+import asyncio
+import threading
+from datetime import date, datetime, timedelta
 
 
-from core.remote_db import RemoteMySQL
+from core import metrics
+from core.cache import LookupCache
+from core.config import (
+    AGENT_CACHE_MAX_ENTRIES, AGENT_CACHE_TTL_SECONDS, CLIENT_CACHE_MAX_ENTRIES, CLIENT_CACHE_TTL_SECONDS,
+    GOODS_CACHE_MAX_ENTRIES, GOODS_CACHE_TTL_SECONDS, PATTERNS_AGGREGATE_IN_DB, PATTERN_WINDOW_DAYS,
+)
+from core.remote_db import AsyncRemoteMySQL, RemoteMySQL
+from requests.patterns import Names, PatternGroups, PatternSet, PatternSetBuilder
 
-db = RemoteMySQL()
+# Built from the environment by init_clients(), called from the app lifespan (or on first
+# use), so importing this module neither reads the environment nor touches the network
+db: Optional[RemoteMySQL] = None
+async_db: Optional[AsyncRemoteMySQL] = None
+_clients_lock = threading.Lock()
 
+# kind -> (table, id column, name column)
+DIMENSION_TABLES = {
+    "client": ("client", "client_id", "client_name"),
+    "agent": ("agent", "agent_id", "agent_name"),
+    "goods": ("goods", "goods_id", "goods_name"),
+}
+# Ids per "WHERE id IN (...)" lookup of missing names
+DIMENSION_LOOKUP_CHUNK = 1000
+# (client_id, goods_id) pairs per fact query of get_pair_patterns
+PAIR_LOOKUP_CHUNK = 1000
 
+# id -> name per dimension, each with its own size bound and TTL
+dimension_caches = {
+    "client": LookupCache(CLIENT_CACHE_MAX_ENTRIES, CLIENT_CACHE_TTL_SECONDS),
+    "agent": LookupCache(AGENT_CACHE_MAX_ENTRIES, AGENT_CACHE_TTL_SECONDS),
+    "goods": LookupCache(GOODS_CACHE_MAX_ENTRIES, GOODS_CACHE_TTL_SECONDS),
+}
 
-def get_purchase_patterns(
-        min_requirements: int = 3,
-) -> Dict[str, Any]:
-    """
-    Analyze purchase patterns by grouping sales by client and goods.
-    Returns patterns with dates, quantities, and related entities.
-    """
+_sales_watermark = {"value": None, "checked_at": None}
 
-    query = """
-    SELECT 
-        s.sales_id,
+
+def init_clients() -> Tuple[RemoteMySQL, AsyncRemoteMySQL]:
+    """Create the database clients once; nothing is connected until they are started or used."""
+    global db, async_db
+
+    with _clients_lock:
+        if db is None:
+            blocking = RemoteMySQL()
+            # Shares the SSH tunnel and the circuit breaker with the blocking pool
+            async_db = AsyncRemoteMySQL(tunnel=blocking.tunnel, breaker=blocking.breaker)
+            db = blocking
+    return db, async_db
+
+
+def get_db() -> RemoteMySQL:
+    return db if db is not None else init_clients()[0]
+
+
+def get_async_db() -> AsyncRemoteMySQL:
+    return async_db if async_db is not None else init_clients()[1]
+
+
+# Integer keys, date and amount only; names come from dimension_caches
+PURCHASE_FACT_COLUMNS = """
         s.client_id,
         s.created_date,
         s.agent_id,
-        c.client_name,
-        a.agent_name,
         sg.goods_id,
-        g.goods_name,
         sg.amount
     FROM sales s
     INNER JOIN sales_goods sg ON s.sales_id = sg.sales_id
-    INNER JOIN goods g ON sg.goods_id = g.goods_id
-    INNER JOIN client c ON s.client_id = c.client_id
-    INNER JOIN agent a ON s.agent_id = a.agent_id
+"""
+
+PURCHASE_FACT_QUERY = f"""
+    SELECT {PURCHASE_FACT_COLUMNS}
     WHERE sg.amount > 0
     ORDER BY s.created_date DESC
     """
 
-    results = db.query(query)
-
-    if not results:
-        return {
-            "patterns": [],
-            "total_patterns": 0,
-            "min_requirements_used": min_requirements
-        }
-
-    patterns = defaultdict(lambda: defaultdict(lambda: {
-        "dates": [],
-        "amounts": [],
-        "client_id": None,
-        "client_name": None,
-        "agent_id": None,
-        "agent_name": None,
-        "goods_id": None,
-        "goods_name": None
-    }))
-
-    for row in results:
-        client_id = row["client_id"]
-        goods_id = row["goods_id"]
-
-        pattern = patterns[client_id][goods_id]
-        pattern["dates"].append(row["created_date"])
-        pattern["amounts"].append(float(row["amount"]))
-        pattern["client_id"] = client_id
-        pattern["client_name"] = row["client_name"]
-        pattern["agent_id"] = row["agent_id"]
-        pattern["agent_name"] = row["agent_name"]
-        pattern["goods_id"] = goods_id
-        pattern["goods_name"] = row["goods_name"]
-
-    # Filter and format patterns
-    formatted_patterns = []
-
-    for client_id, goods_dict in patterns.items():
-        for goods_id, pattern in goods_dict.items():
-            purchase_count = len(pattern["dates"])
-
-            if purchase_count >= min_requirements:
-                amounts = pattern["amounts"]
-
-                formatted_patterns.append({
-                    "client_id": pattern["client_id"],
-                    "client_name": pattern["client_name"],
-                    "agent_id": pattern["agent_id"],
-                    "agent_name": pattern["agent_name"],
-                    "goods_id": pattern["goods_id"],
-                    "goods_name": pattern["goods_name"],
-                    "purchase_count": purchase_count,
-                    "dates": pattern["dates"],
-                    "amounts": amounts
-
-                })
-
-    formatted_patterns.sort(key=lambda x: x["purchase_count"], reverse=True)
+# The agent is the one of the pair's oldest sale, as on the default path, so the whole
+# history is grouped; only the purchases inside the window (cutoff passed twice) are
+# counted and shipped
+AGGREGATED_PATTERNS_QUERY = """
+    SELECT
+        s.client_id,
+        sg.goods_id,
+        CAST(SUBSTRING_INDEX(
+            GROUP_CONCAT(s.agent_id ORDER BY s.created_date, s.sales_id), ',', 1
+        ) AS UNSIGNED) AS agent_id,
+        SUM(s.created_date >= %s) AS purchase_count,
+        GROUP_CONCAT(
+            IF(s.created_date >= %s, CONCAT(DATE(s.created_date), ':', sg.amount), NULL)
+            ORDER BY s.created_date, s.sales_id SEPARATOR ','
+        ) AS history
+    FROM sales s
+    INNER JOIN sales_goods sg ON s.sales_id = sg.sales_id
+    WHERE sg.amount > 0
+    GROUP BY s.client_id, sg.goods_id
+    HAVING purchase_count >= %s
+    ORDER BY purchase_count DESC
+    """
+
+SALES_SINCE_QUERY = f"""
+    SELECT s.sales_id, {PURCHASE_FACT_COLUMNS}
+    WHERE sg.amount > 0
+      AND s.sales_id > %s
+    ORDER BY s.created_date, s.sales_id
+    """
 
+SALES_FACTS_QUERY = """
+    SELECT
+        s.sales_id,
+        s.client_id,
+        sg.goods_id,
+        s.agent_id,
+        s.created_date,
+        sg.amount
+    FROM sales s
+    INNER JOIN sales_goods sg ON s.sales_id = sg.sales_id
+    WHERE sg.amount > 0
+      AND s.sales_id > %s
+    """
+
+SALES_WATERMARK_QUERY = "SELECT MAX(sales_id) AS max_sales_id FROM sales"
+
+
+def pairs_history_query(pair_count: int) -> str:
+    placeholders = ", ".join(["(%s, %s)"] * pair_count)
+    return f"""
+    SELECT s.sales_id, {PURCHASE_FACT_COLUMNS}
+    WHERE (s.client_id, sg.goods_id) IN ({placeholders})
+      AND sg.amount > 0
+    ORDER BY s.created_date, s.sales_id
+    """
+
+
+@metrics.stage("group")
+def _parse_aggregated_rows(builder: PatternSetBuilder, rows: Iterable[Dict[str, Any]]):
+    for row in rows:
+        if not row["history"]:
+            # Nothing inside the window (only with min_requirements 0)
+            continue
+
+        days = []
+        amounts = []
+
+        for item in row["history"].split(","):
+            day, amount = item.split(":")
+            days.append(date.fromisoformat(day).toordinal())
+            amounts.append(float(amount))
+
+        builder.append(row["client_id"], row["goods_id"], row["agent_id"], days, amounts)
+
+
+def _aggregated_result(builder: PatternSetBuilder, min_requirements: int) -> Dict[str, Any]:
+    patterns = builder.build()
+    metrics.count("patterns", len(patterns))
     return {
-        "patterns": formatted_patterns,
-        "total_patterns": len(formatted_patterns),
+        "patterns": patterns,
+        "total_patterns": len(patterns),
         "min_requirements_used": min_requirements
-    }
\ No newline at end of file
+    }
+
+
+def dimension_lookups(kind: str, missing: List[int]) -> Iterator[Tuple[str, tuple]]:
+    """(query, params) per chunk of ids whose names are not cached."""
+    table, id_column, name_column = DIMENSION_TABLES[kind]
+
+    for start in range(0, len(missing), DIMENSION_LOOKUP_CHUNK):
+        chunk = tuple(missing[start:start + DIMENSION_LOOKUP_CHUNK])
+        placeholders = ", ".join(["%s"] * len(chunk))
+        query = f"SELECT {id_column} AS id, {name_column} AS name FROM {table} WHERE {id_column} IN ({placeholders})"
+        yield query, chunk
+
+
+def dimension_scan_query(kind: str) -> str:
+    """The first LIMIT rows of a dimension table, as warm_dimension_caches loads them."""
+    table, id_column, name_column = DIMENSION_TABLES[kind]
+    return f"SELECT {id_column} AS id, {name_column} AS name FROM {table} LIMIT %s"
+
+
+def resolve_names(ids: Dict[str, Iterable[int]]) -> Names:
+    """
+    id -> name maps for the given client, agent and goods ids. Cached names are
+    reused; the rest are loaded by primary key and cached. Ids that do not exist
+    in their table are left out of the result.
+    """
+
+    names: Names = {}
+    with metrics.stage("dimensions"):
+        for kind, kind_ids in ids.items():
+            cache = dimension_caches[kind]
+            found, missing = cache.get_many(int(i) for i in kind_ids)
+
+            for query, params in dimension_lookups(kind, missing):
+                loaded = {row["id"]: row["name"] for row in get_db().query(query, params)}
+                cache.set_many(loaded)
+                found.update(loaded)
+
+            names[kind] = found
+    return names
+
+
+async def resolve_names_async(ids: Dict[str, Iterable[int]]) -> Names:
+    names: Names = {}
+    with metrics.stage("dimensions"):
+        for kind, kind_ids in ids.items():
+            cache = dimension_caches[kind]
+            found, missing = cache.get_many(int(i) for i in kind_ids)
+
+            for query, params in dimension_lookups(kind, missing):
+                loaded = {row["id"]: row["name"] for row in await get_async_db().query(query, params)}
+                cache.set_many(loaded)
+                found.update(loaded)
+
+            names[kind] = found
+    return names
+
+
+def with_names(analyzed: List[Tuple[Dict[str, Any], Optional[dict]]]) -> List[Tuple[Dict[str, Any], Optional[dict]]]:
+    """
+    (pattern info, analysis) pairs whose info only carries ids, with client, agent and
+    goods names filled in through dimension_caches. Pairs with an id that has no name
+    are dropped, as PatternSet.with_names does.
+    """
+    names = resolve_names({
+        "client": {info["client_id"] for info, _ in analyzed},
+        "agent": {info["agent_id"] for info, _ in analyzed},
+        "goods": {info["goods_id"] for info, _ in analyzed},
+    })
+    clients, agents, goods = names["client"], names["agent"], names["goods"]
+
+    named = []
+    for info, analysis in analyzed:
+        client_name = clients.get(info["client_id"])
+        agent_name = agents.get(info["agent_id"])
+        goods_name = goods.get(info["goods_id"])
+        if client_name is None or agent_name is None or goods_name is None:
+            continue
+        info["client_name"], info["agent_name"], info["goods_name"] = client_name, agent_name, goods_name
+        named.append((info, analysis))
+    return named
+
+
+def warm_dimension_caches() -> Dict[str, int]:
+    """
+    Load client, agent and goods names into dimension_caches ahead of the first
+    request, up to each cache's size bound. Returns the number loaded per kind.
+    """
+    loaded = {}
+    with metrics.stage("dimensions"):
+        for kind in DIMENSION_TABLES:
+            cache = dimension_caches[kind]
+            count = 0
+            for batch in get_db().stream_batches(dimension_scan_query(kind), (cache.max_entries,)):
+                cache.set_many({row["id"]: row["name"] for row in batch})
+                count += len(batch)
+            loaded[kind] = count
+    return loaded
+
+
+def _named(result: Dict[str, Any], names: Names) -> Dict[str, Any]:
+    patterns: PatternSet = result["patterns"].with_names(names)
+    result["patterns"] = patterns
+    result["total_patterns"] = len(patterns)
+    return result
+
+
+def _window_cutoff() -> datetime:
+    # Same cutoff PurchasePatternAnalyzer applies, so nothing it would keep is dropped here
+    return datetime.now() - timedelta(days=PATTERN_WINDOW_DAYS)
+
+
+def _aggregated_params(min_requirements: int) -> tuple:
+    cutoff = _window_cutoff()
+    return cutoff, cutoff, min_requirements
+
+
+def get_purchase_patterns(
+        min_requirements: int = 3,
+        aggregate_in_db: Optional[bool] = None,
+) -> Dict[str, Any]:
+    """
+    Analyze purchase patterns by grouping sales by client and goods.
+    Returns the pairs as a PatternSet (day ordinals, amounts and related entities).
+    The fact query only carries ids; names are resolved afterwards, once per
+    distinct id, through dimension_caches.
+    """
+
+    if aggregate_in_db is None:
+        aggregate_in_db = PATTERNS_AGGREGATE_IN_DB
+
+    if aggregate_in_db:
+        return get_aggregated_purchase_patterns(min_requirements)
+
+    groups = PatternGroups()
+
+    # Rows are grouped batch by batch as they arrive; only the per-pair histories are kept
+    for batch in get_db().stream_batches(PURCHASE_FACT_QUERY):
+        groups.add_rows(batch)
+
+    result = groups.to_result(min_requirements)
+    return _named(result, resolve_names(result["patterns"].distinct_ids()))
+
+
+def get_aggregated_purchase_patterns(
+        min_requirements: int = 3,
+) -> Dict[str, Any]:
+    """
+    Same result shape as get_purchase_patterns, but grouping, the 12-month window
+    and the min_requirements filter run in MySQL. Each pair arrives as one row
+    with its history packed as "date:amount,date:amount,..." in date order.
+
+    purchase_count only counts purchases inside the window. The agent is taken
+    from the oldest sale of the pair, the same one the default path reports.
+    """
+
+    builder = PatternSetBuilder()
+    # Parsed batch by batch so the packed history strings are not all held at once
+    for batch in get_db().stream_batches(AGGREGATED_PATTERNS_QUERY, _aggregated_params(min_requirements)):
+        _parse_aggregated_rows(builder, batch)
+
+    result = _aggregated_result(builder, min_requirements)
+    return _named(result, resolve_names(result["patterns"].distinct_ids()))
+
+
+async def get_purchase_patterns_async(
+        min_requirements: int = 3,
+        aggregate_in_db: Optional[bool] = None,
+) -> Dict[str, Any]:
+    """
+    get_purchase_patterns over AsyncRemoteMySQL. Each fetched batch is grouped
+    in a worker thread so the event loop stays free while rows are processed.
+    """
+
+    if aggregate_in_db is None:
+        aggregate_in_db = PATTERNS_AGGREGATE_IN_DB
+
+    if aggregate_in_db:
+        builder = PatternSetBuilder()
+        async for batch in get_async_db().stream_batches(
+                AGGREGATED_PATTERNS_QUERY, _aggregated_params(min_requirements)
+        ):
+            await asyncio.to_thread(_parse_aggregated_rows, builder, batch)
+        result = _aggregated_result(builder, min_requirements)
+    else:
+        groups = PatternGroups()
+
+        async for batch in get_async_db().stream_batches(PURCHASE_FACT_QUERY):
+            await asyncio.to_thread(groups.add_rows, batch)
+
+        result = await asyncio.to_thread(groups.to_result, min_requirements)
+
+    names = await resolve_names_async(result["patterns"].distinct_ids())
+    return await asyncio.to_thread(_named, result, names)
+
+
+def pair_fact_queries(pairs: Iterable[Tuple[int, int]]) -> Iterator[Tuple[str, tuple]]:
+    """(query, params) per chunk of distinct pairs, rows in PURCHASE_FACT_QUERY order."""
+    pairs = sorted(set(pairs))
+
+    for start in range(0, len(pairs), PAIR_LOOKUP_CHUNK):
+        chunk = pairs[start:start + PAIR_LOOKUP_CHUNK]
+        placeholders = ", ".join(["(%s, %s)"] * len(chunk))
+        query = f"""
+    SELECT {PURCHASE_FACT_COLUMNS}
+    WHERE (s.client_id, sg.goods_id) IN ({placeholders})
+      AND sg.amount > 0
+    ORDER BY s.created_date DESC
+    """
+        yield query, tuple(v for pair in chunk for v in pair)
+
+
+def get_pair_patterns(pairs: Iterable[Tuple[int, int]], min_requirements: int = 3) -> Dict[str, Any]:
+    """
+    get_purchase_patterns restricted to the given (client_id, goods_id) pairs.
+    Only their rows are fetched, so the cost follows the number of pairs, not
+    the size of the sales history. Pairs without enough purchases are left out.
+    """
+
+    groups = PatternGroups()
+    for query, params in pair_fact_queries(pairs):
+        for batch in get_db().stream_batches(query, params):
+            groups.add_rows(batch)
+
+    result = groups.to_result(min_requirements)
+    return _named(result, resolve_names(result["patterns"].distinct_ids()))
+
+
+async def get_pair_patterns_async(pairs: Iterable[Tuple[int, int]], min_requirements: int = 3) -> Dict[str, Any]:
+    groups = PatternGroups()
+    for query, params in pair_fact_queries(pairs):
+        async for batch in get_async_db().stream_batches(query, params):
+            await asyncio.to_thread(groups.add_rows, batch)
+
+    result = await asyncio.to_thread(groups.to_result, min_requirements)
+    names = await resolve_names_async(result["patterns"].distinct_ids())
+    return await asyncio.to_thread(_named, result, names)
+
+
+def get_sales_since(after_sales_id: int) -> Iterator[Dict[str, Any]]:
+    """
+    Stream sales rows (ids, date, amount) with sales_id above the watermark, oldest first.
+    """
+
+    return get_db().stream(SALES_SINCE_QUERY, (after_sales_id,))
+
+
+def get_pairs_history(pairs: List[Tuple[int, int]]) -> Iterator[Dict[str, Any]]:
+    """
+    Stream the full history (ids, date, amount) of the given (client_id, goods_id) pairs, oldest first.
+    """
+
+    if not pairs:
+        return iter(())
+
+    params = tuple(v for pair in pairs for v in pair)
+    return get_db().stream(pairs_history_query(len(pairs)), params)
+
+
+def get_sales_facts(after_sales_id: int = 0) -> Iterator[Dict[str, Any]]:
+    """
+    Stream the sales fact columns (integer keys, date, amount) without joining names.
+    """
+
+    return get_db().stream(SALES_FACTS_QUERY, (after_sales_id,))
+
+
+def _remember_watermark(row: Optional[Dict[str, Any]]) -> Optional[int]:
+    value = row["max_sales_id"] if row else None
+
+    _sales_watermark["value"] = value
+    _sales_watermark["checked_at"] = time.monotonic()
+    return value
+
+
+def _fresh_watermark(max_age: float) -> bool:
+    checked_at = _sales_watermark["checked_at"]
+    return checked_at is not None and time.monotonic() - checked_at <= max_age
+
+
+def get_sales_watermark(max_age: float = 0.0) -> Optional[int]:
+    """
+    MAX(sales_id) of the sales table; changes whenever a new sale lands.
+    A value fetched less than max_age seconds ago is reused.
+    """
+
+    if _fresh_watermark(max_age):
+        return _sales_watermark["value"]
+
+    return _remember_watermark(get_db().query_one(SALES_WATERMARK_QUERY))
+
+
+async def get_sales_watermark_async(max_age: float = 0.0) -> Optional[int]:
+    if _fresh_watermark(max_age):
+        return _sales_watermark["value"]
+
+    return _remember_watermark(await get_async_db().query_one(SALES_WATERMARK_QUERY))
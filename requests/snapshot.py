@@ -0,0 +1,285 @@
+import os
+import json
+import time
+import shutil
+import threading
+from array import array
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+import requests.rq as rq
+from core.config import SNAPSHOT_DIR, SNAPSHOT_FULL_REBUILD_SECONDS
+from requests.patterns import PAIR_KEY_SHIFT
+from requests.prediction import PurchasePatternAnalyzer
+
+# Row columns, sorted by (client_id, goods_id, day, sales_id)
+COLUMNS = {
+    "client_id": np.int64,
+    "goods_id": np.int64,
+    "agent_id": np.int64,
+    "sales_id": np.int64,
+    "day": np.int64,  # date ordinal
+    "amount": np.float64,
+}
+# One entry per (client, goods) pair; pair i owns rows pair_offsets[i]:pair_offsets[i + 1]
+PAIR_COLUMNS = ("pair_client_id", "pair_goods_id", "pair_offsets")
+# Bumped when the files change; a snapshot in another format is rebuilt instead of opened
+FORMAT = 3
+# Row order inside a pair: day << ROW_KEY_SHIFT | sales_id
+ROW_KEY_SHIFT = 43
+
+
+def _fetch_columns(after_sales_id: int) -> Tuple[Dict[str, np.ndarray], int]:
+    """Stream fact rows past the watermark into compact arrays."""
+    buffers = {
+        "client_id": array("q"),
+        "goods_id": array("q"),
+        "agent_id": array("q"),
+        "sales_id": array("q"),
+        "day": array("q"),
+        "amount": array("d"),
+    }
+    max_sales_id = after_sales_id
+
+    for row in rq.get_sales_facts(after_sales_id):
+        buffers["client_id"].append(row["client_id"])
+        buffers["goods_id"].append(row["goods_id"])
+        buffers["agent_id"].append(row["agent_id"])
+        buffers["sales_id"].append(row["sales_id"])
+        buffers["day"].append(row["created_date"].toordinal())
+        buffers["amount"].append(float(row["amount"]))
+        if row["sales_id"] > max_sales_id:
+            max_sales_id = row["sales_id"]
+
+    columns = {name: np.frombuffer(buf, dtype=COLUMNS[name]) if len(buf) else np.empty(0, COLUMNS[name])
+               for name, buf in buffers.items()}
+    return columns, max_sales_id
+
+
+def _sort(columns: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    order = np.lexsort((columns["sales_id"], columns["day"], columns["goods_id"], columns["client_id"]))
+    return {name: values[order] for name, values in columns.items()}
+
+
+def _index(columns: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """Pair columns of rows that are already sorted; one linear pass."""
+    columns = {name: columns[name] for name in COLUMNS}
+    client_id, goods_id = columns["client_id"], columns["goods_id"]
+    starts = np.flatnonzero(
+        np.concatenate(([True], (client_id[1:] != client_id[:-1]) | (goods_id[1:] != goods_id[:-1])))
+    ) if len(client_id) else np.empty(0, np.int64)
+
+    columns["pair_client_id"] = client_id[starts]
+    columns["pair_goods_id"] = goods_id[starts]
+    columns["pair_offsets"] = np.append(starts, len(client_id)).astype(np.int64)
+    return columns
+
+
+def _merge(data: Dict[str, np.ndarray], delta: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """
+    Insert the (few) delta rows into the sorted snapshot rows. Only the delta is
+    sorted; each row's position is a binary search in the pair index and then in its
+    pair's rows, so the old rows are copied once and never re-sorted.
+    """
+    delta = _sort(delta)
+    offsets = data["pair_offsets"]
+    pair_keys = data["pair_client_id"] << PAIR_KEY_SHIFT | data["pair_goods_id"]
+    delta_pairs = delta["client_id"] << PAIR_KEY_SHIFT | delta["goods_id"]
+    delta_rows = delta["day"] << ROW_KEY_SHIFT | delta["sales_id"]
+
+    pair = np.searchsorted(pair_keys, delta_pairs)
+    positions = offsets[pair]
+    known = np.flatnonzero(pair < len(pair_keys))
+    known = known[pair_keys[pair[known]] == delta_pairs[known]]
+
+    day, sales_id = data["day"], data["sales_id"]
+    for i in known.tolist():
+        start, end = offsets[pair[i]], offsets[pair[i] + 1]
+        rows = day[start:end] << ROW_KEY_SHIFT | sales_id[start:end]
+        positions[i] = start + np.searchsorted(rows, delta_rows[i], side="right")
+
+    return _index({name: np.insert(data[name], positions, delta[name]) for name in COLUMNS})
+
+
+class SalesSnapshot:
+    """
+    Columnar copy of the sales facts on local disk, opened with np.load(mmap_mode="r").
+
+    Every build writes a new generation directory and then switches the CURRENT
+    pointer, so readers keep using the previous files until the new set is complete.
+    refresh() merges only the sales past the sales_id watermark into the sorted rows;
+    a periodic full build picks up backdated or edited rows the watermark misses.
+    """
+
+    def __init__(self, path: str = SNAPSHOT_DIR, full_rebuild_seconds: int = SNAPSHOT_FULL_REBUILD_SECONDS):
+        self.path = path
+        self.full_rebuild_seconds = full_rebuild_seconds
+        self._lock = threading.Lock()
+        self._data: Optional[Dict[str, np.ndarray]] = None
+        self.meta: Dict[str, Any] = {}
+
+    # ---------- files ----------
+
+    def _current_dir(self) -> Optional[str]:
+        try:
+            with open(os.path.join(self.path, "CURRENT")) as f:
+                return os.path.join(self.path, f.read().strip())
+        except FileNotFoundError:
+            return None
+
+    def _write(self, columns: Dict[str, np.ndarray], meta: Dict[str, Any]):
+        generation = f"gen-{int(time.time() * 1000)}"
+        target = os.path.join(self.path, generation)
+        os.makedirs(target, exist_ok=True)
+
+        for name, values in columns.items():
+            np.save(os.path.join(target, f"{name}.npy"), values)
+
+        with open(os.path.join(target, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        previous = self._current_dir()
+
+        pointer = os.path.join(self.path, "CURRENT.tmp")
+        with open(pointer, "w") as f:
+            f.write(generation)
+        os.replace(pointer, os.path.join(self.path, "CURRENT"))
+
+        self._open(target)
+
+        if previous and previous != target:
+            # Open mmaps of the old generation stay valid on POSIX after unlinking
+            shutil.rmtree(previous, ignore_errors=True)
+
+    def _open(self, directory: str):
+        data = {
+            name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+            for name in (*COLUMNS, *PAIR_COLUMNS)
+        }
+
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+
+        self._data = data
+        self.meta = meta
+
+    # ---------- lifecycle ----------
+
+    def load(self) -> bool:
+        """Open the snapshot already on disk, if any and in the current format."""
+        with self._lock:
+            directory = self._current_dir()
+            if directory is None or not os.path.isdir(directory):
+                return False
+            with open(os.path.join(directory, "meta.json")) as f:
+                if json.load(f).get("format") != FORMAT:
+                    return False
+            self._open(directory)
+            return True
+
+    @property
+    def loaded(self) -> bool:
+        return self._data is not None
+
+    def build(self) -> Dict[str, Any]:
+        """Export the full fact table from the remote database."""
+        with self._lock:
+            started = time.perf_counter()
+            columns, max_sales_id = _fetch_columns(0)
+            columns = _index(_sort(columns))
+
+            now = datetime.now().isoformat()
+            meta = {
+                "format": FORMAT,
+                "max_sales_id": max_sales_id,
+                "rows": int(len(columns["day"])),
+                "pairs": int(len(columns["pair_client_id"])),
+                "built_at": now,
+                "full_built_at": now,
+            }
+            self._write(columns, meta)
+            return {**meta, "full_build": True, "duration_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+    def _rebuild_due(self) -> bool:
+        built = datetime.fromisoformat(self.meta["full_built_at"])
+        return (datetime.now() - built).total_seconds() > self.full_rebuild_seconds
+
+    def refresh(self) -> Dict[str, Any]:
+        """
+        Merge sales past max_sales_id into the snapshot. Builds from scratch when there
+        is no snapshot yet or the last full build is older than full_rebuild_seconds.
+        """
+        if (not self.loaded and not self.load()) or self._rebuild_due():
+            return self.build()
+
+        with self._lock:
+            started = time.perf_counter()
+            delta, max_sales_id = _fetch_columns(self.meta["max_sales_id"])
+            rows_added = int(len(delta["day"]))
+
+            if rows_added == 0:
+                return {**self.meta, "rows_added": 0,
+                        "duration_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+            columns = _merge(self._data, delta)
+
+            meta = {
+                **self.meta,
+                "max_sales_id": max_sales_id,
+                "rows": int(len(columns["day"])),
+                "pairs": int(len(columns["pair_client_id"])),
+                "built_at": datetime.now().isoformat(),
+            }
+            self._write(columns, meta)
+            return {**meta, "rows_added": rows_added,
+                    "duration_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+    # ---------- serving ----------
+
+    def analyze(
+            self,
+            analyzer: PurchasePatternAnalyzer,
+            now: Optional[datetime] = None,
+    ) -> List[Tuple[Dict[str, Any], Optional[dict]]]:
+        """
+        Run analyze_many straight off the mapped arrays.
+        Only actionable pairs are returned, so pattern info is built, and names are
+        resolved through rq.dimension_caches, for those alone.
+        """
+        data = self._data
+        if data is None:
+            raise RuntimeError("Sales snapshot is not loaded")
+
+        offsets = data["pair_offsets"]
+        counts = np.diff(offsets)
+
+        analyses = analyzer.analyze_many(offsets, data["day"], data["amount"], now=now)
+
+        results = []
+        # Same purchase_count >= min_requirements rule as rq.get_purchase_patterns
+        for i in np.flatnonzero(counts >= analyzer.min_requirements).tolist():
+            analysis = analyses[i]
+            if analysis is None:
+                continue
+
+            client_id = int(data["pair_client_id"][i])
+            goods_id = int(data["pair_goods_id"][i])
+            # Agent of the oldest purchase, as the request path reports it
+            agent_id = int(data["agent_id"][offsets[i]])
+
+            results.append(({
+                "client_id": client_id,
+                "agent_id": agent_id,
+                "goods_id": goods_id,
+                "purchase_count": int(counts[i]),
+            }, analysis))
+
+        return rq.with_names(results)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"loaded": self.loaded, "path": self.path, **self.meta}
+
+
+sales_snapshot = SalesSnapshot()
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import requests.rq as rq
+from core.config import PRECOMPUTE_ENABLED, WARMUP_CONNECTIONS, WARMUP_TIMEOUT_SECONDS
+from requests import pipeline
+from requests.precompute import prediction_scheduler
+
+logger = logging.getLogger(__name__)
+
+# What the default GET /predictions request asks for
+DEFAULT_MIN_REQUIREMENTS = 3
+DEFAULT_CONFIDENCE_THRESHOLD = 0.6
+
+
+async def _connect():
+    await asyncio.to_thread(rq.get_db().start, WARMUP_CONNECTIONS)
+    await rq.get_async_db().start()
+
+
+async def _dimensions() -> Dict[str, int]:
+    return await asyncio.to_thread(rq.warm_dimension_caches)
+
+
+async def _predictions() -> int:
+    if PRECOMPUTE_ENABLED:
+        # The scheduler's first refresh is already running; a second pass would only repeat it
+        await prediction_scheduler.refreshed.wait()
+        if prediction_scheduler.last_error:
+            raise RuntimeError(prediction_scheduler.last_error)
+        return prediction_scheduler.generation
+    predictions = await pipeline.build_predictions_async(DEFAULT_MIN_REQUIREMENTS, DEFAULT_CONFIDENCE_THRESHOLD)
+    return len(predictions)
+
+
+class Warmup:
+    """
+    Startup work run in the background so the first requests do not pay for it:
+    open the SSH tunnel and pool connections, load the dimension names and run one
+    prediction pass (which fills the pattern and statistics caches). GET /ready
+    answers 503 until it has finished.
+
+    A failed step is logged and reported, not fatal: the service becomes ready anyway
+    and connects on first use, the way it would with warm-up disabled.
+    """
+
+    def __init__(self, timeout_seconds: float = WARMUP_TIMEOUT_SECONDS):
+        self.timeout_seconds = timeout_seconds
+        self.steps: List[Tuple[str, Callable[[], Awaitable[Any]]]] = [
+            ("connections", _connect),
+            ("dimensions", _dimensions),
+            ("predictions", _predictions),
+        ]
+
+        self._task: Optional[asyncio.Task] = None
+        self.results: Dict[str, Dict[str, Any]] = {}
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+        self.enabled = True
+
+    @property
+    def ready(self) -> bool:
+        return self.finished_at is not None
+
+    @property
+    def ok(self) -> bool:
+        return self.ready and self.enabled and all(result["ok"] for result in self.results.values())
+
+    async def _step(self, name: str, fn: Callable[[], Awaitable[Any]]):
+        started = time.perf_counter()
+        result: Dict[str, Any] = {"ok": False}
+        self.results[name] = result
+        try:
+            value = await fn()
+            result["ok"] = True
+            if value is not None:
+                result["result"] = value
+        except Exception as e:
+            result["error"] = repr(e)
+            logger.error(f"Warm-up step {name} failed: {e!r}")
+        finally:
+            result["ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+    async def _run_steps(self):
+        for name, fn in self.steps:
+            await self._step(name, fn)
+            if name == "connections" and not self.results[name]["ok"]:
+                # Every later step needs the database
+                break
+
+    async def run(self):
+        self.started_at = datetime.now()
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._run_steps(), self.timeout_seconds)
+        except asyncio.TimeoutError:
+            for result in self.results.values():
+                if not result["ok"] and "error" not in result:
+                    result["error"] = f"timed out after {self.timeout_seconds:g}s"
+            logger.error(f"Warm-up timed out after {self.timeout_seconds:g}s")
+        finally:
+            self.finished_at = datetime.now()
+            self._task = None
+
+        elapsed = time.perf_counter() - started
+        if self.ok:
+            logger.info(f"Warm-up finished in {elapsed:.1f}s")
+        else:
+            logger.warning(f"Warm-up finished in {elapsed:.1f}s with failures, serving cold")
+
+    def start(self):
+        if self._task is None and not self.ready:
+            self._task = asyncio.create_task(self.run())
+
+    def skip(self):
+        """Ready at once, everything connects on first use."""
+        self.enabled = False
+        self.finished_at = datetime.now()
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "warm": self.ok,
+            "enabled": self.enabled,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "steps": {name: dict(result) for name, result in self.results.items()},
+        }
+
+
+warmup = Warmup()
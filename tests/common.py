@@ -0,0 +1,74 @@
+import random
+from datetime import datetime, timedelta
+
+import requests.rq as rq
+from requests.patterns import PatternGroups
+from requests.prediction import PurchasePatternAnalyzer
+
+
+def sales_rows(seed: int, now: datetime, midnight: bool = False):
+    """
+    One row per sale, sales_id unrelated to created_date (backdated inserts), with days
+    outside the window, repeated days and pairs with few purchases.
+    """
+    rng = random.Random(seed)
+    rows = []
+    for client_id in range(1, 61):
+        for goods_id in range(1, 9):
+            cycle = rng.choice([7, 14, 30, 45, 120, 150])
+            start = rng.randint(0, 450)
+            for i in range(rng.randint(0, 12)):
+                offset = start - i * (cycle + rng.randint(-3, 3)) + rng.choice([0, 0, 0, 1])
+                if offset < 0:
+                    break
+                created = (now - timedelta(days=offset)).replace(hour=rng.randint(0, 23), minute=rng.randint(0, 59))
+                if midnight:
+                    created = created.replace(hour=0, minute=0, second=0, microsecond=0)
+                agent_id = rng.randint(1, 5)
+                rows.append({
+                    "client_id": client_id, "client_name": f"Client {client_id}",
+                    "goods_id": goods_id, "goods_name": f"Goods {goods_id}",
+                    "agent_id": agent_id, "agent_name": f"Agent {agent_id}",
+                    "created_date": created, "amount": float(rng.choice([1, 2, 5, 10, 34])),
+                })
+    rng.shuffle(rows)
+    for sales_id, row in enumerate(rows, 1):
+        row["sales_id"] = sales_id
+    return rows
+
+
+class NamesDatabase:
+    """RemoteMySQL answering rq's dimension lookups: every id exists, named the way sales_rows names it."""
+
+    def query(self, query, params):
+        kind = next(kind for kind, (table, _, _) in rq.DIMENSION_TABLES.items() if f" FROM {table} " in query)
+        return [{"id": i, "name": f"{kind.title()} {i}"} for i in params]
+
+
+def serve_names(monkeypatch, database: NamesDatabase):
+    """rq.get_db() returns database, with the dimension caches emptied first."""
+    monkeypatch.setattr(rq, "get_db", lambda: database)
+    for cache in rq.dimension_caches.values():
+        cache.clear()
+
+
+def scalar_predictions(rows, analyzer: PurchasePatternAnalyzer):
+    """
+    (pattern info, analysis) per pair from the default request path: rows in
+    PURCHASE_FACT_QUERY order (ties by sales_id), grouped, analyzed one pattern at a time.
+    """
+    groups = PatternGroups()
+    groups.add_rows(sorted(rows, key=lambda r: (r["created_date"], r["sales_id"]), reverse=True))
+    names = {
+        "client": {r["client_id"]: r["client_name"] for r in rows},
+        "agent": {r["agent_id"]: r["agent_name"] for r in rows},
+        "goods": {r["goods_id"]: r["goods_name"] for r in rows},
+    }
+    patterns = groups.to_result(analyzer.min_requirements)["patterns"].with_names(names)
+
+    results = {}
+    for i, pattern in enumerate(patterns):
+        analysis = analyzer.analyze_client_product_pattern(pattern.dates, pattern.amounts.tolist())
+        if analysis is not None:
+            results[(pattern.client_id, pattern.goods_id)] = (patterns.info(i), analysis)
+    return results
@@ -0,0 +1,136 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import requests.rq as rq
+from common import NamesDatabase, sales_rows, scalar_predictions, serve_names
+from requests.pattern_store import IncrementalPatternStore, PairStats
+from requests.prediction import PurchasePatternAnalyzer
+
+FACT_COLUMNS = ("sales_id", "client_id", "created_date", "agent_id", "goods_id", "amount")
+
+
+def _stored(store: IncrementalPatternStore, analyzer: PurchasePatternAnalyzer, now: datetime):
+    return {
+        (info["client_id"], info["goods_id"]): (info, analysis)
+        for info, analysis in store.analyze(analyzer, now)
+        if analysis is not None
+    }
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """rq's pattern store queries served from a list of rows."""
+    rows = []
+    serve_names(monkeypatch, NamesDatabase())
+
+    def facts(selected):
+        # The columns SALES_SINCE_QUERY and pairs_history_query return: no names
+        return iter([{column: r[column] for column in FACT_COLUMNS}
+                     for r in sorted(selected, key=lambda r: (r["created_date"], r["sales_id"]))])
+
+    def get_sales_since(after_sales_id):
+        return facts(r for r in rows if r["sales_id"] > after_sales_id)
+
+    def get_pairs_history(pairs):
+        wanted = set(pairs)
+        return facts(r for r in rows if (r["client_id"], r["goods_id"]) in wanted)
+
+    monkeypatch.setattr(rq, "get_sales_since", get_sales_since)
+    monkeypatch.setattr(rq, "get_pairs_history", get_pairs_history)
+    return rows
+
+
+@pytest.mark.parametrize("min_requirements", [2, 3, 5])
+def test_full_load_matches_scalar_path(database, min_requirements):
+    now = datetime.now()
+    database.extend(sales_rows(1, now))
+    analyzer = PurchasePatternAnalyzer(min_requirements=min_requirements, confidence_threshold=0.0)
+
+    store = IncrementalPatternStore()
+    store.refresh(now)
+
+    expected = scalar_predictions(database, analyzer)
+    assert expected
+    assert _stored(store, analyzer, now) == expected
+
+
+def test_incremental_and_backdated_rows_match_scalar_path(database):
+    now = datetime.now()
+    rows = sales_rows(2, now)
+    analyzer = PurchasePatternAnalyzer(min_requirements=3, confidence_threshold=0.0)
+
+    store = IncrementalPatternStore()
+    database.extend(rows[:len(rows) // 2])
+    store.refresh(now)
+    # Higher sales_ids with any created_date: appends, backdated rows in the window, rows older than it
+    database.extend(rows[len(rows) // 2:])
+    stats = store.refresh(now)
+
+    assert not stats["full_reload"]
+    assert stats["pairs_reloaded"]
+    assert _stored(store, analyzer, now) == scalar_predictions(database, analyzer)
+
+
+@pytest.mark.parametrize("min_requirements", [2, 3])
+def test_expiry_matches_scalar_path(database, min_requirements):
+    now = datetime.now()
+    database.extend(sales_rows(3, now))
+    analyzer = PurchasePatternAnalyzer(min_requirements=min_requirements, confidence_threshold=0.0)
+
+    store = IncrementalPatternStore()
+    store.refresh(now - timedelta(days=60))
+    stats = store.refresh(now)
+
+    assert not stats["full_reload"]
+    assert _stored(store, analyzer, now) == scalar_predictions(database, analyzer)
+
+
+def test_expired_amounts_leave_the_trailing_mean():
+    pair = PairStats()
+    for day, amount in ((100, 34.0), (110, 34.0), (120, 1.0)):
+        pair.add(day, amount)
+
+    pair.expire(115)
+
+    assert pair.recent == [(120, 1.0)]
+    assert list(pair.days) == [120]
+    assert pair.cycle_count == 0
+
+
+def test_pairs_outside_the_window_are_dropped(database):
+    now = datetime.now()
+    database.extend(sales_rows(7, now))
+
+    store = IncrementalPatternStore()
+    stats = store.refresh(now)
+
+    assert stats["pairs_expired"]
+    assert all(pair.days for pair in store._pairs.values())
+    assert stats["pairs"] == len({(r["client_id"], r["goods_id"]) for r in database
+                                  if r["created_date"].toordinal() >= store._cutoff_day(now)})
+
+
+def test_dropped_pair_buying_again_keeps_its_history(database):
+    now = datetime.now()
+    analyzer = PurchasePatternAnalyzer(min_requirements=3, confidence_threshold=0.0)
+
+    def sale(sales_id, days_ago, agent_id):
+        return {
+            "sales_id": sales_id, "client_id": 1, "client_name": "Client 1", "goods_id": 1, "goods_name": "Goods 1",
+            "agent_id": agent_id, "agent_name": f"Agent {agent_id}",
+            "created_date": now - timedelta(days=days_ago), "amount": 2.0,
+        }
+
+    database.extend(sale(i, 500 + 30 * i, agent_id=1) for i in range(1, 5))
+    store = IncrementalPatternStore()
+    assert store.refresh(now)["pairs"] == 0
+
+    database.extend(sale(4 + i, 90 - 30 * i, agent_id=2) for i in range(1, 4))
+    stats = store.refresh(now)
+
+    assert not stats["full_reload"]
+    assert stats["pairs_reloaded"] == 1
+    [(info, _)] = _stored(store, analyzer, now).values()
+    assert info["purchase_count"] == 7 and info["agent_id"] == 1
+    assert _stored(store, analyzer, now) == scalar_predictions(database, analyzer)
@@ -0,0 +1,74 @@
+from datetime import datetime
+
+import pytest
+
+import requests.rq as rq
+from common import NamesDatabase, sales_rows, serve_names
+from requests.prediction import PurchasePatternAnalyzer
+
+
+def _aggregated_rows(rows, cutoff: datetime, min_requirements: int):
+    """What AGGREGATED_PATTERNS_QUERY returns for these rows."""
+    pairs = {}
+    for row in sorted(rows, key=lambda r: (r["created_date"], r["sales_id"])):
+        pairs.setdefault((row["client_id"], row["goods_id"]), []).append(row)
+
+    result = []
+    for (client_id, goods_id), history in pairs.items():
+        window = [r for r in history if r["created_date"] >= cutoff]
+        if len(window) >= min_requirements:
+            result.append({
+                "client_id": client_id,
+                "goods_id": goods_id,
+                "agent_id": history[0]["agent_id"],
+                "purchase_count": len(window),
+                "history": ",".join(f"{r['created_date'].date()}:{r['amount']}" for r in window) or None,
+            })
+    return sorted(result, key=lambda r: -r["purchase_count"])
+
+
+class _Database(NamesDatabase):
+    """RemoteMySQL serving the fact, aggregated and dimension queries from a list of rows."""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def stream_batches(self, query, params=None, batch_size=100):
+        if query == rq.PURCHASE_FACT_QUERY:
+            result = sorted(self.rows, key=lambda r: (r["created_date"], r["sales_id"]), reverse=True)
+        else:
+            assert query == rq.AGGREGATED_PATTERNS_QUERY
+            cutoff, _, min_requirements = params
+            result = _aggregated_rows(self.rows, cutoff, min_requirements)
+        for start in range(0, len(result), batch_size):
+            yield result[start:start + batch_size]
+
+
+@pytest.fixture
+def database(monkeypatch):
+    rows = []
+    serve_names(monkeypatch, _Database(rows))
+    return rows
+
+
+def _predictions(analyzer: PurchasePatternAnalyzer, aggregate_in_db: bool):
+    patterns = rq.get_purchase_patterns(analyzer.min_requirements, aggregate_in_db=aggregate_in_db)["patterns"]
+    results = {}
+    for i, pattern in enumerate(patterns):
+        analysis = analyzer.analyze_client_product_pattern(pattern.dates, pattern.amounts.tolist())
+        if analysis is not None:
+            info = patterns.info(i)
+            # Documented difference: in-window purchases only when aggregated in MySQL
+            del info["purchase_count"]
+            results[(pattern.client_id, pattern.goods_id)] = (info, analysis)
+    return results
+
+
+@pytest.mark.parametrize("min_requirements", [2, 3, 5])
+def test_aggregated_patterns_match_default_path(database, min_requirements):
+    database.extend(sales_rows(6, datetime.now()))
+    analyzer = PurchasePatternAnalyzer(min_requirements=min_requirements, confidence_threshold=0.0)
+
+    expected = _predictions(analyzer, aggregate_in_db=False)
+    assert expected
+    assert _predictions(analyzer, aggregate_in_db=True) == expected
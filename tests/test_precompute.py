@@ -0,0 +1,42 @@
+from datetime import date, datetime
+
+from requests.precompute import MaterializedPredictions
+
+
+def _item(client_id: int, confidence: float, goods_name="Goods"):
+    pattern = {
+        "client_id": client_id, "client_name": f"Client {client_id}",
+        "agent_id": 1, "agent_name": "Agent",
+        "goods_id": 1, "goods_name": goods_name,
+        "purchase_count": 4,
+    }
+    analysis = {
+        "last_requirement_date": date(2026, 3, 1),
+        "days_since_last_requirement": client_id,
+        "predicted_next_purchase_date": date(2026, 3, 15),
+        "average_cycle_days": 14.0,
+        "confidence_score": confidence,
+        "predicted_amount": 2.0,
+        "requirement_count": 4,
+        "pattern_consistency": "regular",
+    }
+    return pattern, analysis
+
+
+def test_rejected_predictions_are_not_counted():
+    # The goods without a name is rejected by make_prediction, as validation would
+    items = [_item(1, 0.9), _item(2, 0.8, goods_name=None), _item(3, 0.7), _item(4, 0.5)]
+    materialized = MaterializedPredictions(3, items, datetime.now())
+
+    assert materialized.count(0.0) == 3
+    assert materialized.count(0.6) == 2
+
+    page, total, cursor = materialized.select(0.6, limit=1)
+    assert [p.client_id for p in page] == [3]
+    assert total == 2
+    assert cursor is not None
+
+    # Sort key of client 3: most overdue first, then client and goods id
+    rest, _, cursor = materialized.select(0.6, limit=1, after=(-3, 3, 1))
+    assert [p.client_id for p in rest] == [1]
+    assert cursor is None
@@ -0,0 +1,148 @@
+import random
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+import requests.prediction as prediction
+from core.config import PATTERN_WINDOW_DAYS
+from requests.prediction import PatternStats, PurchasePatternAnalyzer
+
+NOWS = [
+    datetime(2026, 3, 15, 0, 0, 0),  # exactly midnight: the cutoff day itself is inside the window
+    datetime(2026, 3, 15, 0, 0, 1),
+    datetime(2026, 3, 15, 13, 30),
+    datetime(2026, 3, 15, 23, 59, 59),
+]
+
+
+class _FixedDatetime(datetime):
+    fixed: datetime = None
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.fixed
+
+
+@pytest.fixture
+def frozen_now(monkeypatch):
+    """analyze_client_product_pattern reads datetime.now(); pin it to the "now" given to analyze_many."""
+    def freeze(now: datetime):
+        _FixedDatetime.fixed = now
+        monkeypatch.setattr(prediction, "datetime", _FixedDatetime)
+    return freeze
+
+
+def _cases(seed: int, now: datetime, count: int):
+    """(dates, amounts) per pattern, in arbitrary order, biased towards the edges of the analysis."""
+    rng = random.Random(seed)
+    today = now.date()
+    cutoff = (now - timedelta(days=PATTERN_WINDOW_DAYS)).date()
+    cases = []
+
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.15:
+            # Zero cycles: every purchase on the same day
+            dates = [today - timedelta(days=rng.randint(0, 60))] * rng.randint(1, 5)
+        else:
+            cycle = rng.choice([1, 7, 14, 30, 45, 90])
+            last = rng.randint(-5, 120) if kind < 0.9 else (today - cutoff).days + rng.randint(-2, 2)
+            dates = []
+            for i in range(rng.randint(1, 9)):
+                offset = last + i * cycle + rng.randint(-2, 2)
+                dates.append(today - timedelta(days=offset))
+                if rng.random() < 0.2:
+                    # Same day twice
+                    dates.append(dates[-1])
+            if rng.random() < 0.3:
+                # Purchases straddling the window cutoff
+                dates += [cutoff + timedelta(days=rng.randint(-1, 1)) for _ in range(rng.randint(1, 3))]
+
+        amounts = [float(rng.choice([0.5, 1, 2, 3, 5, 7.25, 10, 34])) for _ in dates]
+        order = list(range(len(dates)))
+        rng.shuffle(order)
+        cases.append(([dates[i] for i in order], [amounts[i] for i in order]))
+
+    return cases
+
+
+def _pack(cases):
+    offsets = np.zeros(len(cases) + 1, dtype=np.int64)
+    np.cumsum([len(dates) for dates, _ in cases], out=offsets[1:])
+    days = np.array([d.toordinal() for dates, _ in cases for d in dates], dtype=np.int32)
+    amounts = np.array([a for _, amounts in cases for a in amounts], dtype=np.float64)
+    return offsets, days, amounts
+
+
+@pytest.mark.parametrize("now", NOWS)
+@pytest.mark.parametrize("min_requirements", [2, 3, 5])
+def test_analyze_many_matches_scalar(frozen_now, now, min_requirements):
+    frozen_now(now)
+    analyzer = PurchasePatternAnalyzer(min_requirements=min_requirements, confidence_threshold=0.0)
+    cases = _cases(min_requirements, now, 3000)
+
+    expected = [analyzer.analyze_client_product_pattern(dates, amounts) for dates, amounts in cases]
+    actual = analyzer.analyze_many(*_pack(cases), now=now)
+
+    assert sum(result is not None for result in expected) > 100
+    assert actual == expected
+
+
+def test_datetimes_are_truncated_to_their_day(frozen_now):
+    now = NOWS[2]
+    frozen_now(now)
+    analyzer = PurchasePatternAnalyzer(min_requirements=2)
+    dates = [datetime(2026, 2, 13, 18), datetime(2026, 2, 27, 9), datetime(2026, 3, 13, 23, 59)]
+
+    expected = analyzer.analyze_client_product_pattern(dates, [1.0, 2.0, 3.0])
+    actual = analyzer.analyze_many(*_pack([([d.date() for d in dates], [1.0, 2.0, 3.0])]), now=now)
+
+    assert expected is not None
+    assert actual == [expected]
+
+
+@pytest.mark.parametrize("amounts, predicted", [
+    ([4.0], None),  # one purchase, no cycle
+    ([4.0, 1.0], 2.5),
+    ([2.0, 4.0, 1.0], 2.33),
+    ([9.0, 4.0, 1.0, 1.0], 2.0),
+])
+def test_predicted_amount_is_the_trailing_mean(frozen_now, amounts, predicted):
+    now = NOWS[2]
+    frozen_now(now)
+    analyzer = PurchasePatternAnalyzer(min_requirements=1)
+    today = now.date()
+    dates = [today - timedelta(days=10 * (len(amounts) - i)) for i in range(len(amounts))]
+
+    [actual] = analyzer.analyze_many(*_pack([(dates, amounts)]), now=now)
+
+    assert actual == analyzer.analyze_client_product_pattern(dates, amounts)
+    assert (actual and actual["predicted_amount"]) == predicted
+
+
+def test_pattern_stats_are_threshold_independent():
+    now = NOWS[2]
+    cases = _cases(7, now, 500)
+    stats = PurchasePatternAnalyzer().pattern_stats(*_pack(cases), now=now)
+
+    for min_requirements in (2, 3, 4):
+        analyzer = PurchasePatternAnalyzer(min_requirements=min_requirements)
+        assert stats.analyses(min_requirements, now) == analyzer.analyze_many(*_pack(cases), now=now)
+
+    assert stats.valid_for(now.replace(hour=23))
+    assert not stats.valid_for(now + timedelta(days=1))
+
+
+def test_merged_shards_match_one_table():
+    now = NOWS[2]
+    cases = _cases(11, now, 500)
+    analyzer = PurchasePatternAnalyzer()
+    whole = analyzer.pattern_stats(*_pack(cases), now=now)
+
+    shards = [np.arange(0, len(cases), 2), np.arange(1, len(cases), 2)]
+    merged = PatternStats.merge(len(cases), [
+        (indices, analyzer.pattern_stats(*_pack([cases[i] for i in indices]), now=now)) for indices in shards
+    ])
+
+    assert merged.analyses(3, now) == whole.analyses(3, now)
@@ -0,0 +1,73 @@
+import json
+
+import requests.rq as rq
+from requests import query_plans
+
+
+class _Database:
+    """RemoteMySQL answering EXPLAIN with one ref access on sales per query and every index present."""
+
+    def __init__(self, key: str, access_type: str = "ref"):
+        self.key = key
+        self.access_type = access_type
+        self.explained = []
+
+    def query_one(self, query, params=None):
+        self.explained.append(query[len("EXPLAIN FORMAT=JSON "):])
+        plan = {"query_block": {"table": {
+            "table_name": "s", "access_type": self.access_type, "key": self.key,
+            "rows_examined_per_scan": len(self.explained), "using_index": True,
+        }}}
+        return {"EXPLAIN": json.dumps(plan)}
+
+    def query(self, query, params=None):
+        table = params[0]
+        return [
+            {"index_name": name, "column_name": column}
+            for index_table, name, columns, _ in query_plans.RECOMMENDED_INDEXES
+            if index_table == table
+            for column in columns
+        ]
+
+
+def test_dimension_queries_are_explained(tmp_path):
+    db = _Database("idx_sales_created_client_agent")
+    query_plans.check(db, str(tmp_path / "plans.json"))
+
+    for kind in rq.DIMENSION_TABLES:
+        assert rq.dimension_scan_query(kind) in db.explained
+        assert next(rq.dimension_lookups(kind, list(range(1, 101))))[0] in db.explained
+
+
+def test_plan_change_is_reported(tmp_path):
+    history = str(tmp_path / "plans.json")
+
+    first = query_plans.check(_Database("idx_sales_created_client_agent"), history)
+    assert first["plan_changes"] == []
+    # Only the row estimates differ: same plan
+    assert query_plans.check(_Database("idx_sales_created_client_agent"), history)["plan_changes"] == []
+
+    report = query_plans.check(_Database("PRIMARY", "range"), history)
+    changes = {change["query"]: change for change in report["plan_changes"]}
+    assert set(changes) == {query["name"] for query in report["queries"]}
+    change = changes["purchase_facts"]
+    assert change["before"]["tables"][0]["key"] == "idx_sales_created_client_agent"
+    assert change["after"]["tables"][0] == {"table": "s", "access_type": "range", "key": "PRIMARY", "using_index": True}
+    assert change["since"] == first["checked_at"]
+
+    # The new plan is the one compared against next time
+    assert query_plans.check(_Database("PRIMARY", "range"), history)["plan_changes"] == []
+
+
+def test_changed_sql_is_not_a_plan_change(tmp_path):
+    history = str(tmp_path / "plans.json")
+    query_plans.check(_Database("idx_sales_created_client_agent"), history)
+
+    with open(history) as f:
+        stored = json.load(f)
+    stored["purchase_facts"]["sql_hash"] = "0"
+    with open(history, "w") as f:
+        json.dump(stored, f)
+
+    report = query_plans.check(_Database("PRIMARY"), history)
+    assert "purchase_facts" not in {change["query"] for change in report["plan_changes"]}
@@ -0,0 +1,72 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+import requests.rq as rq
+from common import NamesDatabase, sales_rows, scalar_predictions, serve_names
+from requests.prediction import PurchasePatternAnalyzer
+from requests.snapshot import SalesSnapshot
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """rq's snapshot queries served from a list of rows."""
+    rows = []
+    serve_names(monkeypatch, NamesDatabase())
+
+    def get_sales_facts(after_sales_id=0):
+        return iter([r for r in rows if r["sales_id"] > after_sales_id])
+
+    monkeypatch.setattr(rq, "get_sales_facts", get_sales_facts)
+    return rows
+
+
+def _served(snapshot: SalesSnapshot, analyzer: PurchasePatternAnalyzer, now: datetime):
+    return {(info["client_id"], info["goods_id"]): (info, analysis) for info, analysis in snapshot.analyze(analyzer, now)}
+
+
+@pytest.mark.parametrize("min_requirements", [2, 3])
+def test_build_matches_scalar_path(database, tmp_path, min_requirements):
+    now = datetime.now()
+    # Day granularity: same-day purchases are ordered by sales_id on both paths
+    database.extend(sales_rows(4, now, midnight=True))
+    analyzer = PurchasePatternAnalyzer(min_requirements=min_requirements, confidence_threshold=0.0)
+
+    snapshot = SalesSnapshot(str(tmp_path))
+    snapshot.refresh()
+
+    expected = scalar_predictions(database, analyzer)
+    assert expected
+    assert _served(snapshot, analyzer, now) == expected
+
+
+def test_merged_refreshes_match_a_full_build(database, tmp_path):
+    now = datetime.now()
+    rows = sales_rows(5, now, midnight=True)
+    analyzer = PurchasePatternAnalyzer(min_requirements=3, confidence_threshold=0.0)
+
+    snapshot = SalesSnapshot(str(tmp_path / "merged"))
+    for part in np.array_split(np.arange(len(rows)), 4):
+        # Each part has rows for known and new pairs, before, between and after their existing days
+        database.extend(rows[i] for i in part)
+        stats = snapshot.refresh()
+    assert not stats.get("full_build") and stats["rows_added"]
+
+    built = SalesSnapshot(str(tmp_path / "built"))
+    built.build()
+
+    for name in ("client_id", "goods_id", "sales_id", "day", "amount", "pair_offsets"):
+        assert np.array_equal(snapshot._data[name], built._data[name])
+    assert _served(snapshot, analyzer, now) == scalar_predictions(database, analyzer)
+
+
+def test_full_rebuild_after_interval(database, tmp_path):
+    database.extend(sales_rows(6, datetime.now()))
+    snapshot = SalesSnapshot(str(tmp_path), full_rebuild_seconds=0)
+
+    assert snapshot.refresh()["full_build"]
+    # A backdated edit the sales_id watermark cannot see
+    database[0]["amount"] += 1
+    assert snapshot.refresh()["full_build"]
+    assert float(snapshot._data["amount"].sum()) == pytest.approx(sum(r["amount"] for r in database))